@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import numpy as np
+
+log = logging.getLogger('artifacts')
+
+# Startup artifact cache.
+# Everything a server needs before it can handle its first frame that only
+# depends on files and settings (the ground truth map, its statistics, the
+# perspective warp maps and projection table of the camera, and the
+# classifier's packing levels) is stored in one .npz next to this module.
+# The file holds a key hashed from the artifact version, all of the inputs
+# and the cv2 version, and is rebuilt (and rewritten) when it is missing or its key does
+# not match, so an edited map or calibration never loads stale arrays.
+# Paths are relative to this module, not the working directory, and the
+# geometry modules are only imported when they are needed
+artifact_version = 2
+module_dir = os.path.dirname(os.path.abspath(__file__))
+ground_truth_path = os.path.join(module_dir, '..', 'calibration_images', 'map_bw.png')
+artifact_path = os.path.join(module_dir, 'startup_artifacts.npz')
+# Shape of the simulator's camera frames
+camera_shape = (160, 320, 3)
+
+# Artifacts in use (name -> array), loaded on first use
+_artifacts = None
+
+# Define a function to hash the inputs the artifacts are computed from
+def artifact_key():
+    import cv2
+    from perception import perspective_points, pixel_classifier
+    src, dst = perspective_points(camera_shape)
+    key = hashlib.sha1()
+    key.update(str(artifact_version).encode())
+    with open(ground_truth_path, 'rb') as f:
+        key.update(f.read())
+    key.update(repr(camera_shape).encode())
+    key.update(src.tobytes())
+    key.update(dst.tobytes())
+    key.update(repr(sorted(pixel_classifier.thresholds.items())).encode())
+    # The packing levels depend on cv2's RGB->gray rounding
+    key.update(cv2.__version__.encode())
+    return key.hexdigest()
+
+# Define a function to compute the artifacts
+def build_artifacts(key):
+    import cv2
+    from perception import perspective_points, pixel_classifier
+    from warp import get_warp_map
+    from projection import get_projection_table
+    # Ground truth: 255 on navigable cells, 0 elsewhere (the map's green channel)
+    truth = cv2.imread(ground_truth_path, cv2.IMREAD_GRAYSCALE)
+    if truth is None:
+        raise IOError('cannot read the ground truth map {}'.format(ground_truth_path))
+    src, dst = perspective_points(camera_shape)
+    warp_map = get_warp_map(camera_shape, src, dst)
+    table = get_projection_table(camera_shape, src, dst)
+    nbins, levels = pixel_classifier.packing()
+    artifacts = {
+        'key': np.array(key),
+        'ground_truth': truth,
+        'navigable_cells': np.int64(np.count_nonzero(truth)),
+        'warp_map_x': warp_map.map_x,
+        'warp_map_y': warp_map.map_y,
+        'packing_nbins': np.int64(nbins),
+        'packing_levels': np.zeros(0, dtype=np.int64) if levels is None else levels,
+    }
+    for name, array in table.arrays().items():
+        artifacts['table_' + name] = array
+    return artifacts
+
+# Define a function to get the artifacts, from the cache file if it is up to
+# date, otherwise built and written to it (a cache that cannot be written is
+# only logged, the artifacts are still returned)
+def load_artifacts(path=None):
+    global _artifacts
+    if _artifacts is not None:
+        return _artifacts
+    path = artifact_path if path is None else path
+    key = artifact_key()
+    try:
+        with np.load(path) as data:
+            if str(data['key']) == key:
+                _artifacts = {name: data[name] for name in data.files}
+    except (OSError, KeyError, ValueError) as e:
+        if os.path.exists(path):
+            log.warning('ignoring unreadable startup artifacts %s: %s', path, e)
+    if _artifacts is None:
+        artifacts = build_artifacts(key)
+        try:
+            # Written under a temporary name, so a reader never sees a partial file
+            temp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp, 'wb') as f:
+                np.savez(f, **artifacts)
+            os.replace(temp, path)
+        except OSError as e:
+            log.warning('cannot write startup artifacts %s: %s', path, e)
+            if os.path.exists(temp):
+                os.remove(temp)
+        _artifacts = artifacts
+    return _artifacts
+
+# Define a function to put the cached geometry and classifier levels in place,
+# so the first frame does not compute them
+def install_artifacts():
+    from perception import perspective_points
+    from warp import get_warp_map
+    from projection import get_projection_table, table_fields
+    from classify import seed_packing_levels
+    artifacts = load_artifacts()
+    src, dst = perspective_points(camera_shape)
+    get_warp_map(camera_shape, src, dst, (artifacts['warp_map_x'], artifacts['warp_map_y']))
+    get_projection_table(camera_shape, src, dst,
+                         {name: artifacts['table_' + name] for name in table_fields})
+    levels = artifacts['packing_levels']
+    seed_packing_levels(int(artifacts['packing_nbins']), levels if len(levels) else None)
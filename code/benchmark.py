@@ -0,0 +1,386 @@
+# Benchmarks for the rover pipeline, driven by the recorded test_dataset frames
+# Example: $ python benchmark.py projection
+# Stored baselines: $ python benchmark.py stages --save-baseline, later runs of
+# the same benchmarks fail when they got slower than the baseline.  The
+# committed benchmark_baselines.json has the slowest p50/p99 of three full runs
+# on the machine in its 'machine' entry; save new ones on other machines.
+# A benchmark also fails (exit status 1) when a fast path gives different
+# results than, or is not faster than, the path it replaces
+import argparse
+import base64
+import csv
+import glob
+import json
+import os
+import platform
+import time
+import numpy as np
+import cv2
+from PIL import Image
+from io import BytesIO
+
+from perception import perspective_points, perspect_transform, classify_pixels, \
+    classify_labels, rover_coords, to_polar_coords, pix_to_world, perception_step, perception_batch, \
+    AdaptiveResolution
+from decision import decision_step
+from rover_state import RoverState
+from supporting_functions import update_rover, create_output_images, telemetry_step
+from insets import InsetRenderer
+from worldmap import WorldMap
+from classify import OBSTACLE, ROCK, NAVIGABLE
+from projection import get_projection_table
+from telemetry import TelemetryDecoder, run_message
+from runs import open_run
+from rocks import RockTracker
+
+# Folder with the recorded test run, resolved relative to this file
+dataset_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_dataset')
+# Default file the baselines are stored in
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# Define a function to load the recorded camera frames as RGB arrays
+def load_frames(limit=None, dataset=dataset_dir):
+    paths = sorted(glob.glob(os.path.join(dataset, 'IMG', '*.jpg')))[:limit]
+    return [np.asarray(Image.open(path)) for path in paths]
+
+# Define a function to build simulator-style telemetry messages from the
+# recorded log: base64 JPEG frames plus the pose fields as strings
+def load_telemetry(limit=None, dataset=dataset_dir):
+    run = open_run(dataset)
+    return [run_message(run, i) for i in range(len(run) if limit is None else min(limit, len(run)))]
+
+# Define a function to time fn over every frame, repeated a few times
+# setup(frame), if given, runs untimed before each call
+# Returns the per-call latencies in seconds
+def time_frames(fn, frames, repeat=5, setup=None):
+    latencies = []
+    for _ in range(repeat):
+        for frame in frames:
+            if setup is not None:
+                setup(frame)
+            start = time.perf_counter()
+            fn(frame)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+# Results reported by the running benchmark, name -> statistics
+measured = {}
+
+# Define a function to print one line of benchmark results and record them
+def report(name, latencies):
+    stats = {'mean_us': 1e6*np.mean(latencies), 'p50_us': 1e6*np.percentile(latencies, 50),
+             'p99_us': 1e6*np.percentile(latencies, 99), 'per_second': 1/np.mean(latencies)}
+    measured[name] = stats
+    print('{:<28s} mean {:8.1f} us   p50 {:8.1f} us   p99 {:8.1f} us   {:8.0f} frames/s'.format(
+        name, stats['mean_us'], stats['p50_us'], stats['p99_us'], stats['per_second']))
+    return stats
+
+# Define a function to print a check that failed and pass its result on
+def check(ok, message):
+    if not ok:
+        print('FAIL ' + message)
+    return ok
+
+# Define a function to check that a fast path beats the path it replaces by
+# more than minimum; medians, so a few runs slowed down by the machine do not
+# decide it
+def check_speedup(name, reference_lat, fast_lat, minimum=1.0):
+    speedup = np.median(reference_lat) / np.median(fast_lat)
+    print('speedup: {:.2f}x'.format(speedup))
+    return check(speedup > minimum, '{} is not {:.2f}x faster than the path it replaces'.format(name, minimum))
+
+# Warp path: perspective warp -> classify -> nonzero -> rover coords -> polar coords
+def warp_projection(img, src, dst):
+    warped = perspect_transform(img, src, dst)
+    rocks, obstacles, navig = classify_pixels(warped)
+    for mask in (rocks, obstacles):
+        x_pix, y_pix = rover_coords(mask)
+        to_polar_coords(x_pix, y_pix)
+    x_pix, y_pix = rover_coords(navig)
+    dist, angles = to_polar_coords(x_pix, y_pix)
+    return dist, angles
+
+# Lookup path: warp -> classify -> gather from the projection table
+def lookup_projection(img, src, dst, table):
+    labels = table.gather(classify_labels(perspect_transform(img, src, dst)))
+    table.select(labels & ROCK)
+    table.select(labels & OBSTACLE, include_border=True)
+    _, _, dist, angles = table.select(labels & NAVIGABLE)
+    return dist, angles
+
+# Separate cv2.inRange() pass per class, as classify_pixels() used to do
+def inrange_masks(img):
+    rocks = cv2.inRange(img, (100, 100, 0), (255, 255, 80))
+    obstacles = cv2.inRange(img, (0, 0, 0), (160, 160, 160))
+    navig = cv2.inRange(img, (161, 161, 161), (255, 255, 255))
+    return rocks, obstacles, navig
+
+# Compare the fused label classifier against one inRange pass per class
+def bench_classify(frames, repeat):
+    mismatches = 0
+    for frame in frames:
+        if not all(np.array_equal(a, b) for a, b in zip(inrange_masks(frame), classify_pixels(frame))):
+            mismatches += 1
+    print('fused vs inRange masks: {} of {} frames differ'.format(mismatches, len(frames)))
+    inrange_lat = time_frames(inrange_masks, frames, repeat)
+    fused_lat = time_frames(classify_labels, frames, repeat)
+    report('inRange x3', inrange_lat)
+    report('fused labels', fused_lat)
+    report('fused labels + masks', time_frames(classify_pixels, frames, repeat))
+    return check(mismatches == 0, 'fused classifier differs from inRange') \
+        & check_speedup('fused labels', inrange_lat, fused_lat)
+
+# Compare the warp path against the projection table lookup
+def bench_projection(frames, repeat):
+    src, dst = perspective_points(frames[0].shape)
+    table = get_projection_table(frames[0].shape, src, dst)
+    # The table projects the same warped pixels, so it must match exactly
+    mismatches = 0
+    for frame in frames:
+        dist, angles = warp_projection(frame, src, dst)
+        lk_dist, lk_angles = lookup_projection(frame, src, dst, table)
+        if not (np.array_equal(dist, lk_dist) and np.array_equal(angles, lk_angles)):
+            mismatches += 1
+    print('lookup vs warp: {} of {} frames differ'.format(mismatches, len(frames)))
+    warp_lat = time_frames(lambda img: warp_projection(img, src, dst), frames, repeat)
+    lookup_lat = time_frames(lambda img: lookup_projection(img, src, dst, table), frames, repeat)
+    report('warp projection', warp_lat)
+    report('lookup projection', lookup_lat)
+    return check(mismatches == 0, 'lookup projection differs from the warp path') \
+        & check_speedup('lookup projection', warp_lat, lookup_lat)
+
+# Telemetry decoding as update_rover() used to do it: PIL decode and one
+# string replace + float conversion per field
+def legacy_decode(data):
+    def to_float(string):
+        return float(string.replace(',', '.')) if ',' in string else float(string)
+    fields = [to_float(data[key]) for key in ('speed', 'yaw', 'pitch', 'roll', 'throttle', 'steering_angle')]
+    fields.append([to_float(pos.strip()) for pos in data['position'].split(';')])
+    image = Image.open(BytesIO(base64.b64decode(data['image'])))
+    return fields, np.asarray(image)
+
+# Compare the telemetry decoder against the legacy decode path
+def bench_decode(frames, repeat):
+    messages = load_telemetry(len(frames))
+    decoder = TelemetryDecoder()
+    def decode(data):
+        decoder.decode_fields(data)
+        return decoder.decode_image(data['image'])
+    mismatches = sum(not np.array_equal(legacy_decode(data)[1], decode(data)) for data in messages)
+    print('decoder vs PIL frames: {} of {} differ'.format(mismatches, len(messages)))
+    legacy_lat = time_frames(legacy_decode, messages, repeat)
+    decoder_lat = time_frames(decode, messages, repeat)
+    report('legacy decode', legacy_lat)
+    report('telemetry decoder', decoder_lat)
+    return check(mismatches == 0, 'telemetry decoder differs from PIL') \
+        & check_speedup('telemetry decoder', legacy_lat, decoder_lat)
+
+# Define a function to load the recorded poses matching load_frames()
+def load_poses(limit=None, dataset=dataset_dir):
+    with open(os.path.join(dataset, 'robot_log.csv')) as f:
+        rows = list(csv.DictReader(f, delimiter=';'))[:limit]
+    column = lambda name: np.array([float(row[name]) for row in rows])
+    return {'pos': np.column_stack((column('X_Position'), column('Y_Position'))),
+            'yaw': column('Yaw'), 'pitch': column('Pitch'), 'roll': column('Roll'),
+            'speed': column('Speed'), 'throttle': column('Throttle'), 'steer': column('SteerAngle')}
+
+# Compare perception_step() frame by frame against perception_batch()
+# Whole runs of the two alternate, so a slow spell of the machine hits both,
+# and the batch has to be at least 10% faster in the median run
+def bench_batch(frames, repeat):
+    poses = load_poses(len(frames))
+    stack = np.stack(frames)
+    ok = True
+    for mode in ('warp', 'lookup'):
+        def per_frame():
+            Rover = RoverState()
+            Rover.perception_mode = mode
+            for i, frame in enumerate(frames):
+                Rover.img = frame
+                Rover.pos = poses['pos'][i]
+                Rover.yaw, Rover.pitch, Rover.roll = poses['yaw'][i], poses['pitch'][i], poses['roll'][i]
+                perception_step(Rover)
+            return Rover.worldmap
+        def batched():
+            return perception_batch(stack, poses, WorldMap(200), mode)
+        same = np.array_equal(per_frame().counts, batched().counts)
+        print('{}: batch worldmap {} per-frame worldmap'.format(mode, 'matches' if same else 'DIFFERS from'))
+        ok &= check(same, mode + ' perception_batch differs from perception_step')
+        step_lat, batch_lat = np.zeros(repeat), np.zeros(repeat)
+        for i in range(repeat):
+            step_lat[i] = time_frames(lambda _: per_frame(), [None], 1)[0] / len(frames)
+            batch_lat[i] = time_frames(lambda _: batched(), [None], 1)[0] / len(frames)
+        report(mode + ' perception_step', step_lat)
+        report(mode + ' perception_batch', batch_lat)
+        ok &= check_speedup(mode + ' perception_batch', step_lat, batch_lat, minimum=1.1)
+    return ok
+
+# Define a function to set up a Rover with frame i of the recorded run
+def load_pose(Rover, frames, poses, i):
+    Rover.img = frames[i]
+    Rover.pos = poses['pos'][i]
+    Rover.yaw, Rover.pitch, Rover.roll = poses['yaw'][i], poses['pitch'][i], poses['roll'][i]
+    Rover.vel, Rover.throttle, Rover.steer = poses['speed'][i], poses['throttle'][i], poses['steer'][i]
+    return Rover
+
+# Time every stage of the telemetry handler on its own, then the whole handler
+def bench_stages(frames, repeat):
+    messages = load_telemetry(len(frames))
+    poses = load_poses(len(frames))
+    indices = range(len(frames))
+    decoder = TelemetryDecoder()
+    Rover = RoverState()
+    report('update_rover', time_frames(lambda data: update_rover(Rover, data, decoder), messages, repeat))
+    # perception_step() helpers, each fed with the output of the one before
+    src, dst = perspective_points(frames[0].shape)
+    warped = [perspect_transform(frame, src, dst) for frame in frames]
+    navig = [classify_pixels(img)[2] for img in warped]
+    nav_pix = [rover_coords(mask) for mask in navig]
+    report('perspect_transform', time_frames(lambda img: perspect_transform(img, src, dst), frames, repeat))
+    report('classify_pixels', time_frames(classify_pixels, warped, repeat))
+    report('rover_coords', time_frames(rover_coords, navig, repeat))
+    report('pix_to_world', time_frames(lambda i: pix_to_world(nav_pix[i][0], nav_pix[i][1], poses['pos'][i][0],
+                                                              poses['pos'][i][1], poses['yaw'][i], 200, 10),
+                                       indices, repeat))
+    report('to_polar_coords', time_frames(lambda pix: to_polar_coords(*pix), nav_pix, repeat))
+    # Every perception path must leave the same worldmap as the default warp
+    # path (roi leaves out the warp border, so only its rock and navigable
+    # channels are compared; subsampled roi maps are sparser by design)
+    ok = True
+    reference = None
+    for mode in ('warp', 'lookup'):
+        for lean in (False, True):
+            Rover = RoverState(lean=lean)
+            Rover.perception_mode = mode
+            name = 'perception_step ' + mode + (' lean' if lean else '')
+            report(name, time_frames(lambda i: perception_step(load_pose(Rover, frames, poses, i)), indices, repeat))
+            if reference is None:
+                reference = Rover.worldmap.dense()
+            ok &= check(np.array_equal(Rover.worldmap.dense(), reference), name + ' worldmap differs from warp')
+    for stride in (1, 2, 4):
+        Rover = RoverState()
+        Rover.perception_mode = 'roi'
+        Rover.adaptive_resolution = AdaptiveResolution(budget=None, stride=stride)
+        name = 'perception_step roi' + (' stride {}'.format(stride) if stride > 1 else '')
+        report(name, time_frames(lambda i: perception_step(load_pose(Rover, frames, poses, i)), indices, repeat))
+        if stride == 1:
+            ok &= check(np.array_equal(Rover.worldmap.dense()[:,:,1:], reference[:,:,1:]),
+                        name + ' worldmap differs from warp')
+    # decision_step() and the output images on the state perception left
+    Rover = RoverState()
+    Rover.start_time, Rover.total_time = 0, 0
+    setup = lambda i: perception_step(load_pose(Rover, frames, poses, i))
+    report('decision_step', time_frames(lambda i: decision_step(Rover), indices, repeat, setup))
+    report('create_output_images', time_frames(lambda i: create_output_images(Rover), indices, repeat, setup))
+    # The whole telemetry handler as drive_rover.py runs it, with a fresh
+    # Rover (and so a fresh map) every pass over the run
+    latencies = []
+    for _ in range(repeat):
+        Rover = RoverState()
+        insets = InsetRenderer()
+        latencies.append(time_frames(lambda data: telemetry_step(Rover, data, insets, decoder),
+                                     messages, 1))
+    report('telemetry_step', np.concatenate(latencies))
+    return ok
+
+# Time rock detection on the frames that show rock pixels: connected
+# components of the whole rock mask against RockTracker.update(), which
+# only searches the windows its tracks predict (a fresh tracker per pass)
+def bench_rocks(frames, repeat):
+    poses = load_poses(len(frames))
+    Rover = RoverState()
+    Rover.rock_tracker = None
+    masks = []
+    for i in range(len(frames)):
+        perception_step(load_pose(Rover, frames, poses, i))
+        masks.append((i, Rover.vision_image.copy()))
+    masks = [(i, image) for i, image in masks if np.any(image[:,:,1])]
+    if not masks:
+        print('no rock pixels in these frames')
+        return True
+    tracker = RockTracker()
+    rows = masks[0][1].shape[0]
+    report('rock components full mask', time_frames(lambda m: tracker.detect(m[1][:,:,1], rows), masks, repeat))
+    def setup(m):
+        load_pose(Rover, frames, poses, m[0])
+        Rover.vision_image = m[1]
+    latencies = []
+    searches = 0
+    for _ in range(repeat):
+        tracker = RockTracker()
+        latencies.append(time_frames(lambda m: tracker.update(Rover), masks, 1, setup))
+        searches += tracker.full_searches
+    report('RockTracker.update', np.concatenate(latencies))
+    print('full mask searches: {} of {} frames'.format(searches, repeat * len(masks)))
+    return True
+
+benchmarks = {
+    'batch': bench_batch,
+    'classify': bench_classify,
+    'decode': bench_decode,
+    'projection': bench_projection,
+    'rocks': bench_rocks,
+    'stages': bench_stages,
+}
+
+# Define a function to compare results against stored baselines
+# A benchmark regresses when its p50 got slower by more than tolerance (0.3 is
+# 30%) or its p99 by more than p99_tolerance
+# Returns the list of regressions as printable strings
+def compare_baseline(results, baseline, tolerance, p99_tolerance):
+    regressions = []
+    for bench, names in results.items():
+        for name, stats in names.items():
+            base = baseline.get(bench, {}).get(name)
+            if base is None:
+                continue
+            for key, allowed in (('p50_us', tolerance), ('p99_us', p99_tolerance)):
+                if stats[key] > base[key] * (1 + allowed):
+                    regressions.append('{}/{}: {} {:.1f} us vs baseline {:.1f} us (+{:.0f}%)'.format(
+                        bench, name, key[:3], stats[key], base[key], 100 * (stats[key] / base[key] - 1)))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rover pipeline benchmarks')
+    parser.add_argument('names', nargs='*', default=sorted(benchmarks),
+                        help='Benchmarks to run: {}'.format(', '.join(sorted(benchmarks))))
+    parser.add_argument('--frames', type=int, default=None, help='Limit the number of frames used')
+    parser.add_argument('--repeat', type=int, default=5, help='Passes over the frames per benchmark')
+    parser.add_argument('--baseline', type=str, default=baseline_path, help='Baseline file to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results of this run as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed p50 slowdown vs the baseline')
+    parser.add_argument('--p99-tolerance', type=float, default=1.0, help='Allowed p99 slowdown vs the baseline')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    ok = True
+    results = {}
+    for name in args.names:
+        print('== {} ({} frames)'.format(name, len(frames)))
+        measured.clear()
+        ok = benchmarks[name](frames, args.repeat) and ok
+        results[name] = dict(measured)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        baseline['machine'] = {'node': platform.node(), 'machine': platform.machine(),
+                               'python': platform.python_version(), 'frames': len(frames)}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance, args.p99_tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            ok = False
+        else:
+            print('no regressions against {}'.format(args.baseline))
+    raise SystemExit(0 if ok else 1)
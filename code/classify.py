@@ -0,0 +1,163 @@
+import threading
+import numpy as np
+import cv2
+
+# Class bits in the label image, one bit per Rover.vision_image channel
+OBSTACLE = 1
+ROCK = 2
+NAVIGABLE = 4
+
+# Default RGB ranges (inclusive) of each class, same as classify_pixels() used
+default_thresholds = {
+    OBSTACLE: ((0, 0, 0), (160, 160, 160)),
+    ROCK: ((100, 100, 0), (255, 255, 80)),
+    NAVIGABLE: ((161, 161, 161), (255, 255, 255)),
+}
+
+# Fused pixel classifier.
+# Every channel value is first quantized into the intervals between the
+# threshold breakpoints (exact, since every range boundary is a breakpoint),
+# then the quantized RGB triple indexes a class LUT holding the OR of the bits
+# of every range it falls in.  A frame becomes one uint8 label image instead
+# of one cv2.inRange() pass per class.
+#
+# Fast path: the quantized levels are picked so that cv2's RGB->gray weighted
+# sum is unique for every level triple, which packs the triple into a single
+# byte with one SIMD pass.  A frame is then cv2.LUT -> cv2.cvtColor -> cv2.LUT
+# The LUTs are built on first use, so that the levels can be seeded from the
+# startup artifacts (see seed_packing_levels()) instead of searched for
+class PixelClassifier():
+    def __init__(self, thresholds=None):
+        self.thresholds = None
+        self.class_lut = None # None until the LUTs are built
+        self._local = threading.local() # Intermediate images reused by labels(img, out), per thread
+        self._build_lock = threading.Lock()
+        self.set_thresholds(default_thresholds if thresholds is None else thresholds)
+
+    # Define a function to change the class ranges, the LUTs are rebuilt
+    # (on the next use) only if the ranges actually changed
+    def set_thresholds(self, thresholds):
+        thresholds = {bit: (tuple(int(v) for v in low), tuple(int(v) for v in high))
+                      for bit, (low, high) in thresholds.items()}
+        if thresholds == self.thresholds:
+            return
+        self.thresholds = thresholds
+        self.class_lut = None
+
+    # Define a function to get the number of bins per channel and the packing
+    # levels (None without the fast path) of the current ranges
+    def packing(self):
+        self._ensure_luts()
+        return self.nbins, self.levels
+
+    def _ensure_luts(self):
+        if self.class_lut is None:
+            with self._build_lock:
+                if self.class_lut is None:
+                    self._build_luts()
+
+    # class_lut is assigned last, it marks the LUTs as built
+    def _build_luts(self):
+        # Breakpoints shared by all channels: every value where a range starts or stops
+        points = set()
+        for low, high in self.thresholds.values():
+            points.update(p for p in low + tuple(h + 1 for h in high) if 0 < p < 256)
+        breaks = np.array(sorted(points), dtype=np.int32)
+        nbins = len(breaks) + 1
+        # Quantized bin of every channel value
+        self.bin_lut = np.searchsorted(breaks, np.arange(256), side='right')
+        # Class LUT over every bin triple, evaluated at the lowest value of each
+        # bin (membership is constant inside a bin)
+        lows = np.concatenate(([0], breaks))
+        r, g, b = np.meshgrid(lows, lows, lows, indexing='ij')
+        class_lut = np.zeros(r.shape, dtype=np.uint8)
+        for bit, (low, high) in self.thresholds.items():
+            inside = (r >= low[0]) & (r <= high[0]) & (g >= low[1]) & (g <= high[1]) \
+                   & (b >= low[2]) & (b <= high[2])
+            class_lut[inside] |= bit
+        class_lut = class_lut.ravel()
+        self.nbins = nbins
+        # Look for gray-packable levels for the fast path
+        self.level_lut = None
+        self.levels = levels = _packing_levels(nbins)
+        if levels is not None:
+            self.level_lut = levels[self.bin_lut].astype(np.uint8)
+            gray = _gray_of_triples(levels)
+            self.gray_lut = np.zeros(256, dtype=np.uint8)
+            self.gray_lut[gray] = class_lut
+        self.class_lut = class_lut
+
+    # Define a function to turn an RGB image (or an N x 3 pixel array) into labels
+    # With out given, the intermediate images are kept and reused by the next
+    # call of the same shape, so steady-state labelling allocates nothing
+    def labels(self, img, out=None):
+        self._ensure_luts()
+        if self.level_lut is not None:
+            pixels = img if img.ndim == 3 else img.reshape(1, -1, 3)
+            if out is not None:
+                levels, packed = self._work(pixels.shape)
+                cv2.LUT(pixels, self.level_lut, dst=levels)
+                cv2.cvtColor(levels, cv2.COLOR_RGB2GRAY, dst=packed)
+            else:
+                packed = cv2.cvtColor(cv2.LUT(pixels, self.level_lut), cv2.COLOR_RGB2GRAY)
+            if img.ndim != 3:
+                packed = packed.reshape(img.shape[:-1])
+            return cv2.LUT(packed, self.gray_lut, dst=out)
+        # Generic path for threshold sets with too many breakpoints to pack
+        index = (self.bin_lut[img[..., 0]] * self.nbins + self.bin_lut[img[..., 1]]) \
+              * self.nbins + self.bin_lut[img[..., 2]]
+        if out is None:
+            return self.class_lut[index]
+        return np.take(self.class_lut, index, out=out)
+
+    def _work(self, shape):
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers[0].shape != shape:
+            buffers = self._local.buffers = (np.empty(shape, dtype=np.uint8), np.empty(shape[:2], dtype=np.uint8))
+        return buffers
+
+# Define a function to get the gray value cv2 computes for every level triple
+# (in the same r-major order as the class LUT)
+def _gray_of_triples(levels):
+    r, g, b = np.meshgrid(levels, levels, levels, indexing='ij')
+    triples = np.dstack((r.ravel(), g.ravel(), b.ravel())).astype(np.uint8)
+    return cv2.cvtColor(triples, cv2.COLOR_RGB2GRAY).ravel()
+
+# Cache of gray-packable levels per number of bins
+_levels_cache = {}
+
+# Define a function to find nbins levels whose RGB->gray sums never collide
+# Returns None when no such levels are found (too many bins to pack in a byte)
+def _packing_levels(nbins, trials=2000):
+    if nbins in _levels_cache:
+        return _levels_cache[nbins]
+    found = None
+    if nbins**3 <= 256:
+        # Deterministic search so every run picks the same levels
+        rng = np.random.RandomState(0)
+        for _ in range(trials):
+            levels = np.concatenate(([0], np.sort(rng.choice(np.arange(1, 256), nbins - 1, replace=False))))
+            if len(np.unique(_gray_of_triples(levels))) == nbins**3:
+                found = levels
+                break
+    _levels_cache[nbins] = found
+    return found
+
+# Define a function to provide previously found packing levels (None: there
+# are none) for nbins bins, so classifiers skip the search.  Levels whose
+# gray values collide with this cv2 (e.g. found with another version) are
+# ignored and searched for again
+def seed_packing_levels(nbins, levels):
+    if levels is not None and len(np.unique(_gray_of_triples(levels))) != nbins**3:
+        return
+    _levels_cache.setdefault(nbins, levels)
+
+# Define a function to get a 0/255 binary mask of one class from a label image
+# (the same output format as cv2.inRange)
+def class_mask(label, bit, out=None):
+    out = cv2.bitwise_and(label, bit, dst=out)
+    return cv2.compare(out, 0, cv2.CMP_GT, dst=out)
+
+# Define a function to split a label image into the three masks perception uses
+def split_masks(label):
+    return class_mask(label, ROCK), class_mask(label, OBSTACLE), class_mask(label, NAVIGABLE)
@@ -0,0 +1,37 @@
+# Shared fixtures of the tests: the first frames and poses of the recorded
+# test_dataset run, and a helper that runs perception over them
+# Example: $ python -m pytest -q
+import numpy as np
+import pytest
+
+from benchmark import load_frames, load_poses, load_pose
+from perception import perception_step
+from rover_state import RoverState
+
+# Frames used by the checks
+nframes = 40
+
+@pytest.fixture(scope='session')
+def frames():
+    return load_frames(nframes)
+
+@pytest.fixture(scope='session')
+def poses():
+    return load_poses(nframes)
+
+# run_frames(**settings) runs perception_step() over the frames with a new
+# Rover (RoverState keyword arguments and Rover fields from settings) and
+# returns the Rover and the (nav_dists, nav_angles, vision_image) of every frame
+@pytest.fixture
+def run_frames(frames, poses):
+    def run(**settings):
+        Rover = RoverState(**{name: settings.pop(name) for name in ('lean', 'tiled', 'planning', 'resolution')
+                              if name in settings})
+        for name, value in settings.items():
+            setattr(Rover, name, value)
+        outputs = []
+        for i in range(len(frames)):
+            perception_step(load_pose(Rover, frames, poses, i))
+            outputs.append((np.array(Rover.nav_dists), np.array(Rover.nav_angles), Rover.vision_image.copy()))
+        return Rover, outputs
+    return run
@@ -1,5 +1,32 @@
+import logging
 import numpy as np
 
+from planner import plan_heading
+
+log = logging.getLogger(__name__)
+
+# Define a function to get the steering angle in forward driving
+# The planned heading is followed as far as the navigable terrain in view
+# allows (between its 10th and 90th percentile angle); without a plan the
+# rover steers to the mean angle of the navigable terrain as before
+def steer_angle(Rover, plan_angle):
+    nav_angles = Rover.nav_angles * 180/np.pi
+    if plan_angle is None:
+        return np.clip(np.mean(nav_angles), -15, 15)
+    low, high = np.percentile(nav_angles, (10, 90))
+    return np.clip(np.clip(plan_angle, low, high), -15, 15)
+
+# Define a function to get the rock sample to approach
+# Returns its distance (rover-frame pixels) and angle (degrees): the target
+# of Rover.rock_tracker, which bridges a few frames the rock in view is
+# missed, or without a tracker the mean of the rock pixels in view; None if
+# there is no rock to approach
+def rock_in_view(Rover):
+    if Rover.rock_tracker is not None:
+        return Rover.rock_tracker.target_polar(Rover.pos, Rover.yaw)
+    if Rover.can_see_rock == 1:
+        return np.mean(Rover.rock_dist), np.mean(Rover.rock_angles * 180/np.pi)
+    return None
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
@@ -12,6 +39,11 @@ def decision_step(Rover):
     # Example:
     # Check if we have vision data to make decisions with
     if Rover.nav_angles is not None:
+        # Heading towards the next goal (rock sample or unexplored terrain)
+        # along the planned path, None while there is no plan
+        plan_angle = plan_heading(Rover)
+        # Rock sample to approach (distance, angle), None if there is none
+        rock = rock_in_view(Rover)
         # Check for Rover.mode status
         if Rover.mode == 'forward': 
             #initialize stuck flag
@@ -20,7 +52,7 @@ def decision_step(Rover):
             if len(Rover.nav_angles) >= Rover.stop_forward:  
                 # If mode is forward, navigable terrain looks good 
                 # and velocity is below max, then throttle
-                print('velocity:', Rover.vel, ' is 0? ', Rover.vel == 0)
+                log.debug('velocity: %s is 0? %s', Rover.vel, Rover.vel == 0)
                 if (Rover.steer > 10 or Rover.steer < -10) and Rover.vel == 0:
                     # Rover is stuck
                     Rover.throttle = 0
@@ -29,19 +61,19 @@ def decision_step(Rover):
                     Rover.steer = 0
                     Rover.mode = 'stop'
                     Rover.stuck = 1
-                    print("inside stuck condition ", Rover.stuck)
+                    log.debug('inside stuck condition %s', Rover.stuck)
                 elif Rover.vel < Rover.max_vel:
                     # Set throttle value to throttle setting
                     Rover.throttle = Rover.throttle_set
                 else: # Else coast
                     Rover.throttle = 0
                 Rover.brake = 0
-                if Rover.can_see_rock == 1:
-                    print('distance to rock: ', np.mean(Rover.rock_dist))
-                if(Rover.can_see_rock == 1 and np.mean(Rover.rock_dist) <= 200):
+                if rock is not None:
+                    log.debug('distance to rock: %s', rock[0])
+                if(rock is not None and rock[0] <= 200):
                     Rover.mode = 'go_to_rock'
                 else:   
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                    Rover.steer = steer_angle(Rover, plan_angle)
             # If there's a lack of navigable terrain pixels then go to 'stop' mode
             elif len(Rover.nav_angles) < Rover.stop_forward:
                     # Set mode to "stop" and hit the brakes!
@@ -61,7 +93,7 @@ def decision_step(Rover):
             # If we're not moving (vel < 0.2) then do something else
             elif Rover.vel <= 0.2:
                 # Now we're stopped and we have vision data to see if there's a path forward
-                if Rover.can_see_rock == 1 and Rover.near_sample == 1:
+                if rock is not None and Rover.near_sample == 1:
                     Rover.throttle = 0
                     Rover.brake = Rover.brake_set
                     Rover.steer = 0
@@ -76,28 +108,27 @@ def decision_step(Rover):
                     #     else:
                     #         Rover.steer = 15
                     # else:
-                    Rover.steer = -15 
+                    # Turn towards the planned path, right without a plan
+                    Rover.steer = 15 if plan_angle is not None and plan_angle > 0 else -15
                 # If we're stopped but see sufficient navigable terrain in front then go!
                 if len(Rover.nav_angles) >= Rover.go_forward:
                     # Set throttle back to stored value
                     Rover.throttle = Rover.throttle_set
                     # Release the brake
                     Rover.brake = 0
-                    # Set steer to mean angle
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                    # Set steer towards the plan (mean angle without one)
+                    Rover.steer = steer_angle(Rover, plan_angle)
                     Rover.mode = 'forward'
         elif Rover.mode == 'go_to_rock':
             if Rover.near_sample:
                 Rover.mode = 'stop'
-                print('STOPPING')
-                print(np.mean(Rover.rock_dist))
-            if(Rover.can_see_rock == 1):
-                print('distance: ', np.mean(Rover.rock_dist))
-            if((Rover.can_see_rock == 1) and (np.mean(Rover.rock_dist) <= 200)):
+                log.debug('STOPPING')
+            if(rock is not None):
+                log.debug('distance: %s', rock[0])
+            if((rock is not None) and (rock[0] <= 200)):
                 if Rover.near_sample:
                     Rover.mode = 'stop'
-                    print('STOPPING')
-                    print(np.mean(Rover.rock_dist))
+                    log.debug('STOPPING at %s', rock[0])
                 else:
                     # forward logic, should be moved to a separate function
                     if len(Rover.nav_angles) >= Rover.stop_forward:  
@@ -112,7 +143,7 @@ def decision_step(Rover):
                         # and velocity is below max, then throttle 
                         elif Rover.vel < Rover.max_vel:
                             # Set throttle value to throttle setting
-                            if(np.mean(Rover.rock_dist) <= 60):
+                            if(rock[0] <= 60):
                                 Rover.throttle = 0.15
                             else:
                                 Rover.throttle = Rover.throttle_set
@@ -127,9 +158,8 @@ def decision_step(Rover):
                         Rover.steer = 0
                         Rover.mode = 'stop'
                     #
-                    rock_angle = np.mean(Rover.rock_angles * 180/np.pi)
-                    Rover.steer = np.clip(rock_angle, -15, 15)
-                    print('rock_angle = ', np.mean(Rover.rock_angles * 180/np.pi))
+                    Rover.steer = np.clip(rock[1], -15, 15)
+                    log.debug('rock_angle = %s', rock[1])
             else:
                 Rover.mode = 'forward'
     # Just to make the rover do something 
@@ -1,88 +1,31 @@
 # Do the necessary imports
 import argparse
 import shutil
-import base64
-from datetime import datetime
 import os
-import cv2
-import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
-from PIL import Image
-from flask import Flask
-from io import BytesIO, StringIO
-import json
-import pickle
-import matplotlib.image as mpimg
+import eventlet.tpool
+from flask import Flask, Response
+import logging
 import time
 
 # Import functions for perception and decision making
-from perception import perception_step
-from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from metrics import registry
+from pipeline import FramePipeline
+from recorder import count_dropped
+from sessions import SessionManager, ShardedSessions
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
+log = logging.getLogger('drive_rover')
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'forward' # Current mode (can be forward or stop)
-        self.throttle_set = 0.2 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 60 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_found = 0 # To count the number of samples found
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-
-        self.rock_angles = None
-        self.rock_dist = None
-        self.can_see_rock = 0
-        self.stuck = 0
-# Initialize our rover 
-Rover = RoverState()
+# Every connected simulator gets its own session (Rover, insets, decoder,
+# recorder) keyed by its socket.io sid, and commands are sent back to that
+# client only (see sessions.py and the --shards option).  Built in __main__
+# from the command line options, importing this module builds nothing
+sessions = None
 
 # Variables to track frames per second (FPS)
 # Intitialize frame counter
@@ -91,71 +34,131 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+# Handler metrics, the per-stage timings are recorded by telemetry_step()
+# All of them are served as text on http://localhost:4567/metrics
+frames_total = registry.counter('rover_frames_total', 'Telemetry messages received')
+frames_dropped = registry.counter('rover_frames_dropped_total', 'Telemetry frames that got no commands because handling failed')
+fps_gauge = registry.gauge('rover_fps', 'Telemetry frames handled in the last second')
+sessions_gauge = registry.gauge('rover_sessions', 'Connected simulator sessions')
+emit_seconds = registry.histogram('rover_emit_seconds', 'Sending commands (and pickup) back to the simulator')
+frame_seconds = registry.histogram('rover_frame_seconds', 'End-to-end handling of one telemetry frame')
+
+# With --pipelined, every session's frames are processed on a worker thread
+# and only the newest one is acted on (see pipeline.FramePipeline); otherwise
+# every frame runs in the handler itself
+pipelined = False
+pipelines = {} # sid -> FramePipeline
+# With --image_folder stale frames count as dropped by the run recorder
+recording = False
+
+# Runs session steps: directly, or on an eventlet tpool thread when the
+# step blocks on a shard process (see --shards)
+execute = None
+
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
     global frame_counter, second_counter, fps
+    frame_start = time.perf_counter()
+    frames_total.inc()
     frame_counter+=1
     # Do a rough calculation of frames per second (FPS)
     if (time.time() - second_counter) > 1:
         fps = frame_counter
+        fps_gauge.set(fps)
         frame_counter = 0
         second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    log.info("Current FPS: {}".format(fps))
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        if pipelined:
+            # Processed on the session's pipeline worker, which calls act() with the result
+            session_pipeline(sid).submit(data, frame_start)
+        else:
+            act(sid, run(process, sid, data), frame_start)
+
+    else:
+        sio.emit('manual', data={}, room=sid)
 
-        if np.isfinite(Rover.vel):
+# Define a function to get the frame pipeline of a session, creating it
+# on its first frame
+def session_pipeline(sid):
+    pipeline = pipelines.get(sid)
+    if pipeline is None:
+        pipeline = pipelines[sid] = FramePipeline(lambda data: process(sid, data),
+                                                  lambda result, received: act(sid, result, received),
+                                                  execute=eventlet.tpool.execute, spawn=eventlet.spawn_n,
+                                                  discard=(lambda data: count_dropped()) if recording else None)
+    return pipeline
 
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
+# Define a function to run one telemetry frame through a client's session
+# Initialize / update its Rover with current telemetry, run perception and
+# decision and get the commands and inset images to send
+def process(sid, data):
+    try:
+        return sessions.step(sid, data)
+    except Exception:
+        frames_dropped.inc()
+        raise
 
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+# Define a function to act on a processed frame: send the commands to the
+# client as soon as they are known (recording happens in the session)
+# A frame dropped because its session is gone (result None) gets no reply
+def act(sid, result, frame_start):
+    if result is None:
+        return
+    commands, (out_image_string1, out_image_string2), pickup = result
+    with emit_seconds.time():
+        if commands is not None:
 
             # The action step!  Send commands to the rover!
-            commands = (Rover.throttle, Rover.brake, Rover.steer)
-            send_control(commands, out_image_string1, out_image_string2)
+            send_control(commands, out_image_string1, out_image_string2, sid)
  
             # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
+            if pickup:
+                send_pickup(sid)
         # In case of invalid telemetry, send null commands
         else:
 
             # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+            send_control((0, 0, 0), '', '', sid)
+    frame_seconds.observe(time.perf_counter() - frame_start)
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+# Serve the handler metrics in the Prometheus text format, with the
+# metrics recorded in the shard processes added in (see --shards)
+# Example: $ curl http://localhost:4567/metrics
+@app.route('/metrics')
+def metrics():
+    sessions_gauge.set(len(sessions))
+    return Response(registry.export(run(sessions.snapshots)), mimetype='text/plain; version=0.0.4')
 
-    else:
-        sio.emit('manual', data={}, skip_sid=True)
+# Define a function to run a session call directly or through execute
+def run(fn, *args):
+    return fn(*args) if execute is None else execute(fn, *args)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    run(sessions.open, sid)
+    send_control((0, 0, 0), '', '', sid)
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    # Pending frames are dropped, a frame in flight finds its session closed
+    pipeline = pipelines.pop(sid, None)
+    if pipeline is not None:
+        pipeline.close()
+    run(sessions.close, sid)
 
-def send_control(commands, image_string1, image_string2):
+def send_control(commands, image_string1, image_string2, sid=None):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -164,20 +167,20 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
-    # Send commands via socketIO server
+    # Send commands via socketIO server, to the client they are for
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(sid=None):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -186,10 +189,91 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to image folder. This is where the images (IMG/) and robot_log.csv of the run will be saved.'
+    )
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='WARNING',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Logging level. DEBUG prints the per-frame telemetry, INFO the FPS.'
+    )
+    parser.add_argument(
+        '--inset-quality',
+        type=int,
+        default=75,
+        help='JPEG quality of the map and vision insets.'
+    )
+    parser.add_argument(
+        '--inset-backend',
+        type=str,
+        default='cv2',
+        choices=['cv2', 'pil'],
+        help='JPEG encoder used for the insets.'
+    )
+    parser.add_argument(
+        '--inset-fps',
+        type=float,
+        default=5,
+        help='Maximum refresh rate of the insets (control commands are not limited).'
+    )
+    parser.add_argument(
+        '--lean',
+        action='store_true',
+        help='Run perception in preallocated buffers (memory-lean mode).'
+    )
+    parser.add_argument(
+        '--perception-mode',
+        type=str,
+        default='warp',
+        choices=['warp', 'lookup', 'roi'],
+        help='Perception path: warp the frame, use the projection table, or only the valid footprint (roi).'
+    )
+    parser.add_argument(
+        '--perception-budget',
+        type=float,
+        default=0,
+        help='roi mode: subsample the projected pixels while perception takes longer than this (ms, 0 for never).'
+    )
+    parser.add_argument(
+        '--tiled-map',
+        action='store_true',
+        help='Keep the worldmap in tiles allocated as the rover explores.'
+    )
+    parser.add_argument(
+        '--map-resolution',
+        type=float,
+        default=1.0,
+        help='Worldmap cells per meter.'
+    )
+    parser.add_argument(
+        '--planning',
+        action='store_true',
+        help='Steer along a path plan to the exploration frontier instead of the mean navigable angle.'
+    )
+    parser.add_argument(
+        '--pose-correction',
+        action='store_true',
+        help='Map tilted frames with the pitch/roll-corrected projection instead of skipping them.'
+    )
+    parser.add_argument(
+        '--no-rock-tracking',
+        action='store_true',
+        help='Approach the rock pixels of each frame instead of rocks tracked across frames.'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=0,
+        help='Run the sessions of connected simulators in this many worker processes (0: in the server).'
+    )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Process frames on a worker thread and always act on the newest one, dropping stale frames.'
     )
     args = parser.parse_args()
-    
+    logging.basicConfig(level=args.log_level, format='%(message)s')
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
         print("Creating image folder at {}".format(args.image_folder))
@@ -201,6 +285,31 @@ if __name__ == '__main__':
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
+
+    # Settings every new session is built with (see sessions.make_session)
+    options = {
+        'lean': args.lean,
+        'tiled': args.tiled_map,
+        'resolution': args.map_resolution,
+        'planning': args.planning,
+        'perception_mode': args.perception_mode,
+        'perception_budget': args.perception_budget / 1000.0 if args.perception_budget > 0 else None,
+        'pose_correction': args.pose_correction,
+        'rock_tracking': not args.no_rock_tracking,
+        'inset_quality': args.inset_quality,
+        'inset_backend': args.inset_backend,
+        'inset_interval': 1.0 / args.inset_fps,
+        'image_folder': args.image_folder,
+    }
+    pipelined = args.pipelined
+    recording = args.image_folder != ''
+    if args.shards > 0:
+        # Sessions run in worker processes; the handler waits for them on a
+        # tpool thread so the event loop keeps serving the other clients
+        sessions = ShardedSessions(options, args.shards)
+        execute = eventlet.tpool.execute
+    else:
+        sessions = SessionManager(options)
     
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
@@ -0,0 +1,102 @@
+import numpy as np
+import cv2
+
+from worldmap import FREE, UNKNOWN, cell_occupancy
+
+# Incrementally maintained exploration frontier of the worldmap: the free
+# cells with an unknown 4-neighbour, where driving extends the map.
+# Registered as a WorldMap tracker it reclassifies only the cells an update
+# changed and rechecks the frontier flag of those cells and their neighbours.
+# Frontier cells are grouped into 8-connected clusters on demand (only when
+# the frontier changed since the last query); each cluster is represented by
+# its frontier cell closest to the cluster's centroid, which is the cell to
+# drive to
+class FrontierIndex():
+    def __init__(self, size=200, obstacle_weight=0.25, min_cluster=3):
+        self.size = size
+        self.obstacle_weight = obstacle_weight # See worldmap.cell_occupancy
+        self.min_cluster = min_cluster # Smaller clusters are noise and not offered as targets
+        self.reset()
+
+    def reset(self):
+        self.occupancy = np.full((self.size, self.size), UNKNOWN, dtype=np.uint8)
+        self.frontier = np.zeros((self.size, self.size), dtype=bool)
+        self.count = 0 # Number of frontier cells
+        self.version = 0 # Incremented whenever the frontier changes
+        self._clustered = None # Version the clusters below belong to
+        self.targets = np.zeros((0, 2), dtype=np.intp) # (x, y) target cell per cluster
+        self.sizes = np.zeros(0, dtype=np.intp) # Frontier cells per cluster
+
+    # Fold changed worldmap cells into the frontier (WorldMap tracker interface)
+    def update(self, worldmap, update):
+        cells = np.unique(update.cells // 3)
+        occupancy = cell_occupancy(worldmap.cell_counts(cells), self.obstacle_weight)
+        flat = self.occupancy.reshape(-1)
+        changed = occupancy != flat[cells]
+        if not np.any(changed):
+            return
+        cells = cells[changed]
+        flat[cells] = occupancy[changed]
+        # A cell's frontier flag depends on itself and its 4-neighbours
+        size = self.size
+        ys, xs = np.divmod(cells, size)
+        ys = np.concatenate((ys, ys - 1, ys + 1, ys, ys))
+        xs = np.concatenate((xs, xs, xs, xs - 1, xs + 1))
+        inside = (ys >= 0) & (ys < size) & (xs >= 0) & (xs < size)
+        ys, xs = np.divmod(np.unique(ys[inside] * size + xs[inside]), size)
+        grid = self.occupancy
+        near_unknown = np.zeros(len(ys), dtype=bool)
+        for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            ny, nx = ys + dy, xs + dx
+            inside = (ny >= 0) & (ny < size) & (nx >= 0) & (nx < size)
+            near_unknown[inside] |= grid[ny[inside], nx[inside]] == UNKNOWN
+        frontier = (grid[ys, xs] == FREE) & near_unknown
+        old = self.frontier[ys, xs]
+        if np.any(frontier != old):
+            self.frontier[ys, xs] = frontier
+            self.count += int(np.count_nonzero(frontier)) - int(np.count_nonzero(old))
+            self.version += 1
+
+    # Define a function to group the frontier into clusters (if it changed)
+    def clusters(self):
+        if self._clustered != self.version:
+            self._clustered = self.version
+            n, labels, stats, centroids = cv2.connectedComponentsWithStats(
+                self.frontier.view(np.uint8), connectivity=8)
+            ys, xs = np.nonzero(self.frontier)
+            label = labels[ys, xs]
+            # The cell of each cluster closest to its centroid
+            dist = np.hypot(xs - centroids[label, 0], ys - centroids[label, 1])
+            order = np.lexsort((dist, label))
+            first = order[np.flatnonzero(np.diff(label[order], prepend=-1))]
+            sizes = stats[label[first], cv2.CC_STAT_AREA]
+            keep = sizes >= self.min_cluster
+            self.targets = np.column_stack((xs[first], ys[first]))[keep]
+            self.sizes = sizes[keep]
+        return self.targets, self.sizes
+
+    def _candidates(self, position, min_distance, exclude):
+        targets, sizes = self.clusters()
+        dist = np.hypot(targets[:, 0] - position[0], targets[:, 1] - position[1])
+        ok = dist >= min_distance
+        if exclude:
+            ok &= np.array([(int(x), int(y)) not in exclude for x, y in targets], dtype=bool)
+        return targets[ok], sizes[ok], dist[ok]
+
+    # Define functions to query the frontier from the rover's (x, y) position
+    # Both return the (x, y) target cell of a cluster at least min_distance
+    # away whose target is not in exclude, or None if there is none
+    def nearest(self, position, min_distance=0, exclude=()):
+        targets, sizes, dist = self._candidates(position, min_distance, exclude)
+        if len(targets) == 0:
+            return None
+        i = np.argmin(dist)
+        return int(targets[i, 0]), int(targets[i, 1])
+
+    def largest(self, position, min_distance=0, exclude=()):
+        targets, sizes, dist = self._candidates(position, min_distance, exclude)
+        if len(targets) == 0:
+            return None
+        # Largest cluster, the nearer one among equal sizes
+        i = np.lexsort((dist, -sizes))[0]
+        return int(targets[i, 0]), int(targets[i, 1])
@@ -0,0 +1,101 @@
+import threading
+import time
+import numpy as np
+
+from supporting_functions import compose_map_image, encode_image
+from metrics import registry
+
+# JPEG/base64 encoding of an inset refresh, timed wherever it runs
+encode_seconds = registry.histogram('rover_inset_encode_seconds', 'JPEG encoding of one inset refresh')
+
+# Renderer for the map and vision insets sent along with the control commands.
+# The insets are refreshed at most every `interval` seconds, independently of
+# the control rate; an inset whose source did not change since it was last
+# encoded keeps its previous string.  With threaded=True the JPEG/base64
+# encoding runs on a background thread, so submit() only snapshots the source
+# images and latest() always returns immediately with the newest strings
+class InsetRenderer():
+    def __init__(self, quality=75, backend='cv2', interval=0.2, threaded=True):
+        self.quality = quality # JPEG quality of both insets
+        self.backend = backend # 'cv2' or 'pil', see encode_image()
+        self.interval = interval # Minimum seconds between inset refreshes
+        self.threaded = threaded
+        self.strings = ('', '') # Latest (map, vision) base64 JPEG strings
+        self.last_submit = None # Time of the last accepted refresh
+        self.map_key = None # What the current map string was rendered from
+        self.vision = None # Vision image the current vision string was encoded from
+        self.encoded = 0 # Number of images encoded
+        self.reused = 0 # Number of refreshes where an inset string was reused
+        self._lock = threading.Lock()
+        self._job = None # Pending (map image, vision image) to encode
+        self._busy = False # True while a job is pending or being encoded
+        self._wake = threading.Event()
+        self._thread = None
+
+    # Define a function to refresh the insets from the Rover state if due
+    # Returns True if a refresh was started
+    def submit(self, Rover, now=None):
+        now = time.time() if now is None else now
+        if self.last_submit is not None and now - self.last_submit < self.interval:
+            return False
+        if self._busy:
+            # Encoding the previous refresh is still running, never queue up
+            return False
+        self.last_submit = now
+        # The map display only changes with the worldmap and the text on it
+        map_key = (Rover.worldmap.version, np.round(Rover.total_time, 1), Rover.samples_found)
+        map_img = None
+        if map_key != self.map_key:
+            self.map_key = map_key
+            map_img = compose_map_image(Rover)
+        vision = None
+        if self.vision is None or not np.array_equal(self.vision, Rover.vision_image):
+            vision = Rover.vision_image.astype(np.uint8)
+            self.vision = vision
+        if map_img is None or vision is None:
+            self.reused += 1
+        if map_img is None and vision is None:
+            return False
+        self._busy = True
+        if not self.threaded:
+            self._encode((map_img, vision))
+            return True
+        with self._lock:
+            self._job = (map_img, vision)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inset-renderer')
+            self._thread.daemon = True
+            self._thread.start()
+        self._wake.set()
+        return True
+
+    # Define a function to get the latest (map, vision) inset strings
+    def latest(self):
+        with self._lock:
+            return self.strings
+
+    def _encode(self, job):
+        map_img, vision = job
+        start = time.perf_counter()
+        try:
+            map_string, vision_string = self.strings
+            if map_img is not None:
+                map_string = encode_image(map_img, self.quality, self.backend)
+                self.encoded += 1
+            if vision is not None:
+                vision_string = encode_image(vision, self.quality, self.backend)
+                self.encoded += 1
+            with self._lock:
+                self.strings = (map_string, vision_string)
+            encode_seconds.observe(time.perf_counter() - start)
+        finally:
+            self._busy = False
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                job, self._job = self._job, None
+            if job is not None:
+                self._encode(job)
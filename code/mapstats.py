@@ -0,0 +1,209 @@
+import numpy as np
+
+from worldmap import OBSTACLE_CHANNEL, ROCK_CHANNEL, NAVIGABLE_CHANNEL, meter_grid
+
+# Incremental map statistics.
+# Registered as a WorldMap tracker, it only looks at the cells changed by each
+# update to keep the navigable/obstacle cell counts and count sums (for the
+# display normalization) and the good/bad navigable cells against the ground
+# truth, so perc_mapped and fidelity never need a scan of the whole map.
+# The ground truth has one cell per meter; on a worldmap with another
+# resolution it is resampled to the worldmap's cells on the first update
+class MapStats():
+    def __init__(self, ground_truth, navigable_cells=None):
+        # Ground truth navigable cells (green channel of the 3-channel map)
+        if ground_truth.ndim == 3:
+            ground_truth = ground_truth[:,:,1]
+        self.ground_truth = ground_truth > 0
+        self.truth = self.ground_truth.ravel()
+        # Total number of ground truth map cells, computed once (or given)
+        if navigable_cells is None:
+            navigable_cells = np.count_nonzero(self.truth)
+        self.tot_map_pix = float(navigable_cells)
+        self.cells = (len(ground_truth), 1.0) # (window, resolution) the truth is resampled to
+        self.reset()
+
+    # Define a function to resample the ground truth to a worldmap's cells
+    def fit(self, worldmap):
+        self.cells = (worldmap.window, worldmap.resolution)
+        truth = meter_grid(self.ground_truth, worldmap)
+        if truth is not self.ground_truth:
+            self.truth = truth.ravel()
+            self.tot_map_pix = float(np.count_nonzero(self.truth))
+
+    def reset(self):
+        self.nav_cells = 0 # Cells with any navigable hit
+        self.good_nav_cells = 0 # ... of which are ground truth navigable
+        self.bad_nav_cells = 0 # ... of which are not
+        self.obs_cells = 0 # Cells with any obstacle hit
+        self.nav_sum = 0.0 # Sum of navigable counts over the map
+        self.obs_sum = 0.0 # Sum of obstacle counts over the map
+
+    # Define a function to fold one WorldMap update into the statistics
+    def update(self, worldmap, update):
+        if (worldmap.window, worldmap.resolution) != self.cells:
+            self.fit(worldmap)
+        channel = update.cells % 3
+        cells = update.cells // 3
+        for ch in (NAVIGABLE_CHANNEL, OBSTACLE_CHANNEL):
+            sel = channel == ch
+            old = update.old[sel]
+            new = update.new[sel]
+            # Counts only ever grow, so a cell is new when it goes from zero to nonzero
+            newly = (old == 0) & (new > 0)
+            delta = float(np.sum(new, dtype=np.float64) - np.sum(old, dtype=np.float64))
+            if ch == NAVIGABLE_CHANNEL:
+                good = int(np.count_nonzero(self.truth[cells[sel][newly]]))
+                self.nav_cells += int(np.count_nonzero(newly))
+                self.good_nav_cells += good
+                self.bad_nav_cells = self.nav_cells - self.good_nav_cells
+                self.nav_sum += delta
+            else:
+                self.obs_cells += int(np.count_nonzero(newly))
+                self.obs_sum += delta
+
+    # Display normalization: 255 / mean count over the cells hit at least once
+    def nav_scale(self):
+        return 255 * self.nav_cells / self.nav_sum if self.nav_cells > 0 else 1.0
+
+    def obs_scale(self):
+        return 255 * self.obs_cells / self.obs_sum if self.obs_cells > 0 else 1.0
+
+    # Percentage of the ground truth map that has been successfully found
+    def perc_mapped(self):
+        return round(100*self.good_nav_cells/self.tot_map_pix, 1)
+
+    # Good map pixel detections divided by total pixels found to be navigable
+    def fidelity(self):
+        if self.nav_cells > 0:
+            return round(100*self.good_nav_cells/self.nav_cells, 1)
+        return 0
+
+# Incrementally rendered obstacle/navigable overlay of the worldmap.
+# Only the cells changed since the last render are redrawn, unless a
+# normalization constant has drifted more than rescale_tolerance since the
+# overlay was last normalized; then every cell that was ever hit is redrawn
+# (the others only show the ground truth, whatever the normalization).
+# The overlay has the worldmap's cells (the ground truth is resampled to them)
+class MapOverlay():
+    def __init__(self, stats, ground_truth, rescale_tolerance=0.02):
+        self.stats = stats
+        self.meter_truth = ground_truth # 3-channel ground truth, one cell per meter
+        self.cells = None # (window, resolution) the ground truth below is resampled to
+        self.rescale_tolerance = rescale_tolerance
+        self.reset()
+
+    # Define a function to resample the ground truth to a worldmap's cells
+    def fit(self, worldmap):
+        self.cells = (worldmap.window, worldmap.resolution)
+        ground_truth = meter_grid(self.meter_truth, worldmap)
+        # 3-channel ground truth, one row per cell
+        self.ground_truth_shape = ground_truth.shape
+        self.ground_truth = ground_truth.reshape(-1, 3).astype(np.float64)
+        self.base = None
+
+    def reset(self):
+        self.base = None # plotmap blended with half the ground truth
+        self.hit = None # Cells with any hit, the only ones a new normalization changes
+        self.scales = None # (navigable, obstacle) scales the base was drawn with
+        self.dirty = [] # Cells changed since the last render
+        self.rescales = 0 # Renders that redrew every hit cell with new scales
+
+    # Collect the changed cells (WorldMap tracker interface)
+    def update(self, worldmap, update):
+        self.dirty.append(update.cells // 3)
+
+    # counts holds the (n, 3) counts of cells
+    def _draw(self, counts, cells, scales):
+        navigable = counts[:, 2].astype(np.float64) * scales[0]
+        obstacle = counts[:, 0].astype(np.float64) * scales[1]
+        obstacle[navigable >= obstacle] = 0
+        self.base[cells, 0] = np.clip(obstacle, 0, 255) + 0.5 * self.ground_truth[cells, 0]
+        self.base[cells, 2] = np.clip(navigable, 0, 255) + 0.5 * self.ground_truth[cells, 2]
+
+    # Define a function to get the up-to-date overlay (size x size x 3, float)
+    def render(self, worldmap):
+        if (worldmap.window, worldmap.resolution) != self.cells:
+            self.fit(worldmap)
+        if self.base is None:
+            self.base = 0.5 * self.ground_truth
+            self.hit = np.zeros(len(self.ground_truth), dtype=bool)
+            self.scales = None
+            # Cells hit before the first render
+            self.dirty = [np.flatnonzero(worldmap.dense().reshape(-1, 3).any(axis=1))]
+        cells = np.unique(np.concatenate(self.dirty)) if self.dirty else None
+        self.dirty = []
+        if cells is not None:
+            self.hit[cells] = True
+        scales = (self.stats.nav_scale(), self.stats.obs_scale())
+        if self.scales is None or any(abs(new - old) > self.rescale_tolerance * old
+                                      for new, old in zip(scales, self.scales)):
+            # Redraw with the new normalization; cells never hit only show
+            # the ground truth whatever the scales are
+            self.scales = scales
+            self.rescales += 1
+            cells = np.flatnonzero(self.hit)
+        if cells is not None:
+            self._draw(worldmap.cell_counts(cells), cells, self.scales)
+        return self.base.reshape(self.ground_truth_shape)
+
+# Spatial index of detected rock cells for confirming known sample positions.
+# Rock cells are bucketed on a grid as soon as they first get a hit, and a
+# sample is only checked against the buckets around it, and only again when
+# new rock cells arrived.  Rock counts never go down, so once a sample is
+# confirmed it stays confirmed and is not checked again.  Sample positions
+# and the radius are in meters, the buckets in worldmap cells
+class RockIndex():
+    def __init__(self, radius=3):
+        self.radius = radius # A detection closer than this (in meters) confirms a sample
+        self.resolution = 1.0 # Worldmap cells per meter
+        self.bucket_size = int(np.ceil(radius))
+        self.reset()
+
+    def reset(self):
+        self.buckets = {} # (bucket x, bucket y) -> list of (x, y) rock cells
+        self.samples = None # Sample positions the cache below belongs to
+        self.found = None # Confirmed flag per sample
+        self.stale = True # New rock cells since the last confirmation check
+
+    # Add newly detected rock cells to the buckets (WorldMap tracker interface)
+    def update(self, worldmap, update):
+        if worldmap.resolution != self.resolution:
+            self.resolution = worldmap.resolution
+            self.bucket_size = int(np.ceil(self.radius * self.resolution))
+        rock = (update.cells % 3 == ROCK_CHANNEL) & (update.old == 0) & (update.new > 0)
+        if not np.any(rock):
+            return
+        cells = update.cells[rock] // 3
+        ys, xs = np.divmod(cells, worldmap.window)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            key = (x // self.bucket_size, y // self.bucket_size)
+            self.buckets.setdefault(key, []).append((x, y))
+        self.stale = True
+
+    # Define a function to check whether any rock cell lies near cell (x, y)
+    def near(self, x, y):
+        r = self.radius * self.resolution
+        for bx in range(int(x - r) // self.bucket_size, int(x + r) // self.bucket_size + 1):
+            for by in range(int(y - r) // self.bucket_size, int(y + r) // self.bucket_size + 1):
+                for cx, cy in self.buckets.get((bx, by), ()):
+                    if (cx - x)**2 + (cy - y)**2 < r**2:
+                        return True
+        return False
+
+    # Define a function to get the confirmed flag of every known sample
+    # samples_pos is (x positions, y positions) as in Rover.samples_pos
+    def confirmed(self, samples_pos):
+        if samples_pos is None:
+            return np.zeros(0, dtype=bool)
+        samples = (tuple(samples_pos[0]), tuple(samples_pos[1]))
+        if samples != self.samples:
+            self.samples = samples
+            self.found = np.zeros(len(samples[0]), dtype=bool)
+            self.stale = True
+        if self.stale:
+            for idx in np.flatnonzero(~self.found):
+                self.found[idx] = self.near(samples[0][idx] * self.resolution,
+                                            samples[1][idx] * self.resolution)
+            self.stale = False
+        return self.found
@@ -0,0 +1,194 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets in seconds, from 0.1 ms up to a second
+default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Monotonic counter, e.g. of dropped frames
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def reset(self):
+        self.value = 0
+
+    # Define functions to get the state of the metric and to add another
+    # process's state of it (see Registry.snapshot)
+    def state(self):
+        return self.value
+
+    def merge(self, state):
+        self.value += state
+
+# Value that can go up and down, e.g. the current frame rate
+class Gauge():
+    kind = 'gauge'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def reset(self):
+        self.value = 0
+
+    def state(self):
+        return self.value
+
+    # The values of several processes add up (e.g. their sessions)
+    def merge(self, state):
+        self.value += state
+
+# Histogram of observed values (seconds) over fixed buckets.
+# Observing is a bisect and two additions, cheap enough for every frame
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Define a function to time a block of code into the histogram
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    # Define a function to estimate quantile q (0..1) as the upper bound of
+    # the bucket it falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append(('{}_bucket{{le="{}"}}'.format(self.name, bound), total))
+        samples.append(('{}_bucket{{le="+Inf"}}'.format(self.name), self.count))
+        samples.append(('{}_sum'.format(self.name), self.sum))
+        samples.append(('{}_count'.format(self.name), self.count))
+        return samples
+
+    def state(self):
+        return self.buckets, list(self.counts), self.count, self.sum
+
+    def merge(self, state):
+        buckets, counts, count, total = state
+        if tuple(buckets) != self.buckets:
+            raise ValueError('histogram {} has other buckets'.format(self.name))
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+
+# Metric classes by kind
+metric_kinds = {cls.kind: cls for cls in (Counter, Gauge, Histogram)}
+
+# Collection of named metrics with a text exporter in the Prometheus
+# exposition format.  Getting a metric that exists returns it, so modules can
+# declare the metrics they record at import time
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('metric {} is a {}, not a {}'.format(name, metric.kind, cls.kind))
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=default_buckets):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    # Define a function to clear every metric (e.g. between benchmark runs)
+    def reset(self):
+        with self._lock:
+            for metric in self.metrics.values():
+                metric.reset()
+
+    # Define a function to get the state of every metric, e.g. to send it
+    # from a worker process to the registry that serves the metrics
+    def snapshot(self):
+        with self._lock:
+            return [(metric.kind, metric.name, metric.help, metric.state())
+                    for metric in self.metrics.values()]
+
+    # Define a function to add the metrics of a snapshot to this registry's
+    # (metrics it does not have yet are created)
+    def merge(self, snapshot):
+        for kind, name, help, state in snapshot:
+            kwargs = {'buckets': state[0]} if kind == 'histogram' else {}
+            self._get(metric_kinds[kind], name, help, **kwargs).merge(state)
+
+    # Define a function to render every metric in the text exposition format
+    # snapshots of other registries (e.g. of worker processes) are added in
+    def export(self, snapshots=()):
+        if snapshots:
+            combined = Registry()
+            for snapshot in [self.snapshot()] + list(snapshots):
+                combined.merge(snapshot)
+            return combined.export()
+        lines = []
+        with self._lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if metric.help:
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+# Registry the rover pipeline records into and drive_rover.py serves on /metrics
+registry = Registry()
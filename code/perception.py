@@ -1,36 +1,72 @@
+import time
 import numpy as np
-import cv2
+
+from warp import get_warp_map, clear_warp_cache
+from projection import get_projection_table, clear_projection_cache
+from classify import PixelClassifier, class_mask, split_masks, OBSTACLE, ROCK, NAVIGABLE
+from worldmap import HitScratch, OBSTACLE_CHANNEL
+
+# Camera calibration used by perception_step()
+# Source points are the corners of a 1 m grid square in the camera image
+calib_source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+# Half-size of the 1 m square in the warped image (so 1 m = 2*dst_size pixels)
+calib_dst_size = 5
+# Set a bottom offset to account for the fact that the bottom of the image 
+# is not the position of the rover but a bit in front of it
+calib_bottom_offset = 6
+# Camera height above the ground in rover-frame pixels (10 per meter), used
+# to correct the ground projection of tilted frames (see tilt_correct())
+calib_camera_height = 10
+
+# Frames tilted (pitch or roll) by at most level_tilt degrees are projected
+# as if level.  With Rover.pose_correction frames up to max_tilt are
+# projected with the pitch/roll correction; their hits are weighted by
+# tilt_confidence(), which halves at tilt_scale degrees beyond level_tilt
+level_tilt = 1.5
+max_tilt = 6.0
+tilt_scale = 3.0
+# Corrected ground points farther than this (rover-frame pixels) are dropped;
+# near the horizon a small angle error moves a point a long way
+tilt_max_range = 160
+
+# Fused classifier used by classify_pixels(); see set_thresholds()
+pixel_classifier = PixelClassifier()
+# color_thresh() classifiers, one per threshold so each LUT is only built once
+_color_thresh_classifiers = {}
 
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
 def color_thresh(img, rgb_thresh=(160, 160, 160)):
-    # Create an array of zeros same xy size as img, but single channel
-    color_select = np.zeros_like(img[:,:,0])
-    # Require that each pixel be above all three threshold values in RGB
-    # above_thresh will now contain a boolean array with "True"
-    # where threshold was met
-    above_thresh = (img[:,:,0] > rgb_thresh[0]) \
-                & (img[:,:,1] > rgb_thresh[1]) \
-                & (img[:,:,2] > rgb_thresh[2])
-    # Index the array of zeros with the boolean array and set to 1
-    color_select[above_thresh] = 1
+    rgb_thresh = tuple(rgb_thresh)
+    classifier = _color_thresh_classifiers.get(rgb_thresh)
+    if classifier is None:
+        # Require that each pixel be above all three threshold values in RGB
+        classifier = PixelClassifier({1: ([t + 1 for t in rgb_thresh], (255, 255, 255))})
+        _color_thresh_classifiers[rgb_thresh] = classifier
+    # Label is 1 where the threshold was met and 0 elsewhere
+    color_select = classifier.labels(img)
     # Return the binary image
     return color_select
 
+# Define a function to get the fused label image (OBSTACLE | ROCK | NAVIGABLE bits)
+def classify_labels(img):
+    return pixel_classifier.labels(img)
+
+# Define a function to write the label image into a preallocated buffer
+def classify_labels_into(img, out):
+    return pixel_classifier.labels(img, out=out)
+
 def classify_pixels(img):
-    low_yellow = np.array([100, 100, 0], dtype = "uint8")
-    high_yellow = np.array([255, 255, 80], dtype = "uint8")
-    rocks_pix = cv2.inRange(img, low_yellow, high_yellow)
-    
-    low_black = np.array([0, 0, 0], dtype = "uint8")
-    high_black = np.array([160, 160, 160], dtype = "uint8")
-    obstacles_pix = cv2.inRange(img, low_black, high_black)
-    
-    low_white = np.array([161, 161, 161], dtype = "uint8")
-    high_white = np.array([255, 255, 255], dtype = "uint8")
-    navig_pix = cv2.inRange(img, low_white, high_white)
-    
-    return rocks_pix, obstacles_pix, navig_pix
+    # One labelling pass, then cheap 0/255 views per class
+    return split_masks(classify_labels(img))
+
+# Define a function to change the RGB ranges used by classify_pixels()
+# thresholds maps OBSTACLE/ROCK/NAVIGABLE to ((low r, g, b), (high r, g, b));
+# classes that are left out keep their current range
+def set_thresholds(thresholds):
+    merged = dict(pixel_classifier.thresholds)
+    merged.update(thresholds)
+    pixel_classifier.set_thresholds(merged)
 
 # Define a function to convert to rover-centric coordinates
 def rover_coords(binary_img):
@@ -38,8 +74,8 @@ def rover_coords(binary_img):
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float)
+    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float64)
+    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -68,8 +104,9 @@ def rotate_pix(xpix, ypix, yaw):
 def translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale): 
     # TODO:
     # Apply a scaling and a translation
-    xpix_translated = np.int_(xpos + xpix_rot/scale)
-    ypix_translated = np.int_(ypos + ypix_rot/scale)
+    # (rounded down, so cells left of or below the origin are negative, not 0)
+    xpix_translated = np.floor(xpos + xpix_rot/scale).astype(int)
+    ypix_translated = np.floor(ypos + ypix_rot/scale).astype(int)
     # Return the result  
     return xpix_translated, ypix_translated
 
@@ -81,68 +118,457 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
     # Perform rotation, translation and clipping all at once
+    # (world_size None: an unbounded map, no clipping)
+    if world_size is None:
+        return np.int_(xpix_tran), np.int_(ypix_tran)
     x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
     y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
     # Return the result
     return x_pix_world, y_pix_world
 
+# Define a function to convert a simulator angle (0 to 360 degrees) to -180 to 180
+def signed_angle(angle):
+    return angle - 360 if angle > 180 else angle
+
+# Define a function to get how far a frame is tilted from level (degrees)
+def frame_tilt(pitch, roll):
+    return max(abs(signed_angle(pitch)), abs(signed_angle(roll)))
+
+# Define a function to get the weight of the hits of a frame with this tilt
+def tilt_confidence(tilt):
+    if tilt <= level_tilt:
+        return 1.0
+    return 1.0 / (1.0 + ((tilt - level_tilt) / tilt_scale)**2)
+
+# Define a function to correct rover-centric ground coords for pitch and roll
+# The flat-ground projection assumes a level camera.  Each pixel is turned
+# back into the camera ray to its level ground point, the ray is rotated by
+# the rover's pitch and roll and intersected with the ground again.  Rays
+# that no longer reach the ground (above the horizon) or land farther than
+# max_range away are dropped
+# Returns the corrected x, y and the mask of pixels that were kept
+def tilt_correct(x_pixel, y_pixel, pitch, roll, height=None, max_range=None):
+    height = calib_camera_height if height is None else height
+    max_range = tilt_max_range if max_range is None else max_range
+    pitch_rad = signed_angle(pitch) * np.pi / 180
+    roll_rad = signed_angle(roll) * np.pi / 180
+    # Rotate the ray (x, y, -height) about the y axis by pitch...
+    x_ray = x_pixel * np.cos(pitch_rad) - height * np.sin(pitch_rad)
+    z_ray = -x_pixel * np.sin(pitch_rad) - height * np.cos(pitch_rad)
+    # ...and about the x axis by roll
+    y_ray = y_pixel * np.cos(roll_rad) - z_ray * np.sin(roll_rad)
+    z_ray = y_pixel * np.sin(roll_rad) + z_ray * np.cos(roll_rad)
+    # Distance along the ground is height * horizontal / vertical ray length
+    horizontal = np.sqrt(x_ray**2 + y_ray**2)
+    valid = (z_ray < 0) & (height * horizontal < -z_ray * max_range)
+    t = height / -z_ray[valid]
+    return x_ray[valid] * t, y_ray[valid] * t, valid
+
+# Define a function to get the pix_to_world() arguments for the Rover's worldmap
+# Returns the rover position in cells, the map size (None: unbounded) and
+# the rover-frame pixels per cell (10 pixels per meter)
+def map_frame(Rover):
+    worldmap = Rover.worldmap
+    resolution = getattr(worldmap, 'resolution', 1.0)
+    return Rover.pos[0] * resolution, Rover.pos[1] * resolution, worldmap.size, 10 / resolution
+
+# Define a function to add a tilted frame to the worldmap
+# rover_pix holds the (x, y) rover-centric coords of each class in channel
+# order, dists the matching distances (or None); the coords are corrected
+# with tilt_correct() and, on a floating point worldmap, every hit is
+# weighted by the frame's tilt_confidence()
+def add_tilted(Rover, rover_pix, dists=None):
+    worldmap = Rover.worldmap
+    xpos, ypos, world_size, scale = map_frame(Rover)
+    world_pix = []
+    kept = []
+    for x_rover, y_rover in rover_pix:
+        x_ground, y_ground, valid = tilt_correct(x_rover, y_rover, Rover.pitch, Rover.roll)
+        world_pix.append(pix_to_world(x_ground, y_ground, xpos, ypos, Rover.yaw, world_size, scale))
+        kept.append(valid)
+    if dists is not None:
+        dists = [dist[valid] for dist, valid in zip(dists, kept)]
+    weight = None
+    if np.issubdtype(worldmap.dtype, np.floating):
+        weight = tilt_confidence(frame_tilt(Rover.pitch, Rover.roll))
+    return worldmap.add(world_pix, dists, weight)
+
 # Define a function to perform a perspective transform
+# The homography and remap maps are computed once per (shape, src, dst)
+# and reused from the warp cache on every following frame
 def perspect_transform(img, src, dst):
-           
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
-    
+    warped = get_warp_map(img.shape, src, dst).warp(img) # keep same size as input image
     return warped
 
+# Define a function to get the source and destination points for an image shape
+def perspective_points(img_shape, src=None, dst_size=None, bottom_offset=None):
+    src = calib_source if src is None else np.float32(src)
+    dst_size = calib_dst_size if dst_size is None else dst_size
+    bottom_offset = calib_bottom_offset if bottom_offset is None else bottom_offset
+    rows, cols = img_shape[0], img_shape[1]
+    dst = np.float32([[cols/2 - dst_size, rows - bottom_offset],
+                      [cols/2 + dst_size, rows - bottom_offset],
+                      [cols/2 + dst_size, rows - 2*dst_size - bottom_offset], 
+                      [cols/2 - dst_size, rows - 2*dst_size - bottom_offset],
+                      ])
+    return src, dst
+
+# Define a function to re-calibrate the camera at run time
+# Cached warp maps and projection tables for the old geometry are dropped
+# and rebuilt lazily
+def set_calibration(src=None, dst_size=None, bottom_offset=None):
+    global calib_source, calib_dst_size, calib_bottom_offset
+    if src is not None:
+        calib_source = np.float32(src)
+    if dst_size is not None:
+        calib_dst_size = dst_size
+    if bottom_offset is not None:
+        calib_bottom_offset = bottom_offset
+    clear_warp_cache()
+    clear_projection_cache()
+
+
+# Preallocated buffers for perception_step() in memory-lean mode.
+# Everything a frame needs is sized for the worst case (every pixel of the
+# warped image, or every projection table entry, in one class) when the
+# first frame of a geometry arrives.  The rover-frame coordinates, distances
+# and angles of the pixels never change, so they are computed once and each
+# frame only computes the world cells of all pixels in place and writes them into the flat worldmap update once per class (weight 0 in the
+# classes they are not in), which is accumulated with a HitScratch.  What
+# still allocates per frame is the index of the navigable and rock pixels
+# (8 bytes each) and the trackers' work on the update.  The outputs set on
+# the Rover (nav_dists, nav_angles, rock_dist, rock_angles) are views into
+# the buffers and are overwritten by the next frame
+class PerceptionScratch():
+    def __init__(self):
+        self.key = None # Geometry and mode the buffers were sized for
+        self.map_hits = HitScratch() # Worldmap accumulation buffers
+
+    # Define a function to (re)size the buffers for a geometry if needed
+    def prepare(self, img_shape, source, destination, mode):
+        key = (tuple(img_shape), mode, source.tobytes(), destination.tobytes())
+        if key == self.key:
+            return
+        self.key = key
+        rows, cols = img_shape[:2]
+        self.label_img = np.empty((rows, cols), dtype=np.uint8) # Warped labels (vision image)
+        self.mask = np.empty((rows, cols), dtype=np.uint8)
+        self.warp_map = get_warp_map(img_shape, source, destination)
+        self.warped = np.empty((rows, cols, 3), dtype=np.uint8)
+        if mode == 'lookup':
+            self.table = get_projection_table(img_shape, source, destination)
+            x, y = self.table.x, self.table.y
+            dist, angles = self.table.dist, self.table.angles
+            self.labels = np.empty(len(x), dtype=np.uint8) # Label per table entry
+            border_x, border_y = self.table.border_x, self.table.border_y
+        else:
+            # Rover-centric coords of every warped pixel, as rover_coords() computes them
+            ypos, xpos = np.indices((rows, cols)).reshape(2, -1)
+            x = np.absolute(ypos - rows).astype(np.float64)
+            y = -(xpos - rows).astype(np.float64)
+            dist, angles = to_polar_coords(x, y)
+            self.labels = self.label_img.reshape(-1) # Label per warped pixel (a view)
+            border_x, border_y = np.zeros(0), np.zeros(0)
+        self.x, self.y, self.dist, self.angles = x, y, dist, angles
+        self.border_x, self.border_y = border_x, border_y
+        self.border_dist = np.sqrt(border_x**2 + border_y**2)
+        n, nb = len(x), len(border_x)
+        self.bits = np.empty(n, dtype=np.uint8)
+        self.sel = np.empty(n, dtype=bool)
+        self.fa = np.empty(n, dtype=np.float64)
+        self.fb = np.empty(n, dtype=np.float64)
+        self.cx = np.empty(n, dtype=np.intp)
+        self.cells = np.empty(n, dtype=np.intp) # Flat worldmap index of every pixel
+        self.border_cells = np.empty(nb, dtype=np.intp)
+        self.flat = np.empty(3 * n + nb, dtype=np.intp) # One frame's worldmap update
+        self.weights = np.empty(3 * n + nb, dtype=np.float64)
+        self.pixel_weights = np.empty(n, dtype=np.float64)
+        self.nav_dist = np.empty(n, dtype=np.float64)
+        self.nav_angles = np.empty(n, dtype=np.float64)
+        self.rock_dist = np.empty(n, dtype=np.float64)
+        self.rock_angles = np.empty(n, dtype=np.float64)
+
+    # Define a function to compute flat worldmap indices (channel 0) of rover-frame
+    # pixels in place, see world_cells_into()
+    def world_cells(self, x, y, xpos, ypos, yaw, world_size, scale, out):
+        n = len(x)
+        return world_cells_into(x, y, xpos, ypos, yaw, world_size, scale, out,
+                                self.fa[:n], self.fb[:n], self.cx[:n])
+
+# Define a function to compute flat worldmap indices (channel 0) of rover-frame
+# pixels into out, with the same arithmetic, in the same order, as
+# pix_to_world() but no temporaries (truncating instead of rounding down only
+# differs below 0, which clips to 0 anyway): fa, fb (float64) and cx (intp)
+# are work buffers shaped like out.  xpos, ypos and yaw may be (n, 1) columns to map
+# the pixels for n poses at once into (n, pixels) buffers
+def world_cells_into(x, y, xpos, ypos, yaw, world_size, scale, out, fa, fb, cx):
+    yaw_rad = yaw * np.pi / 180
+    cos_yaw, sin_yaw = np.cos(yaw_rad), np.sin(yaw_rad)
+    np.multiply(x, cos_yaw, out=fa)
+    np.multiply(y, sin_yaw, out=fb)
+    np.subtract(fa, fb, out=fa)
+    np.divide(fa, scale, out=fa)
+    np.add(fa, xpos, out=fa)
+    np.copyto(cx, fa, casting='unsafe')
+    np.clip(cx, 0, world_size - 1, out=cx)
+    np.multiply(x, sin_yaw, out=fa)
+    np.multiply(y, cos_yaw, out=fb)
+    np.add(fa, fb, out=fa)
+    np.divide(fa, scale, out=fa)
+    np.add(fa, ypos, out=fa)
+    np.copyto(out, fa, casting='unsafe')
+    np.clip(out, 0, world_size - 1, out=out)
+    np.multiply(out, world_size, out=out)
+    np.add(out, cx, out=out)
+    np.multiply(out, 3, out=out)
+    return out
+
+# Define a function to run steps 2) to 8) of perception_step() on the
+# scratch buffers; gives the same worldmap and outputs as the default path
+def _perception_lean(Rover, scratch, source, destination):
+    xpos, ypos, world_size, scale = map_frame(Rover)
+    mode = getattr(Rover, 'perception_mode', 'warp')
+    scratch.prepare(Rover.img.shape, source, destination, mode)
+    scratch.warp_map.warp(Rover.img, dst=scratch.warped)
+    classify_labels_into(scratch.warped, scratch.label_img)
+    if mode == 'lookup':
+        np.take(scratch.label_img.reshape(-1), scratch.table.warped_index, out=scratch.labels, mode='clip')
+    # Vision image, one class mask per channel
+    for channel, bit in ((0, OBSTACLE), (1, ROCK), (2, NAVIGABLE)):
+        Rover.vision_image[:,:,channel] = class_mask(scratch.label_img, bit, out=scratch.mask)
+    # World cells of every pixel, then the update of each class in channel order
+    worldmap = Rover.worldmap
+    falloff = worldmap.distance_falloff
+    scratch.world_cells(scratch.x, scratch.y, xpos, ypos, Rover.yaw,
+                        world_size, scale, scratch.cells)
+    # Hit weight of every pixel (1 without distance weighting)
+    if falloff is not None:
+        np.add(scratch.dist, falloff, out=scratch.pixel_weights)
+        np.divide(falloff, scratch.pixel_weights, out=scratch.pixel_weights)
+    else:
+        scratch.pixel_weights.fill(1)
+    # Every pixel goes into the update once per class, with weight 0 in the
+    # classes it is not in (compressing them out would allocate an index array)
+    n, count = len(scratch.cells), 0
+    for channel, bit in ((0, OBSTACLE), (1, ROCK), (2, NAVIGABLE)):
+        np.bitwise_and(scratch.labels, bit, out=scratch.bits)
+        np.not_equal(scratch.bits, 0, out=scratch.sel)
+        np.add(scratch.cells, channel, out=scratch.flat[count:count + n])
+        weights = scratch.weights[count:count + n]
+        weights.fill(0)
+        np.copyto(weights, scratch.pixel_weights, where=scratch.sel)
+        count += n
+        if bit == OBSTACLE and len(scratch.border_x):
+            # The warp border counts as obstacle
+            nb = len(scratch.border_x)
+            scratch.world_cells(scratch.border_x, scratch.border_y, xpos, ypos,
+                                Rover.yaw, world_size, scale, scratch.flat[count:count + nb])
+            if falloff is not None:
+                np.add(scratch.border_dist, falloff, out=scratch.weights[count:count + nb])
+                np.divide(falloff, scratch.weights[count:count + nb], out=scratch.weights[count:count + nb])
+            else:
+                scratch.weights[count:count + nb] = 1
+            count += nb
+        elif bit == ROCK:
+            # The only per-frame allocation: the index of the pixels of the
+            # output classes (np.compress would build it twice)
+            index = np.flatnonzero(scratch.sel)
+            rocks = len(index)
+            np.take(scratch.dist, index, out=scratch.rock_dist[:rocks], mode='clip')
+            np.take(scratch.angles, index, out=scratch.rock_angles[:rocks], mode='clip')
+        elif bit == NAVIGABLE:
+            index = np.flatnonzero(scratch.sel)
+            navigable = len(index)
+            np.take(scratch.dist, index, out=scratch.nav_dist[:navigable], mode='clip')
+            np.take(scratch.angles, index, out=scratch.nav_angles[:navigable], mode='clip')
+    worldmap.add_flat(scratch.flat[:count], scratch.weights[:count], scratch.map_hits)
+    # Rock and navigable outputs, as views into the scratch buffers
+    if rocks > 0:
+        Rover.can_see_rock = 1
+        Rover.rock_dist, Rover.rock_angles = scratch.rock_dist[:rocks], scratch.rock_angles[:rocks]
+    else:
+        Rover.can_see_rock = 0
+        Rover.rock_angles = None
+        Rover.rock_dist = None
+    Rover.nav_dists = scratch.nav_dist[:navigable]
+    Rover.nav_angles = scratch.nav_angles[:navigable]
+
+
+# Subsampling controller for the 'roi' perception mode.
+# After every frame the time perception took is compared with the budget
+# (seconds): over it the stride doubles (only every 2nd, 4th, ... pixel is
+# projected into the worldmap), below half of it the stride halves again,
+# so under load the control loop stays on time at the cost of map density.
+# With budget None the stride stays where it is set
+class AdaptiveResolution():
+    def __init__(self, budget=0.003, max_stride=8, stride=1):
+        self.budget = budget
+        self.max_stride = max_stride
+        self.stride = stride # Project every stride-th pixel
+
+    # Define a function to adapt the stride to the last frame's time
+    def update(self, seconds):
+        if self.budget is None:
+            pass
+        elif seconds > self.budget and self.stride < self.max_stride:
+            self.stride *= 2
+        elif seconds < self.budget / 2 and self.stride > 1:
+            self.stride //= 2
+        return self.stride
+
+# Define a function to run perception on the valid warped footprint only
+# Only the projection table entries (warped pixels the camera image reaches)
+# are projected, the black border the warp adds is not treated as obstacle,
+# and with Rover.adaptive_resolution only every stride-th table entry is
+# projected into the worldmap (its hits weighted by the stride on a
+# floating point map).  Navigable and rock angles/distances for decisions
+# always use every entry
+def _perception_roi(Rover, source, destination):
+    table = get_projection_table(Rover.img.shape, source, destination)
+    control = getattr(Rover, 'adaptive_resolution', None)
+    stride = 1 if control is None else control.stride
+    # Classify the warped image and gather the labels of the entries
+    entries = table.gather(classify_labels(perspect_transform(Rover.img, source, destination)))
+    # Vision image: the top-down labels, nothing outside the footprint
+    label_img = np.zeros(table.shape, dtype=np.uint8)
+    label_img[table.warped_rows, table.warped_cols] = entries
+    rocks, obstacles, navig = split_masks(label_img)
+    Rover.vision_image[:,:,0] = obstacles
+    Rover.vision_image[:,:,1] = rocks
+    Rover.vision_image[:,:,2] = navig
+    # World cells of (a subsample of) the entries of each class
+    worldmap = Rover.worldmap
+    xpos, ypos, world_size, scale = map_frame(Rover)
+    index, x, y, dist = table.subsample(stride)
+    sampled = entries[index]
+    rover_pix = []
+    dists = []
+    for bit in (OBSTACLE, ROCK, NAVIGABLE):
+        sel = (sampled & bit) != 0
+        rover_pix.append((x[sel], y[sel]))
+        dists.append(dist[sel])
+    if worldmap.distance_falloff is None:
+        dists = None
+    if frame_tilt(Rover.pitch, Rover.roll) > level_tilt:
+        add_tilted(Rover, rover_pix, dists)
+    else:
+        world_pix = [pix_to_world(x_rover, y_rover, xpos, ypos, Rover.yaw, world_size, scale)
+                     for x_rover, y_rover in rover_pix]
+        weight = None
+        if stride > 1 and np.issubdtype(worldmap.dtype, np.floating):
+            weight = stride
+        worldmap.add(world_pix, dists, weight)
+    # Rock and navigable outputs from every entry
+    rock = (entries & ROCK) != 0
+    if np.any(rock):
+        Rover.can_see_rock = 1
+        Rover.rock_dist, Rover.rock_angles = table.dist[rock], table.angles[rock]
+    else:
+        Rover.can_see_rock = 0
+        Rover.rock_angles = None
+        Rover.rock_dist = None
+    navigable = (entries & NAVIGABLE) != 0
+    Rover.nav_dists = table.dist[navigable]
+    Rover.nav_angles = table.angles[navigable]
+
 
 # Apply the above functions in succession and update the Rover state accordingly
+# Frames tilted beyond level_tilt are skipped, or with Rover.pose_correction
+# projected with the pitch/roll correction up to max_tilt.  The rock mask of
+# every frame that was perceived goes to Rover.rock_tracker (see rocks.py)
 def perception_step(Rover):
-    if (Rover.roll <= 1.5 or Rover.roll >= 358.5) and (Rover.pitch <= 1.5 or Rover.pitch >= 358.5):
+    if _perceive_frame(Rover) and getattr(Rover, 'rock_tracker', None) is not None:
+        Rover.rock_tracker.update(Rover)
+    return Rover
+
+# Define a function to run perception on the current frame
+# Returns True if the frame was perceived, False if it was skipped
+def _perceive_frame(Rover):
+    tilt = frame_tilt(Rover.pitch, Rover.roll)
+    level = tilt <= level_tilt
+    if level or (getattr(Rover, 'pose_correction', False) and tilt <= max_tilt):
         # Perform perception steps to update Rover()
         # TODO: 
         # NOTE: camera image is coming to you in Rover.img
         # 1) Define source and destination points for perspective transform
-        dst_size = 5 
-        # Set a bottom offset to account for the fact that the bottom of the image 
-        # is not the position of the rover but a bit in front of it
-        # this is just a rough guess, feel free to change it!
-        bottom_offset = 6
-        source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-        destination = np.float32([[Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - bottom_offset],
-                          [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - bottom_offset],
-                          [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset], 
-                          [Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset],
-                          ])
-        # 2) Apply perspective transform
-        warped = perspect_transform(Rover.img, source, destination)
-        # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-        rocks, obstacles, navig = classify_pixels(warped)
-        # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-        Rover.vision_image[:,:,0] = obstacles
-        Rover.vision_image[:,:,1] = rocks
-        Rover.vision_image[:,:,2] = navig
-
-        # 5) Convert map image pixel values to rover-centric coords
-        rock_x_rover, rock_y_rover = rover_coords(rocks)
-        obstacle_x_rover, obstacle_y_rover = rover_coords(obstacles)
-        navig_x_rover, navig_y_rover = rover_coords(navig)
+        # (see calib_* above and set_calibration() to change them)
+        source, destination = perspective_points(Rover.img.shape)
+        if getattr(Rover, 'perception_mode', 'warp') == 'roi':
+            # Valid footprint only, subsampled under load
+            start = time.perf_counter()
+            _perception_roi(Rover, source, destination)
+            control = getattr(Rover, 'adaptive_resolution', None)
+            if control is not None:
+                control.update(time.perf_counter() - start)
+            return True
+        scratch = getattr(Rover, 'scratch', None)
+        if scratch is not None and level and Rover.worldmap.size is not None:
+            # Memory-lean mode: the same steps on preallocated buffers
+            # (tilted frames and unbounded maps take the default path below)
+            _perception_lean(Rover, scratch, source, destination)
+            return True
+        if getattr(Rover, 'perception_mode', 'warp') == 'lookup':
+            # 2) Apply perspective transform, with the precomputed warped
+            # pixel -> rover-frame table for step 5)
+            table = get_projection_table(Rover.img.shape, source, destination)
+            warped = perspect_transform(Rover.img, source, destination)
+            # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
+            labels = classify_labels(warped)
+            # 4) Update Rover.vision_image (this will be displayed on left side of screen)
+            rocks, obstacles, navig = split_masks(labels)
+            Rover.vision_image[:,:,0] = obstacles
+            Rover.vision_image[:,:,1] = rocks
+            Rover.vision_image[:,:,2] = navig
+            # 5) Look up rover-centric coords (and polar coords) of the classified pixels
+            table_labels = table.gather(labels)
+            rock_x_rover, rock_y_rover, rock_dist, rock_angles = table.select(table_labels & ROCK)
+            obstacle_x_rover, obstacle_y_rover, obstacle_dist, _ = table.select(table_labels & OBSTACLE, include_border=True)
+            navig_x_rover, navig_y_rover, dist, angles = table.select(table_labels & NAVIGABLE)
+        else:
+            # 2) Apply perspective transform
+            warped = perspect_transform(Rover.img, source, destination)
+            # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
+            rocks, obstacles, navig = classify_pixels(warped)
+            # 4) Update Rover.vision_image (this will be displayed on left side of screen)
+            Rover.vision_image[:,:,0] = obstacles
+            Rover.vision_image[:,:,1] = rocks
+            Rover.vision_image[:,:,2] = navig
+
+            # 5) Convert map image pixel values to rover-centric coords
+            rock_x_rover, rock_y_rover = rover_coords(rocks)
+            obstacle_x_rover, obstacle_y_rover = rover_coords(obstacles)
+            navig_x_rover, navig_y_rover = rover_coords(navig)
+            # Convert rover-centric pixel positions to polar coordinates
+            dist, angles = to_polar_coords(navig_x_rover, navig_y_rover)
+            rock_dist, rock_angles = to_polar_coords(rock_x_rover, rock_y_rover)
+            obstacle_dist = None
         # 6) Convert rover-centric pixel values to world coordinates
-        world_size = 200
-        scale = 10
-        rock_x_world, rock_y_world = pix_to_world(rock_x_rover, rock_y_rover, Rover.pos[0], Rover.pos[1], Rover.yaw, world_size, scale)
-        obstacle_x_world, obstacle_y_world = pix_to_world(obstacle_x_rover, obstacle_y_rover, Rover.pos[0], Rover.pos[1], Rover.yaw, world_size, scale)
-        navig_x_world, navig_y_world = pix_to_world(navig_x_rover, navig_y_rover, Rover.pos[0], Rover.pos[1], Rover.yaw, world_size, scale)
-        # 7) Update Rover worldmap (to be displayed on right side of screen)
-        Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-        Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-        Rover.worldmap[navig_y_world, navig_x_world, 2] += 1
-        # 8) Convert rover-centric pixel positions to polar coordinates
-        dist, angles = to_polar_coords(navig_x_rover, navig_y_rover)
-
-        # update rock angles and dist if it is currently seen by the robot
+        # (in the worldmap's cells, see map_frame())
+        xpos, ypos, world_size, scale = map_frame(Rover)
+        dists = None
+        if Rover.worldmap.distance_falloff is not None:
+            if obstacle_dist is None:
+                obstacle_dist = np.sqrt(obstacle_x_rover**2 + obstacle_y_rover**2)
+            dists = (obstacle_dist, rock_dist, dist)
+        if not level:
+            # 6-7) Tilted frame: corrected projection, hits weighted by confidence
+            add_tilted(Rover, ((obstacle_x_rover, obstacle_y_rover),
+                               (rock_x_rover, rock_y_rover),
+                               (navig_x_rover, navig_y_rover)), dists)
+        else:
+            rock_x_world, rock_y_world = pix_to_world(rock_x_rover, rock_y_rover, xpos, ypos, Rover.yaw, world_size, scale)
+            obstacle_x_world, obstacle_y_world = pix_to_world(obstacle_x_rover, obstacle_y_rover, xpos, ypos, Rover.yaw, world_size, scale)
+            navig_x_world, navig_y_world = pix_to_world(navig_x_rover, navig_y_rover, xpos, ypos, Rover.yaw, world_size, scale)
+            # 7) Update Rover worldmap (to be displayed on right side of screen)
+            # All three classes go in as one batched update (channels 0, 1, 2)
+            Rover.worldmap.add(((obstacle_x_world, obstacle_y_world),
+                                (rock_x_world, rock_y_world),
+                                (navig_x_world, navig_y_world)), dists)
+
+        # 8) update rock angles and dist if it is currently seen by the robot
         if(len(rock_x_rover) > 0):
             Rover.can_see_rock = 1
-            Rover.rock_dist, Rover.rock_angles = to_polar_coords(rock_x_rover, rock_y_rover)
+            Rover.rock_dist, Rover.rock_angles = rock_dist, rock_angles
         else:
             Rover.can_see_rock = 0
             Rover.rock_angles = None
@@ -150,5 +576,84 @@ def perception_step(Rover):
         # Update Rover pixel distances and angles
         Rover.nav_dists = dist
         Rover.nav_angles = angles
-    
-    return Rover
\ No newline at end of file
+        return True
+    return False
+
+
+# Define a function to run perception over a stack of frames at once
+# frames is an (N, rows, cols, 3) array; poses holds matching arrays 'pos' (N, 2),
+# 'yaw', 'pitch' and 'roll' (N,).  Like perception_step() frames tilted
+# beyond level_tilt are skipped.  For `batch_size` frames at a time, the world
+# cell of every warped pixel (or projection table entry) is computed for every
+# frame with one broadcast world_cells_into() on buffers reused by every
+# batch, the classified pixels are selected from it with the label image and
+# everything is accumulated into the worldmap in one update, which gives the same worldmap as calling
+# perception_step() frame by frame
+def perception_batch(frames, poses, worldmap, perception_mode='warp', batch_size=16):
+    frames = np.asarray(frames)
+    pos = np.asarray(poses['pos'], dtype=np.float64).reshape(-1, 2)
+    yaw = np.asarray(poses['yaw'], dtype=np.float64)
+    level = np.array([frame_tilt(pitch, roll) <= level_tilt
+                      for pitch, roll in zip(poses['pitch'], poses['roll'])], dtype=bool)
+    rows, cols = frames.shape[1:3]
+    source, destination = perspective_points(frames.shape[1:])
+    if worldmap.size is None:
+        raise ValueError('perception_batch needs a bounded WorldMap')
+    world_size = worldmap.size
+    resolution = getattr(worldmap, 'resolution', 1.0)
+    pos = pos * resolution
+    scale = 10 / resolution
+    warp_map = get_warp_map(frames.shape[1:], source, destination)
+    if perception_mode == 'lookup':
+        table = get_projection_table(frames.shape[1:], source, destination)
+        x_rover, y_rover = table.x, table.y
+        border_x, border_y = table.border_x, table.border_y
+    else:
+        # Rover-centric coords of every warped pixel, as rover_coords() computes them
+        ypos, xpos = np.indices((rows, cols)).reshape(2, -1)
+        x_rover = np.absolute(ypos - rows).astype(np.float64)
+        y_rover = -(xpos - rows).astype(np.float64)
+        border_x, border_y = np.zeros(0), np.zeros(0)
+    # Hit weight of every pixel, then of every border entry, of one frame
+    falloff = worldmap.distance_falloff
+    if falloff is not None:
+        pix_weights = worldmap.weights(np.sqrt(x_rover**2 + y_rover**2))
+        border_weights = worldmap.weights(np.sqrt(border_x**2 + border_y**2))
+    # Buffers for the largest batch, reused by every batch
+    npix, nb = len(x_rover), len(border_x)
+    size = min(batch_size, max(len(frames), 1))
+    warped = np.empty((size, rows, cols, 3), dtype=np.uint8)
+    fa = np.empty((size, npix + nb), dtype=np.float64)
+    fb = np.empty_like(fa)
+    cx = np.empty((size, npix + nb), dtype=np.intp)
+    cells = np.empty((size, npix + nb), dtype=np.intp)
+    hit_scratch = HitScratch()
+    level_frames = np.flatnonzero(level)
+    for start in range(0, len(level_frames), batch_size):
+        batch = level_frames[start:start + batch_size]
+        n = len(batch)
+        for k in range(n):
+            warp_map.warp(frames[batch[k]], dst=warped[k])
+        labels = classify_labels(warped[:n].reshape(-1, cols, 3)).reshape(n, -1)
+        if perception_mode == 'lookup':
+            # Gather the table entries of every frame
+            labels = labels[:, table.warped_index]
+        # World cell of every pixel (then border entry) in every frame (n, pixels)
+        xs, ys, yaws = pos[batch, 0][:, None], pos[batch, 1][:, None], yaw[batch][:, None]
+        world_cells_into(x_rover, y_rover, xs, ys, yaws, world_size, scale, cells[:n, :npix], fa[:n, :npix], fb[:n, :npix], cx[:n, :npix])
+        flat = []
+        weights = []
+        for channel, bit in enumerate((OBSTACLE, ROCK, NAVIGABLE)):
+            sel = (labels & bit) != 0
+            flat.append(cells[:n, :npix][sel] + channel)
+            if falloff is not None:
+                weights.append(np.broadcast_to(pix_weights, sel.shape)[sel])
+        if nb:
+            # The warp border counts as obstacle in every frame
+            border = cells[:n, npix:]
+            world_cells_into(border_x, border_y, xs, ys, yaws, world_size, scale, border, fa[:n, npix:], fb[:n, npix:], cx[:n, npix:])
+            flat.append((border + OBSTACLE_CHANNEL).ravel())
+            if falloff is not None:
+                weights.append(np.tile(border_weights, n))
+        worldmap.add_flat(np.concatenate(flat), np.concatenate(weights) if weights else None, hit_scratch)
+    return worldmap
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+stale_frames = registry.counter('rover_frames_stale_total',
+                                'Telemetry frames replaced by a newer one before they were processed')
+wait_seconds = registry.histogram('rover_pipeline_wait_seconds',
+                                  'Time a telemetry frame waited for the pipeline worker')
+
+# Define a function to run fn in a new daemon thread (default spawn)
+def spawn_thread(fn):
+    thread = threading.Thread(target=fn, name='frame-pipeline')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+# Newest-frame pipeline for the telemetry handler.
+# submit() only drops the frame into a one-frame slot and returns, so the
+# server keeps receiving while a frame is processed.  A single worker takes
+# whatever frame is newest when it becomes free, runs process(data) through
+# execute (e.g. eventlet.tpool.execute, so the CPU-bound work runs on an OS
+# thread and the event loop keeps going) and hands the result straight to
+# deliver(result, received).  A frame that is replaced in the slot before the
+# worker got to it is stale and dropped: under load commands are sent for the
+# newest frames as soon as they are ready instead of piling up behind old ones.
+# close() drops the pending frame and everything submitted after it; a frame
+# the worker is processing at that moment is finished but not delivered.
+# discard(data), if given, is called with every frame dropped either way
+class FramePipeline():
+    def __init__(self, process, deliver, execute=None, spawn=spawn_thread, discard=None):
+        self.process = process # process(data) -> result, the expensive part
+        self.deliver = deliver # deliver(result, received), e.g. send the commands
+        self.execute = execute # execute(fn, *args) runs fn elsewhere, None to call it directly
+        self.spawn = spawn # spawn(fn) starts the worker loop
+        self.discard = discard # discard(data) for dropped frames, e.g. count them
+        self.pending = None # Newest (data, received) not yet processed
+        self.running = False # True while the worker loop is active
+        self.closed = False # True once close() was called
+        self.submitted = 0 # Frames submitted
+        self.processed = 0 # Frames processed and delivered
+        self.dropped = 0 # Frames dropped as stale
+        self._lock = threading.Lock()
+
+    # Define a function to hand a telemetry frame to the pipeline
+    def submit(self, data, received=None):
+        received = time.perf_counter() if received is None else received
+        with self._lock:
+            if self.closed:
+                return
+            self.submitted += 1
+            stale = self.pending
+            if stale is not None:
+                self.dropped += 1
+                stale_frames.inc()
+            self.pending = (data, received)
+            start = not self.running
+            self.running = True
+        if stale is not None and self.discard is not None:
+            self.discard(stale[0])
+        if start:
+            self.spawn(self._run)
+
+    # Define a function to stop the pipeline, e.g. when its client disconnects
+    def close(self):
+        with self._lock:
+            self.closed = True
+            stale, self.pending = self.pending, None
+            if stale is not None:
+                self.dropped += 1
+                stale_frames.inc()
+        if stale is not None and self.discard is not None:
+            self.discard(stale[0])
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job, self.pending = self.pending, None
+                if job is None:
+                    self.running = False
+                    return
+            data, received = job
+            wait_seconds.observe(time.perf_counter() - received)
+            try:
+                if self.execute is None:
+                    result = self.process(data)
+                else:
+                    result = self.execute(self.process, data)
+                if not self.closed:
+                    self.deliver(result, received)
+            except Exception:
+                log.exception('telemetry frame failed in the pipeline')
+            self.processed += 1
@@ -0,0 +1,287 @@
+import heapq
+import math
+import numpy as np
+
+from worldmap import UNKNOWN, cell_occupancy
+
+inf = float('inf')
+# Keys are sums of float step costs, so two keys that tie can differ in the
+# last bits depending on the order they were summed in; the search only stops
+# on keys that are above the start's by more than this
+key_tolerance = 1e-9
+
+# Incremental path planner on the worldmap (D* Lite).
+# Registered as a WorldMap tracker it keeps an occupancy grid of the map,
+# and only the cells whose class changed in an update have their edges
+# repaired; the search runs backwards from the goal so a moving rover reuses
+# everything computed before.  Moving into a cell costs the step length
+# times the cell's cost (unknown cells are allowed but cost more, so the
+# rover prefers mapped terrain).  plan() expands at most `budget` cells per
+# call and picks up where it stopped on the next call, so planning never
+# takes more than a bounded share of a frame
+class Planner():
+    def __init__(self, size=200, budget=150, cell_costs=(1.0, 3.0, inf), obstacle_weight=0.25):
+        self.size = size # Grid is size x size cells, same as the worldmap
+        self.budget = budget # Maximum cell expansions per plan() call
+        self.cell_costs = cell_costs # Cost of FREE, UNKNOWN and BLOCKED cells
+        self.obstacle_weight = obstacle_weight # Weight of an obstacle hit against a navigable one
+        # Search arrays are over the grid padded by one BLOCKED cell on every
+        # side, so neighbours never need bounds checks
+        self.stride = size + 2
+        s = self.stride
+        self.neighbors = [(dx + dy * s, math.hypot(dx, dy))
+                          for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+        self.reset()
+
+    # Clear the grid and the search (WorldMap tracker interface)
+    def reset(self):
+        size, s = self.size, self.stride
+        self.occupancy = np.full(size * size, UNKNOWN, dtype=np.uint8)
+        self.cost = [inf] * (s * s)
+        for y in range(size):
+            row = (y + 1) * s + 1
+            self.cost[row:row + size] = [self.cell_costs[UNKNOWN]] * size
+        self.goal = None # Padded index of the goal cell
+        self.start = None # Padded index of the rover cell
+        self.changed = set() # Padded cells whose cost changed since the last plan()
+        self.expansions = 0 # Cells expanded by the last plan()
+        self._reset_search()
+
+    def _reset_search(self):
+        n = self.stride * self.stride
+        self.g = [inf] * n
+        self.rhs = [inf] * n
+        self.heap = []
+        self.queued = {} # Cell -> key it is queued with, older heap entries are stale
+        self.km = 0.0
+        self.last = self.start
+        if self.goal is not None:
+            self.rhs[self.goal] = 0.0
+            self._push(self.goal)
+
+    # Define functions to convert between (x, y) cells and padded indices
+    def index(self, cell):
+        return (int(cell[1]) + 1) * self.stride + int(cell[0]) + 1
+
+    def cell(self, index):
+        y, x = divmod(index, self.stride)
+        return x - 1, y - 1
+
+    # Fold changed worldmap cells into the occupancy grid (WorldMap tracker interface)
+    def update(self, worldmap, update):
+        cells = np.unique(update.cells // 3)
+        occupancy = cell_occupancy(worldmap.cell_counts(cells), self.obstacle_weight)
+        changed = occupancy != self.occupancy[cells]
+        if not np.any(changed):
+            return
+        cells, occupancy = cells[changed], occupancy[changed]
+        self.occupancy[cells] = occupancy
+        ys, xs = np.divmod(cells, self.size)
+        padded = (ys + 1) * self.stride + xs + 1
+        for index, occ in zip(padded.tolist(), occupancy.tolist()):
+            self.cost[index] = self.cell_costs[occ]
+            self.changed.add(index)
+
+    # Define a function to estimate the path length between two cells (octile distance)
+    def heuristic(self, a, b):
+        ay, ax = divmod(a, self.stride)
+        by, bx = divmod(b, self.stride)
+        dx, dy = abs(ax - bx), abs(ay - by)
+        return dx + dy + (math.sqrt(2) - 2) * min(dx, dy)
+
+    def _key(self, u):
+        m = min(self.g[u], self.rhs[u])
+        y, x = divmod(u, self.stride)
+        dx, dy = abs(x - self.start_x), abs(y - self.start_y)
+        return (m + dx + dy + (math.sqrt(2) - 2) * min(dx, dy) + self.km, m)
+
+    def _push(self, u):
+        key = self._key(u) if self.start is not None else (self.rhs[u], self.rhs[u])
+        self.queued[u] = key
+        heapq.heappush(self.heap, (key[0], key[1], u))
+
+    def _update_vertex(self, u):
+        # Blocked cells (and the padding) are never entered, so their
+        # distance only matters when the rover itself is on one
+        if self.cost[u] == inf and u != self.start:
+            return
+        if u != self.goal:
+            best = inf
+            g, cost = self.g, self.cost
+            for offset, step in self.neighbors:
+                v = u + offset
+                c = cost[v]
+                if c != inf:
+                    value = g[v] + step * c
+                    if value < best:
+                        best = value
+            self.rhs[u] = best
+        if self.g[u] != self.rhs[u]:
+            self._push(u)
+        else:
+            self.queued.pop(u, None)
+
+    # Define a function to set the goal cell (x, y); a new goal restarts the search
+    def set_goal(self, cell):
+        index = None if cell is None else self.index(cell)
+        if index != self.goal:
+            self.goal = index
+            self.changed.clear()
+            self._reset_search()
+
+    # Define a function to set the rover cell (x, y)
+    def set_start(self, cell):
+        self.start = self.index(cell)
+        self.start_y, self.start_x = divmod(self.start, self.stride)
+        if self.last is None:
+            self.last = self.start
+
+    # Define a function to repair and continue the search within the budget
+    # Returns True when the path from the start is final, False if the budget
+    # ran out first (call again on the next frame)
+    def plan(self):
+        self.expansions = 0
+        if self.goal is None or self.start is None:
+            return False
+        # Keys queued before the rover moved stay lower bounds with km raised
+        # by the distance moved
+        if self.start != self.last:
+            self.km += self.heuristic(self.last, self.start)
+            self.last = self.start
+        if self.changed:
+            for index in self.changed:
+                self._update_vertex(index)
+                for offset, _ in self.neighbors:
+                    self._update_vertex(index + offset)
+            self.changed.clear()
+        g, rhs, heap, queued = self.g, self.rhs, self.heap, self.queued
+        start = self.start
+        if self.cost[start] == inf:
+            self._update_vertex(start)
+        while heap:
+            k1, k2, u = heap[0]
+            if queued.get(u) != (k1, k2):
+                heapq.heappop(heap) # Stale entry
+                continue
+            if (k1 - key_tolerance, k2) >= self._key(start) and rhs[start] == g[start]:
+                return True
+            if self.expansions >= self.budget:
+                return False
+            self.expansions += 1
+            heapq.heappop(heap)
+            key = self._key(u)
+            if (k1, k2) < key:
+                self._push(u)
+                continue
+            del queued[u]
+            if g[u] > rhs[u]:
+                g[u] = rhs[u]
+            else:
+                g[u] = inf
+                self._update_vertex(u)
+            for offset, _ in self.neighbors:
+                self._update_vertex(u + offset)
+        return True
+
+    # Define a function to check whether a finished plan reaches the goal
+    def reachable(self):
+        return self.start is not None and self.g[self.start] != inf
+
+    # Define a function to follow the planned path from the start
+    # Returns up to `steps` (x, y) cells, empty without a path
+    def path(self, steps=8):
+        path = []
+        u = self.start
+        if u is None or self.g[u] == inf:
+            return path
+        g, cost = self.g, self.cost
+        for _ in range(steps):
+            if u == self.goal:
+                break
+            best, best_v = inf, None
+            for offset, step in self.neighbors:
+                v = u + offset
+                value = g[v] + step * cost[v]
+                if value < best:
+                    best, best_v = value, v
+            if best_v is None:
+                break
+            u = best_v
+            path.append(self.cell(u))
+        return path
+
+# Navigation goals for the planner: confirmed rock samples that have not
+# been collected yet first, otherwise a frontier cluster (see
+# frontier.FrontierIndex) at least min_distance meters away, the nearest or
+# the largest one depending on strategy.  An exploration goal is kept until
+# it is reached, found unreachable or no longer on the frontier.  Goals the
+# planner proved unreachable are skipped.  Goals are worldmap cells
+class GoalSelector():
+    def __init__(self, min_distance=10, reached_distance=3, strategy='nearest'):
+        self.min_distance = min_distance
+        self.strategy = strategy # 'nearest' or 'largest' frontier cluster
+        self.reached_distance = reached_distance
+        self.collected = set() # Indices of samples picked up
+        self.samples_found = 0 # Rover.samples_found when last checked
+        self.unreachable = set() # Goal cells without a path
+        self.explore = None # Current exploration goal
+
+    # Define a function to pick the goal cell (x, y) for the Rover at cell
+    # position, None if there is none
+    def choose(self, Rover, position):
+        x, y = position
+        resolution = getattr(Rover.worldmap, 'resolution', 1.0) # Cells per meter
+        samples = Rover.samples_pos
+        if samples is not None and len(samples[0]):
+            sx, sy = np.asarray(samples[0]) * resolution, np.asarray(samples[1]) * resolution
+            dist = np.hypot(sx - x, sy - y)
+            # When a sample was picked up, it was the one closest to the rover
+            if Rover.samples_found > self.samples_found:
+                self.samples_found = Rover.samples_found
+                open_samples = [i for i in range(len(sx)) if i not in self.collected]
+                if open_samples:
+                    self.collected.add(min(open_samples, key=lambda i: dist[i]))
+            confirmed = Rover.rock_index.confirmed(samples)
+            targets = [i for i in np.flatnonzero(confirmed) if i not in self.collected
+                       and (int(sx[i]), int(sy[i])) not in self.unreachable]
+            if targets:
+                i = min(targets, key=lambda i: dist[i])
+                return int(sx[i]), int(sy[i])
+        if self.explore is not None:
+            if self.explore in self.unreachable or \
+               not Rover.frontier.frontier[self.explore[1], self.explore[0]] or \
+               math.hypot(self.explore[0] - x, self.explore[1] - y) <= self.reached_distance * resolution:
+                self.explore = None
+        if self.explore is None:
+            query = Rover.frontier.largest if self.strategy == 'largest' else Rover.frontier.nearest
+            self.explore = query(position, self.min_distance * resolution, self.unreachable)
+        return self.explore
+
+# Define a function to plan for one frame and get the heading to follow
+# Returns the angle (degrees, rover frame, positive to the left like
+# Rover.nav_angles) from the rover to a cell a few steps along the planned
+# path, or None when there is no (finished) plan to follow
+def plan_heading(Rover, lookahead=6):
+    planner = Rover.planner
+    if planner is None or Rover.pos is None:
+        return None
+    size = planner.size
+    resolution = getattr(Rover.worldmap, 'resolution', 1.0) # Cells per meter
+    position = (min(max(int(Rover.pos[0] * resolution), 0), size - 1),
+                min(max(int(Rover.pos[1] * resolution), 0), size - 1))
+    planner.set_start(position)
+    goal = Rover.goals.choose(Rover, position)
+    planner.set_goal(goal)
+    if goal is None:
+        return None
+    if not planner.plan():
+        return None
+    if not planner.reachable():
+        Rover.goals.unreachable.add(goal)
+        return None
+    path = planner.path(lookahead)
+    if not path:
+        return None
+    tx, ty = path[-1]
+    angle = math.degrees(math.atan2(ty / resolution - Rover.pos[1], tx / resolution - Rover.pos[0])) - Rover.yaw
+    return (angle + 180) % 360 - 180
@@ -0,0 +1,105 @@
+import numpy as np
+
+from warp import get_warp_map
+
+# Cache of ProjectionTable objects keyed by (image shape, src points, dst points)
+_table_cache = {}
+
+# Arrays a table is stored as (see artifacts.py); the rest is derived from them
+table_fields = ('warped_index', 'x', 'y', 'dist', 'angles', 'border_x', 'border_y')
+
+# Precomputed warped-pixel -> rover-frame lookup table.
+# Because the camera is fixed to the rover, every pixel of the warped
+# (top-down) image always lands on the same rover-centric (x, y, dist,
+# angle).  The table stores, for each warped pixel in row-major order that
+# the camera image reaches, its rover-frame values, so a frame is warped
+# (the same bilinear remap as perspect_transform()), classified, and its
+# labels gathered at the table entries instead of going through
+# nonzero() -> rover_coords() -> to_polar_coords() for every class.
+# Sampling the camera pixels directly (nearest neighbour) would skip the
+# warp too, but gives a different (and noisier) classification than the
+# interpolated warp, so the table keeps the warp path's results exactly
+# arrays, if given, maps table_fields to the arrays of a previously built
+# table for the same geometry
+class ProjectionTable():
+    def __init__(self, shape, src, dst, arrays=None):
+        self.shape = tuple(shape[:2])
+        if arrays is None:
+            self._build(src, dst)
+        else:
+            for name in table_fields:
+                setattr(self, name, arrays[name])
+        self.warped_rows, self.warped_cols = np.divmod(self.warped_index, self.shape[1])
+        self._subsamples = {}
+
+    def _build(self, src, dst):
+        rows, cols = self.shape
+        warp_map = get_warp_map(self.shape, src, dst)
+        # Warped pixels without a single interpolation tap inside the camera
+        # image are black in every frame: warping a white image leaves them 0
+        # (a pixel with any tap inside comes out > 0 for white)
+        border = warp_map.warp(np.full((rows, cols), 255, np.uint8)) == 0
+        # Warped pixel positions of the table entries (row-major like nonzero())
+        self.warped_index = np.flatnonzero(~border) # flat index into the warped image
+        ypos, xpos = np.divmod(self.warped_index, cols)
+        # Same rover-centric convention as rover_coords()
+        self.x = np.absolute(ypos - rows).astype(np.float64)
+        self.y = -(xpos - rows).astype(np.float64)
+        self.dist = np.sqrt(self.x**2 + self.y**2)
+        self.angles = np.arctan2(self.y, self.x)
+        # The black border left by the warp falls inside the obstacle threshold
+        # range, so the warp path reports it as obstacles. Keep it around for parity
+        ypos, xpos = border.nonzero()
+        self.border_x = np.absolute(ypos - rows).astype(np.float64)
+        self.border_y = -(xpos - rows).astype(np.float64)
+
+    # Define a function to get the arrays the table can be rebuilt from
+    def arrays(self):
+        return {name: getattr(self, name) for name in table_fields}
+
+    # Define a function to get every stride-th table entry (cached)
+    # Returns the entry positions and their x, y and dist
+    def subsample(self, stride):
+        entries = self._subsamples.get(stride)
+        if entries is None:
+            index = np.arange(0, len(self.x), stride)
+            entries = self._subsamples[stride] = (index, self.x[index], self.y[index], self.dist[index])
+        return entries
+
+    # Define a function to sample a warped image at the table entries
+    def gather(self, warped_img):
+        if warped_img.ndim == 3:
+            return warped_img.reshape(-1, warped_img.shape[2])[self.warped_index]
+        return warped_img.reshape(-1)[self.warped_index]
+
+    # Define a function to select the rover-frame pixels of a warped mask
+    # Returns x, y, dist and angles in the same order as the warp path would
+    def project(self, warped_mask, include_border=False):
+        return self.select(self.gather(warped_mask), include_border)
+
+    # Define a function to select table entries given per-entry values
+    # (e.g. an already gathered mask or label & class bit)
+    def select(self, entries, include_border=False):
+        sel = entries != 0
+        x, y = self.x[sel], self.y[sel]
+        dist, angles = self.dist[sel], self.angles[sel]
+        if include_border and len(self.border_x):
+            bx, by = self.border_x, self.border_y
+            x, y = np.concatenate((x, bx)), np.concatenate((y, by))
+            dist = np.concatenate((dist, np.sqrt(bx**2 + by**2)))
+            angles = np.concatenate((angles, np.arctan2(by, bx)))
+        return x, y, dist, angles
+
+# Define a function to return the cached ProjectionTable for a geometry
+# (built from arrays, if given, the first time)
+def get_projection_table(shape, src, dst, arrays=None):
+    key = (tuple(shape[:2]), np.float32(src).tobytes(), np.float32(dst).tobytes())
+    table = _table_cache.get(key)
+    if table is None:
+        table = ProjectionTable(shape, src, dst, arrays)
+        _table_cache[key] = table
+    return table
+
+# Define a function to drop cached tables, e.g. after a camera re-calibration
+def clear_projection_cache():
+    _table_cache.clear()
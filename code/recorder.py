@@ -0,0 +1,101 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from metrics import registry
+from runs import log_columns
+
+log = logging.getLogger(__name__)
+
+recorded_frames = registry.counter('rover_recorded_frames_total', 'Frames written by the run recorder')
+recorder_dropped = registry.counter('rover_recorder_dropped_total',
+                                    'Frames of a recorded run that were not recorded: the queue was full, '
+                                    'the telemetry was invalid or the frame went stale (--pipelined)')
+write_seconds = registry.histogram('rover_recorder_write_seconds', 'Writing one batch of recorded frames')
+
+# Define a function to count frames of a recorded run that never got to
+# RunRecorder.record() (invalid telemetry, stale frames) as dropped
+def count_dropped(frames=1):
+    recorder_dropped.inc(frames)
+
+# Background recorder of a run in the simulator's training-mode layout:
+# the camera frames as JPEG files in IMG/ and one ';' separated row of pose
+# and commands per frame in robot_log.csv, so a recording can be replayed
+# with replay.py.  The frames are written with the JPEG bytes received in the
+# telemetry (never re-encoded).  record() only puts the frame on a bounded
+# queue; a writer thread takes up to batch_size frames at a time and writes
+# them with one log append.  When the writer falls behind, frames are dropped
+# instead of blocking the control loop
+class RunRecorder():
+    def __init__(self, folder, max_queue=256, batch_size=16):
+        self.folder = folder
+        self.img_folder = os.path.join(folder, 'IMG')
+        if not os.path.exists(self.img_folder):
+            os.makedirs(self.img_folder)
+        self.batch_size = batch_size
+        self._last_stamp = None
+        self._queue = queue.Queue(max_queue)
+        self._log = open(os.path.join(folder, 'robot_log.csv'), 'w')
+        self._log.write(';'.join(log_columns) + '\n')
+        self._thread = threading.Thread(target=self._run, name='run-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Define a function to record a frame: its JPEG bytes and the Rover's pose
+    # and commands.  Returns False if the frame was dropped
+    def record(self, jpeg, Rover, stamp=None):
+        stamp = datetime.utcnow() if stamp is None else stamp
+        # Frame names have millisecond resolution, keep them unique
+        stamp = stamp.replace(microsecond=stamp.microsecond // 1000 * 1000)
+        if self._last_stamp is not None and stamp <= self._last_stamp:
+            stamp = self._last_stamp + timedelta(milliseconds=1)
+        self._last_stamp = stamp
+        name = 'robocam_{}.jpg'.format(stamp.strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3])
+        row = (os.path.join('IMG', name), Rover.steer, Rover.throttle, Rover.brake, Rover.vel,
+               Rover.pos[0], Rover.pos[1], Rover.pitch, Rover.yaw, Rover.roll)
+        try:
+            self._queue.put_nowait((name, jpeg, row))
+        except queue.Full:
+            recorder_dropped.inc()
+            return False
+        return True
+
+    # Define a function to write what is queued and stop the writer
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._log.close()
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        lines = []
+        for name, jpeg, row in batch:
+            with open(os.path.join(self.img_folder, name), 'wb') as f:
+                f.write(jpeg)
+            lines.append(';'.join(str(value) for value in row) + '\n')
+        self._log.writelines(lines)
+        self._log.flush()
+        recorded_frames.inc(len(batch))
+        write_seconds.observe(time.perf_counter() - start)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError:
+                    log.exception('could not write recorded frames')
+            if done:
+                return
@@ -0,0 +1,201 @@
+# Headless replay of a recorded run (robot_log.csv + IMG/ or a run container) through the real
+# perception_step() and decision_step(), without the simulator or the server
+# Example: $ python replay.py ../test_dataset --workers 4 --out replay_output
+import argparse
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+
+from rover_state import RoverState
+from perception import perception_step, AdaptiveResolution
+from decision import decision_step
+from telemetry import TelemetryDecoder
+from runs import open_run
+
+# Define a function to load the pose of frame i into the Rover, like
+# update_rover() does with live telemetry
+def load_frame(Rover, run, i, decoder):
+    columns = run.columns
+    Rover.total_time = run.times[i]
+    Rover.vel = columns['Speed'][i]
+    Rover.pos = (columns['X_Position'][i], columns['Y_Position'][i])
+    Rover.yaw = columns['Yaw'][i]
+    Rover.pitch = columns['Pitch'][i]
+    Rover.roll = columns['Roll'][i]
+    Rover.throttle = columns['Throttle'][i]
+    Rover.steer = columns['SteerAngle'][i]
+    Rover.img = decoder.decode_jpeg(run.jpeg(i))
+    return Rover
+
+# Define a function to make a fresh Rover for a replay
+def new_rover(perception_mode, pose_correction=False, tiled=False, budget=None, planning=False):
+    Rover = RoverState(tiled=tiled, planning=planning)
+    Rover.perception_mode = perception_mode
+    if budget is not None:
+        Rover.adaptive_resolution = AdaptiveResolution(budget)
+    Rover.pose_correction = pose_correction
+    Rover.start_time = 0
+    return Rover
+
+# Define a function to run decision_step() and record the commands it gave
+def decide(Rover, i, perc_mapped=None):
+    decision_step(Rover)
+    return {
+        'frame': i, 'time': Rover.total_time, 'mode': Rover.mode,
+        'throttle': Rover.throttle, 'brake': Rover.brake, 'steer': Rover.steer,
+        'nav_pixels': 0 if Rover.nav_angles is None else len(Rover.nav_angles),
+        'can_see_rock': Rover.can_see_rock, 'perc_mapped': perc_mapped,
+        'plan_expansions': Rover.planner.expansions if Rover.planner is not None else None,
+        'rock_target': int(Rover.rock_tracker is not None and Rover.rock_tracker.target is not None),
+    }
+
+# Define a function to get the run time at which the mapped percentage first
+# reached each level, from the per-frame traces (None if it never did)
+def time_to_mapped(traces, levels=(10, 25, 50, 75, 90)):
+    times = {}
+    for level in levels:
+        times[str(level)] = next((trace['time'] for trace in traces
+                                  if trace['perc_mapped'] is not None and trace['perc_mapped'] >= level), None)
+    return times
+
+# Perception state decision_step() needs, as returned by the parallel workers
+perception_fields = ('nav_angles', 'nav_dists', 'can_see_rock', 'rock_dist', 'rock_angles')
+
+# Per-process state of the parallel workers
+_worker = {}
+
+def _init_worker(dataset, perception_mode, pose_correction):
+    _worker['run'] = open_run(dataset)
+    _worker['mode'] = perception_mode
+    _worker['pose_correction'] = pose_correction
+
+# Define a function to run perception over frames [start, stop) in a worker
+# Returns the chunk's worldmap counts and the per-frame perception outputs
+# (None for frames perception skipped, e.g. because the rover was tilted)
+def _perceive_chunk(bounds):
+    start, stop = bounds
+    run = _worker['run']
+    Rover = new_rover(_worker['mode'], _worker['pose_correction'])
+    decoder = TelemetryDecoder()
+    outputs = []
+    for i in range(start, stop):
+        load_frame(Rover, run, i, decoder)
+        Rover.nav_angles = None
+        perception_step(Rover)
+        if Rover.nav_angles is None:
+            outputs.append(None)
+        else:
+            outputs.append(tuple(getattr(Rover, field) for field in perception_fields))
+    return Rover.worldmap.dense(), outputs
+
+# Define a function to replay a run
+# With workers > 1 perception runs in a process pool on contiguous chunks of
+# frames; the chunk worldmaps are summed in chunk order (so the result does
+# not depend on scheduling) and decision_step() then runs over the frames in
+# order.  Per-frame mapped percentages (and so the time to reach a mapped
+# percentage) are only traced in sequential mode.  The planner then sees the
+# merged map from the start, and rocks are approached without the rock
+# tracker (it needs every frame's vision image), so parallel decisions can
+# differ from sequential
+def replay(dataset, perception_mode='warp', workers=1, limit=None, chunk_size=64, pose_correction=False,
+           tiled=False, budget=None, planning=False):
+    run = open_run(dataset)
+    nframes = len(run) if limit is None else min(limit, len(run))
+    Rover = new_rover(perception_mode, pose_correction, tiled, budget, planning)
+    decoder = TelemetryDecoder()
+    traces = []
+    perceived = 0 # Frames perception mapped (the others were too tilted)
+    start_time = time.time()
+    if workers <= 1:
+        for i in range(nframes):
+            load_frame(Rover, run, i, decoder)
+            version = Rover.worldmap.version
+            perception_step(Rover)
+            perceived += Rover.worldmap.version != version
+            traces.append(decide(Rover, i, Rover.map_stats.perc_mapped()))
+    else:
+        Rover.rock_tracker = None
+        chunks = [(start, min(start + chunk_size, nframes)) for start in range(0, nframes, chunk_size)]
+        with Pool(workers, initializer=_init_worker, initargs=(dataset, perception_mode, pose_correction)) as pool:
+            results = pool.map(_perceive_chunk, chunks)
+        # Merge the chunk worldmaps and feed them through the map trackers
+        merged = np.zeros(Rover.worldmap.dense().size, dtype=np.float64)
+        for counts, outputs in results:
+            merged += counts.reshape(-1)
+            perceived += sum(output is not None for output in outputs)
+        cells = np.flatnonzero(merged)
+        Rover.worldmap.add_flat(cells, merged[cells])
+        # Decisions depend on the previous frames, so they run in order
+        i = 0
+        for _, outputs in results:
+            for output in outputs:
+                load_frame(Rover, run, i, decoder)
+                if output is not None:
+                    for field, value in zip(perception_fields, output):
+                        setattr(Rover, field, value)
+                traces.append(decide(Rover, i))
+                i += 1
+    elapsed = time.time() - start_time
+    metrics = {
+        'frames': nframes,
+        'perception_mode': perception_mode,
+        'workers': workers,
+        'pose_correction': pose_correction,
+        'planning': planning,
+        'seconds': round(elapsed, 3),
+        'frames_per_second': round(nframes / elapsed, 1) if elapsed > 0 else None,
+        'frames_perceived': perceived,
+        'perc_mapped': Rover.map_stats.perc_mapped(),
+        'perc_mapped_per_frame': round(Rover.map_stats.perc_mapped() / perceived, 4) if perceived else None,
+        'fidelity': Rover.map_stats.fidelity(),
+        'worldmap_bytes': Rover.worldmap.nbytes,
+        'samples_found': Rover.samples_found,
+        'rock_frames': sum(trace['can_see_rock'] for trace in traces),
+        'rock_target_frames': sum(trace['rock_target'] for trace in traces),
+        'rock_full_searches': Rover.rock_tracker.full_searches if Rover.rock_tracker is not None else None,
+        'time_to_mapped': time_to_mapped(traces) if workers <= 1 else None,
+    }
+    return Rover, traces, metrics
+
+# Define a function to write the replay results to a folder
+def save_results(out_dir, Rover, traces, metrics):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    np.save(os.path.join(out_dir, 'worldmap.npy'), Rover.worldmap.dense())
+    with open(os.path.join(out_dir, 'traces.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(traces[0].keys()) if traces else ['frame'])
+        writer.writeheader()
+        writer.writerows(traces)
+    with open(os.path.join(out_dir, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run without the simulator')
+    parser.add_argument('dataset', type=str, nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_dataset'),
+                        help='Folder with robot_log.csv and IMG/, or a run container (default: test_dataset)')
+    parser.add_argument('--mode', type=str, default='warp', choices=['warp', 'lookup', 'roi'],
+                        help='Perception path to replay with')
+    parser.add_argument('--workers', type=int, default=1, help='Perception worker processes')
+    parser.add_argument('--chunk-size', type=int, default=64, help='Frames per worker task')
+    parser.add_argument('--pose-correction', action='store_true',
+                        help='Map tilted frames with the pitch/roll-corrected projection')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Use the sparse tiled worldmap (tiles allocated as the rover explores)')
+    parser.add_argument('--budget', type=float, default=0,
+                        help='roi mode: perception time (ms) above which pixels are subsampled, 0 for never')
+    parser.add_argument('--planning', action='store_true',
+                        help='Steer along a path plan to the exploration frontier')
+    parser.add_argument('--limit', type=int, default=None, help='Only replay the first N frames')
+    parser.add_argument('--out', type=str, default='', help='Folder to write worldmap, traces and metrics to')
+    args = parser.parse_args()
+
+    Rover, traces, metrics = replay(args.dataset, args.mode, args.workers, args.limit, args.chunk_size,
+                                     args.pose_correction, args.tiled, args.budget / 1000.0 if args.budget > 0 else None,
+                                     args.planning)
+    print(json.dumps(metrics, indent=2))
+    if args.out != '':
+        save_results(args.out, Rover, traces, metrics)
@@ -0,0 +1,220 @@
+import math
+import numpy as np
+import cv2
+
+# Frame-to-frame tracking of rock samples.
+# Rocks are detected as 8-connected components of the rock mask of the
+# top-down vision image (Rover.vision_image[:,:,1]) and kept as tracks with
+# a world position (meters) and its variance.  Rocks do not move, so the
+# filter is a constant position Kalman filter: the variance grows by
+# process_noise every frame (pose drift) and each detection is weighted by
+# its measurement variance, which grows with the distance from the rover.
+# Every track predicts where its rock shows up in the vision image, and
+# components are only searched in a window around that; the whole mask is
+# only searched when it has rock pixels outside every window (a new rock).
+# Tracks are remembered through frames where their rock is missed (until it
+# was missed max_misses times in a row while it should have been in view, or
+# went max_unseen frames without a detection), so a rock that comes back into
+# view continues its track.  The approach target is a confirmed track in view
+# that was detected in the last max_coast frames: it bridges a few missed
+# frames, but the rover never chases a rock it no longer sees
+class RockTrack():
+    __slots__ = ('x', 'y', 'var', 'hits', 'misses', 'last_seen')
+
+    def __init__(self, x, y, var, frame):
+        self.x = x # World position (meters)
+        self.y = y
+        self.var = var # Position variance (square meters, per axis)
+        self.hits = 1 # Frames the rock was detected in
+        self.misses = 0 # Consecutive frames it was missed while in view
+        self.last_seen = frame # Frame number of the last detection
+
+class RockTracker():
+    def __init__(self, min_pixels=3, min_hits=2, max_misses=5, max_unseen=100, max_coast=4,
+                 process_noise=0.01, measurement_noise=0.3, gate=1.5, window_margin=20,
+                 merge_angle=4, view_angle=45, view_range=150, scale=10):
+        self.min_pixels = min_pixels # Smaller components only update existing tracks
+        self.min_hits = min_hits # Detections before a track is confirmed
+        self.max_misses = max_misses # Misses in view before a track is dropped
+        self.max_unseen = max_unseen # Frames without a detection before a track is dropped
+        self.max_coast = max_coast # Frames without a detection a target is still approached
+        self.process_noise = process_noise # Variance added per frame (square meters)
+        self.measurement_noise = measurement_noise # Detection std (meters) next to the rover
+        self.gate = gate # Minimum association distance (meters)
+        self.window_margin = window_margin # Search window half-size around the prediction (pixels)
+        self.merge_angle = merge_angle # Components this close in bearing (degrees) are one rock
+        # A track is in view (and can be missed) within view_angle degrees
+        # to either side and view_range pixels of the rover
+        self.view_angle = view_angle
+        self.view_range = view_range
+        self.scale = scale # Vision image pixels per meter
+        self.reset()
+
+    def reset(self):
+        self.tracks = []
+        self.target = None # Track the rover is approaching
+        self.frame = 0 # Frames tracked
+        self.full_searches = 0 # Frames the whole mask had to be searched
+        self.samples_found = 0 # Rover.samples_found when last updated
+
+    # Define a function to find the rock components of a mask (crop)
+    # A rock sticks up from the ground, so its projection is smeared away
+    # from the rover and the rock itself is at the component's pixel nearest
+    # to the rover, which is at (column, row) (origin, origin) of the full mask.
+    # The smear can break up, so a component behind a nearer one on (nearly)
+    # the same bearing is a fragment of the nearer one's rock
+    # Returns the (column, row) of that pixel and the pixel count per rock
+    def detect(self, mask, origin, col0=0, row0=0):
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if n < 2:
+            return np.zeros((0, 2)), np.zeros(0, dtype=np.intp)
+        xs, ys = cv2.findNonZero(mask).reshape(-1, 2).T
+        label = labels[ys, xs]
+        xs, ys = xs + col0, ys + row0
+        dist = (xs - origin)**2 + (ys - origin)**2
+        order = np.lexsort((dist, label))
+        first = order[np.flatnonzero(np.diff(label[order], prepend=-1))]
+        first = first[np.argsort(dist[first])]
+        bearing = np.degrees(np.arctan2(origin - xs[first], origin - ys[first]))
+        areas = stats[label[first], cv2.CC_STAT_AREA]
+        rocks = []
+        for k in range(len(first)):
+            near = [r for r in rocks if abs(bearing[r] - bearing[k]) < self.merge_angle]
+            if near:
+                areas[near[0]] += areas[k]
+            else:
+                rocks.append(k)
+        first = first[rocks]
+        return np.column_stack((xs[first], ys[first])).astype(np.float64), areas[rocks]
+
+    # Define functions to convert between world positions and rover-frame
+    # pixels / vision image (column, row) coords, as rover_coords() relates them
+    def to_rover(self, x, y, pos, yaw):
+        yaw_rad = yaw * np.pi / 180
+        dx, dy = (x - pos[0]) * self.scale, (y - pos[1]) * self.scale
+        return dx * np.cos(yaw_rad) + dy * np.sin(yaw_rad), -dx * np.sin(yaw_rad) + dy * np.cos(yaw_rad)
+
+    def to_world(self, col, row, pos, yaw, rows):
+        yaw_rad = yaw * np.pi / 180
+        x_rover, y_rover = rows - row, rows - col
+        x = pos[0] + (x_rover * np.cos(yaw_rad) - y_rover * np.sin(yaw_rad)) / self.scale
+        y = pos[1] + (x_rover * np.sin(yaw_rad) + y_rover * np.cos(yaw_rad)) / self.scale
+        return x, y
+
+    # Define a function to check whether rover-frame pixel coords are in view
+    def in_view(self, x_rover, y_rover):
+        return 0 < x_rover and math.hypot(x_rover, y_rover) <= self.view_range and \
+            abs(math.degrees(math.atan2(y_rover, x_rover))) <= self.view_angle
+
+    # Define a function to fold the rock mask of the current frame into the tracks
+    def update(self, Rover):
+        self.frame += 1
+        mask = Rover.vision_image[:,:,1]
+        rows, cols = mask.shape
+        pos, yaw = Rover.pos, Rover.yaw
+        # A pickup collected the tracked rock closest to the rover
+        if Rover.samples_found > self.samples_found:
+            self.samples_found = Rover.samples_found
+            if self.tracks:
+                nearest = min(self.tracks, key=lambda t: (t.x - pos[0])**2 + (t.y - pos[1])**2)
+                self.tracks.remove(nearest)
+        # Predict every track and its search window
+        windows = []
+        in_view = []
+        for track in self.tracks:
+            track.var += self.process_noise
+            x_rover, y_rover = self.to_rover(track.x, track.y, pos, yaw)
+            visible = self.in_view(x_rover, y_rover)
+            in_view.append(visible)
+            if visible:
+                # Around the rock and its smear, out to the far edge (row 0) on its bearing
+                col, row = rows - y_rover, rows - x_rover
+                far_col = rows + (col - rows) * rows / x_rover
+                half = int(self.window_margin + 3 * math.sqrt(track.var) * self.scale)
+                windows.append([0, min(int(row) + half + 1, rows),
+                                max(int(min(col, far_col)) - half, 0), min(int(max(col, far_col)) + half + 1, cols)])
+        # Overlapping windows are searched as one
+        merged = True
+        while merged:
+            merged = False
+            for i, a in enumerate(windows):
+                for b in windows[i + 1:]:
+                    if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                        a[:] = min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+                        windows.remove(b)
+                        merged = True
+                        break
+                if merged:
+                    break
+        # Search the windows, or the whole mask if they miss rock pixels
+        total = cv2.countNonZero(mask)
+        detections, areas = None, ()
+        if total:
+            inside = sum(cv2.countNonZero(mask[r0:r1, c0:c1]) for r0, r1, c0, c1 in windows)
+            if inside < total:
+                self.full_searches += 1
+                detections, areas = self.detect(mask, rows)
+            else:
+                found = [self.detect(np.ascontiguousarray(mask[r0:r1, c0:c1]), rows, c0, r0)
+                         for r0, r1, c0, c1 in windows]
+                if found:
+                    detections = np.concatenate([points for points, _ in found])
+                    areas = np.concatenate([counts for _, counts in found])
+        # Detections in world coords, with their measurement variance
+        matched_tracks = set()
+        new_tracks = []
+        if len(areas):
+            wx, wy = self.to_world(detections[:, 0], detections[:, 1], pos, yaw, rows)
+            dist = np.hypot(rows - detections[:, 1], rows - detections[:, 0]) / self.scale
+            meas_var = (self.measurement_noise * (1 + dist / 10))**2
+            # Greedy nearest association within each pair's gate
+            pairs = []
+            gated = np.zeros(len(wx), dtype=bool) # Near a track: a fragment, not a new rock
+            for i, track in enumerate(self.tracks):
+                d = np.hypot(wx - track.x, wy - track.y)
+                near = d < np.maximum(self.gate, 3 * np.sqrt(track.var + meas_var))
+                gated |= near
+                pairs += [(d[j], i, j) for j in np.flatnonzero(near)]
+            pairs.sort()
+            matched_detections = set()
+            for _, i, j in pairs:
+                if i in matched_tracks or j in matched_detections:
+                    continue
+                matched_tracks.add(i)
+                matched_detections.add(j)
+                track = self.tracks[i]
+                gain = track.var / (track.var + meas_var[j])
+                track.x += gain * (wx[j] - track.x)
+                track.y += gain * (wy[j] - track.y)
+                track.var *= 1 - gain
+                track.hits += 1
+                track.misses = 0
+                track.last_seen = self.frame
+            # Unmatched detections start new tracks
+            new_tracks = [RockTrack(float(wx[j]), float(wy[j]), float(meas_var[j]), self.frame)
+                          for j in range(len(wx)) if not gated[j] and areas[j] >= self.min_pixels]
+        # Missed tracks age
+        kept = []
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks and in_view[i]:
+                track.misses += 1
+            if track.misses <= self.max_misses and self.frame - track.last_seen <= self.max_unseen:
+                kept.append(track)
+        kept += new_tracks
+        self.tracks = kept
+        # Keep approaching the same rock while it is in view and was seen lately
+        targets = [track for track in self.tracks if track.hits >= self.min_hits and
+                   self.frame - track.last_seen <= self.max_coast and
+                   self.in_view(*self.to_rover(track.x, track.y, pos, yaw))]
+        if self.target not in targets:
+            self.target = min(targets, key=lambda t: (t.x - pos[0])**2 + (t.y - pos[1])**2) \
+                if targets else None
+
+    # Define a function to get the target rock relative to the rover
+    # Returns its distance (vision image pixels, like Rover.rock_dist) and
+    # angle (degrees, positive to the left), or None without a target
+    def target_polar(self, pos, yaw):
+        if self.target is None:
+            return None
+        x_rover, y_rover = self.to_rover(self.target.x, self.target.y, pos, yaw)
+        return math.hypot(x_rover, y_rover), math.degrees(math.atan2(y_rover, x_rover))
@@ -0,0 +1,121 @@
+import numpy as np
+
+from artifacts import load_artifacts
+from worldmap import WorldMap, TiledWorldMap
+from mapstats import MapStats, MapOverlay, RockIndex
+from perception import PerceptionScratch
+from planner import Planner, GoalSelector
+from frontier import FrontierIndex
+from rocks import RockTracker
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# (from the startup artifact cache, see artifacts.py; 255 on navigable cells)
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+artifacts = load_artifacts()
+ground_truth = artifacts['ground_truth']
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth, ground_truth*0))
+
+# Define RoverState() class to retain rover state parameters
+# The fields are fixed (__slots__), so the state is compact and a typo in a
+# field name raises instead of silently adding a new one.  With lean=True
+# perception works in preallocated buffers (see perception.PerceptionScratch),
+# with tiled=True the worldmap is a worldmap.TiledWorldMap that allocates
+# its tiles as the rover explores, resolution sets its cells per meter (the
+# map statistics, rock index, frontier and planner work in those cells) and
+# with planning=True decisions steer
+# along a path plan to the exploration frontier (the frontier and planner
+# then follow every worldmap update, which costs perception time)
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'img', 'pos', 'yaw', 'pitch', 'roll', 'vel',
+                 'steer', 'throttle', 'brake', 'nav_angles', 'nav_dists', 'ground_truth',
+                 'mode', 'throttle_set', 'brake_set', 'stop_forward', 'go_forward', 'max_vel',
+                 'perception_mode', 'adaptive_resolution', 'pose_correction', 'scratch', 'vision_image', 'worldmap', 'map_stats',
+                 'map_overlay', 'rock_index', 'samples_pos', 'samples_to_find', 'samples_found',
+                 'near_sample', 'picking_up', 'send_pickup', 'rock_angles', 'rock_dist',
+                 'can_see_rock', 'rock_tracker', 'stuck', 'frontier', 'planner', 'goals')
+
+    def __init__(self, lean=False, tiled=False, planning=False, resolution=1.0):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        self.mode = 'forward' # Current mode (can be forward or stop)
+        self.throttle_set = 0.2 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = 60 # Threshold to initiate stopping
+        self.go_forward = 500 # Threshold to go forward again
+        self.max_vel = 5 # Maximum velocity (meters/second)
+        # Perception path: 'warp' projects the warped pixels with rover_coords(),
+        # 'lookup' uses the precomputed projection table instead,
+        # 'roi' only projects the warp's valid footprint
+        self.perception_mode = 'warp'
+        # Subsampling under load in 'roi' mode (perception.AdaptiveResolution), None for full resolution
+        self.adaptive_resolution = None
+        # Map tilted frames with the pitch/roll-corrected projection instead
+        # of skipping them (see perception.add_tilted)
+        self.pose_correction = False
+        # Preallocated perception buffers in memory-lean mode, None otherwise
+        self.scratch = PerceptionScratch() if lean else None
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        # (class masks are 0 or 255, so one byte per pixel and channel)
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8)
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        # (hit counts per cell, see worldmap.WorldMap; the array is worldmap.dense())
+        # The world is 200 meters square
+        size = int(round(200 * resolution))
+        if tiled:
+            self.worldmap = TiledWorldMap(size, resolution=resolution)
+        else:
+            self.worldmap = WorldMap(size, resolution=resolution)
+        # Map statistics, display overlay and rock detection index, updated
+        # from the cells each perception step changes
+        self.map_stats = MapStats(ground_truth_3d, int(artifacts['navigable_cells']))
+        self.map_overlay = MapOverlay(self.map_stats, ground_truth_3d)
+        self.rock_index = RockIndex()
+        self.worldmap.trackers += [self.map_stats, self.map_overlay, self.rock_index]
+        # Exploration frontier, path planner and the goals it plans to
+        # (see frontier.py and planner.py), None without planning
+        self.frontier = None
+        self.planner = None
+        self.goals = None
+        if planning:
+            self.frontier = FrontierIndex(size)
+            self.planner = Planner(size)
+            self.worldmap.trackers += [self.frontier, self.planner]
+            self.goals = GoalSelector()
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_found = 0 # To count the number of samples found
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+
+        self.rock_angles = None
+        self.rock_dist = None
+        self.can_see_rock = 0
+        # Rock samples tracked across frames (see rocks.RockTracker), None
+        # to approach whatever rock pixels the current frame shows
+        self.rock_tracker = RockTracker()
+        self.stuck = 0
@@ -0,0 +1,158 @@
+# Recorded runs, in the simulator's training-mode layout (robot_log.csv + IMG/)
+# or in a single-file run container
+# Example: $ python runs.py ../test_dataset test_dataset.run
+import argparse
+import csv
+import json
+import os
+import struct
+from datetime import datetime
+import numpy as np
+
+# Columns of robot_log.csv, in order
+log_columns = ('Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+               'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll')
+
+# A recorded run in the simulator's training-mode layout: a ';' separated
+# robot_log.csv with one row per frame, and the frames as JPEG files in IMG/
+class CsvRun():
+    def __init__(self, dataset):
+        self.dataset = dataset
+        with open(os.path.join(dataset, 'robot_log.csv')) as f:
+            rows = list(csv.DictReader(f, delimiter=';'))
+        # Image paths in the log are relative to wherever the recording was
+        # made, so look the files up by name in this dataset's IMG folder
+        self.paths = [os.path.join(dataset, 'IMG', os.path.basename(row['Path'].replace('\\', '/')))
+                      for row in rows]
+        self.columns = {}
+        for name in log_columns[1:]:
+            self.columns[name] = np.array([float(row[name].replace(',', '.')) for row in rows])
+        self.times = frame_times(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Define a function to get the raw JPEG bytes of frame i
+    def jpeg(self, i):
+        with open(self.paths[i], 'rb') as f:
+            return f.read()
+
+# Define a function to get frame times in seconds from the start of the run
+# Recorded frame names end in a timestamp (robocam_2017_05_02_11_16_21_421.jpg);
+# if they do not, assume the simulator's typical 25 frames per second
+def frame_times(paths):
+    try:
+        stamps = [datetime.strptime(os.path.splitext(os.path.basename(path))[0][-23:],
+                                    '%Y_%m_%d_%H_%M_%S_%f') for path in paths]
+        return np.array([(stamp - stamps[0]).total_seconds() for stamp in stamps])
+    except (ValueError, IndexError):
+        return np.arange(len(paths)) / 25.0
+
+# Single-file run container layout (all sections start on a 64 byte boundary):
+#   magic 'ROVERRUN', uint32 version, uint32 header length, JSON header
+#   one little-endian float64 array per log column, then the frame times
+#   int64 frame offsets (frames + 1 entries) into the blob section
+#   the frame JPEGs, back to back
+# The header records the number of frames and the offset of every section,
+# so the loader memory-maps the file and every column and frame is a view
+magic = b'ROVERRUN'
+version = 1
+alignment = 64
+
+# Define a function to round an offset up to the section alignment
+def _align(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+# Define a function to write a run container
+# columns maps log column names to per-frame arrays, times are the frame
+# times in seconds and jpegs an iterable of the frames' JPEG bytes
+def write_run(path, columns, times, jpegs):
+    jpegs = list(jpegs)
+    nframes = len(jpegs)
+    arrays = [(name, np.ascontiguousarray(columns[name], dtype='<f8')) for name in log_columns[1:]]
+    arrays.append(('times', np.ascontiguousarray(times, dtype='<f8')))
+    offsets = np.zeros(nframes + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(jpeg) for jpeg in jpegs])
+    # The header size depends on the offsets in it; fix its length up front
+    header = {'frames': nframes, 'columns': {}, 'index': 0, 'blobs': 0}
+    header_size = _align(16 + len(json.dumps(header)) + 64 * (len(arrays) + 2))
+    offset = header_size
+    for name, array in arrays:
+        if len(array) != nframes:
+            raise ValueError('column {} has {} values for {} frames'.format(name, len(array), nframes))
+        header['columns'][name] = offset
+        offset = _align(offset + array.nbytes)
+    header['index'] = offset
+    header['blobs'] = _align(offset + offsets.nbytes)
+    encoded = json.dumps(header).encode('utf-8')
+    if 16 + len(encoded) > header_size:
+        raise ValueError('run header does not fit')
+    with open(path, 'wb') as f:
+        f.write(magic + struct.pack('<II', version, len(encoded)) + encoded)
+        for name, array in arrays:
+            f.seek(header['columns'][name])
+            f.write(array.tobytes())
+        f.seek(header['index'])
+        f.write(offsets.tobytes())
+        f.seek(header['blobs'])
+        for jpeg in jpegs:
+            f.write(jpeg)
+    return path
+
+# Define a function to convert a recorded run (robot_log.csv + IMG/) to a container
+def convert(dataset, path):
+    run = CsvRun(dataset)
+    return write_run(path, run.columns, run.times, (run.jpeg(i) for i in range(len(run))))
+
+# A run container opened for reading, with the same interface as
+# replay.CsvRun: len(), columns, times and jpeg(i).  The file is memory
+# mapped once; columns, times and frames are views into the mapping, so
+# random access is O(1) and nothing is read until it is used
+class RunFile():
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if self.data[:8].tobytes() != magic:
+            raise ValueError('{} is not a run container'.format(path))
+        file_version, header_length = struct.unpack('<II', self.data[8:16].tobytes())
+        if file_version != version:
+            raise ValueError('{} is run container version {}, expected {}'.format(path, file_version, version))
+        header = json.loads(self.data[16:16 + header_length].tobytes().decode('utf-8'))
+        self.nframes = header['frames']
+        self.columns = {}
+        for name, offset in header['columns'].items():
+            self.columns[name] = self._array(offset, '<f8', self.nframes)
+        self.times = self.columns.pop('times')
+        self.offsets = self._array(header['index'], '<i8', self.nframes + 1)
+        self.blobs = self.data[header['blobs']:]
+
+    def _array(self, offset, dtype, count):
+        return np.frombuffer(self.data, dtype=dtype, count=count, offset=offset)
+
+    def __len__(self):
+        return self.nframes
+
+    # Define a function to get the JPEG bytes of frame i (a view, no copy)
+    def jpeg(self, i):
+        return memoryview(self.blobs[self.offsets[i]:self.offsets[i + 1]])
+
+    # Define a function to get frames [start, stop) as one view of their
+    # JPEGs back to back plus the offsets of each frame in it
+    def jpegs(self, start, stop):
+        begin, end = self.offsets[start], self.offsets[stop]
+        return memoryview(self.blobs[begin:end]), self.offsets[start:stop + 1] - begin
+
+# Define a function to open a recorded run, either layout
+def open_run(dataset):
+    if os.path.isfile(dataset):
+        return RunFile(dataset)
+    return CsvRun(dataset)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a recorded run to a single-file run container')
+    parser.add_argument('dataset', type=str, help='Folder with robot_log.csv and IMG/')
+    parser.add_argument('output', type=str, help='Run container to write (e.g. run.run)')
+    args = parser.parse_args()
+    convert(args.dataset, args.output)
+    print('{} frames written to {} ({:.1f} MB)'.format(len(RunFile(args.output)), args.output,
+                                                      os.path.getsize(args.output) / 1e6))
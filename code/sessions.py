@@ -0,0 +1,250 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+from artifacts import install_artifacts
+from rover_state import RoverState
+from perception import AdaptiveResolution
+from supporting_functions import telemetry_step
+from telemetry import TelemetryDecoder
+from insets import InsetRenderer
+from recorder import RunRecorder, count_dropped
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+# Define a function to build the session of one connected simulator
+# options holds the server settings: lean, tiled, resolution, planning, perception_mode,
+# perception_budget (seconds, None for no subsampling), pose_correction,
+# rock_tracking, inset_quality, inset_backend, inset_interval and
+# image_folder ('' to not record); index numbers the sessions of a server,
+# the first one records straight into image_folder
+def make_session(sid, options, index=0):
+    Rover = RoverState(lean=options.get('lean', False), tiled=options.get('tiled', False),
+                       planning=options.get('planning', False), resolution=options.get('resolution', 1.0))
+    Rover.perception_mode = options.get('perception_mode', 'warp')
+    if options.get('perception_budget') is not None:
+        Rover.adaptive_resolution = AdaptiveResolution(options['perception_budget'])
+    Rover.pose_correction = options.get('pose_correction', False)
+    if not options.get('rock_tracking', True):
+        Rover.rock_tracker = None
+    insets = InsetRenderer(quality=options.get('inset_quality', 75),
+                           backend=options.get('inset_backend', 'cv2'),
+                           interval=options.get('inset_interval', 0.2))
+    recorder = None
+    if options.get('image_folder', ''):
+        folder = options['image_folder']
+        if index > 0:
+            folder = os.path.join(folder, 'session_{}'.format(index))
+        recorder = RunRecorder(folder)
+    return Session(sid, Rover, insets, TelemetryDecoder(), recorder)
+
+# Everything one connected simulator needs: its Rover, inset renderer,
+# telemetry decoder (with its frame buffer) and optional recorder
+# Once closed a session drops any further frames, so a frame still in
+# flight when its client disconnects never touches the closed recorder
+class Session():
+    def __init__(self, sid, Rover, insets, decoder, recorder=None):
+        self.sid = sid
+        self.Rover = Rover
+        self.insets = insets
+        self.decoder = decoder
+        self.recorder = recorder
+        self.closed = False
+        self._lock = threading.Lock()
+
+    # Define a function to run one telemetry message through the session
+    # Returns the (throttle, brake, steer) commands (None for invalid
+    # telemetry), the (map, vision) inset strings and whether to send pickup,
+    # or None if the session is closed (the frame is dropped)
+    def step(self, data):
+        with self._lock:
+            if self.closed:
+                return None
+            Rover = self.Rover
+            image, commands, strings = telemetry_step(Rover, data, self.insets, self.decoder)
+            pickup = False
+            if commands is not None:
+                # If in a state where want to pickup a rock send pickup command
+                if Rover.send_pickup and not Rover.picking_up:
+                    pickup = True
+                    # Reset Rover flags
+                    Rover.send_pickup = False
+                if self.recorder is not None:
+                    self.recorder.record(self.decoder.jpeg, Rover)
+            elif self.recorder is not None:
+                # No valid pose or image to record
+                count_dropped()
+            return commands, strings, pickup
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.recorder is not None:
+            self.recorder.close()
+
+# Sessions of the clients connected to this process, by socket.io sid.
+# A session is opened when its client connects and dropped when it
+# disconnects; telemetry for a sid without an open session (e.g. a frame
+# still queued when its client disconnected) is dropped, never starts one
+class SessionManager():
+    def __init__(self, options):
+        # Cached camera geometry for the first frame (see artifacts.py)
+        install_artifacts()
+        self.options = options
+        self.sessions = {}
+        self.created = 0 # Sessions created so far, numbers the next one
+        self._lock = threading.Lock()
+
+    # Define a function to open the session of a newly connected client
+    def open(self, sid):
+        with self._lock:
+            session = self.sessions.get(sid)
+            if session is None:
+                session = self.sessions[sid] = make_session(sid, self.options, self.created)
+                self.created += 1
+            return session
+
+    def get(self, sid):
+        return self.sessions.get(sid)
+
+    # Define a function to process one telemetry message of a client
+    # Returns what Session.step() does, None if the sid has no open session
+    def step(self, sid, data):
+        session = self.get(sid)
+        if session is None:
+            return None
+        return session.step(data)
+
+    def close(self, sid):
+        with self._lock:
+            session = self.sessions.pop(sid, None)
+        if session is not None:
+            session.close()
+
+    # Define a function to get the metrics recorded outside this process's
+    # registry: none, the sessions run here
+    def snapshots(self):
+        return []
+
+    def __len__(self):
+        return len(self.sessions)
+
+# Main loop of a shard worker process: a SessionManager of its own, fed
+# (command, sid, data) messages over a pipe
+def _shard_main(conn, options, shard):
+    options = dict(options)
+    if options.get('image_folder', ''):
+        options['image_folder'] = os.path.join(options['image_folder'], 'shard_{}'.format(shard))
+    sessions = SessionManager(options)
+    while True:
+        try:
+            command, sid, data = conn.recv()
+        except EOFError:
+            break
+        if command == 'open':
+            sessions.open(sid)
+        elif command == 'telemetry':
+            try:
+                conn.send(('ok', sessions.step(sid, data)))
+            except Exception as e:
+                log.exception('telemetry frame failed in shard %d', shard)
+                conn.send(('error', repr(e)))
+        elif command == 'close':
+            sessions.close(sid)
+        elif command == 'metrics':
+            conn.send(('ok', registry.snapshot()))
+        elif command == 'stop':
+            break
+    for sid in list(sessions.sessions):
+        sessions.close(sid)
+
+# One shard worker process and the pipe to it.  Calls are serialized, so
+# any number of threads can use the same shard
+class Shard():
+    def __init__(self, context, options, index):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_shard_main, args=(child, options, index),
+                                       name='rover-shard-{}'.format(index))
+        self.process.daemon = True
+        self.process.start()
+        self.sids = set() # Sessions this shard serves
+        self._lock = threading.Lock()
+
+    def open(self, sid):
+        with self._lock:
+            self.conn.send(('open', sid, None))
+
+    def step(self, sid, data):
+        with self._lock:
+            self.conn.send(('telemetry', sid, data))
+            status, result = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError('shard failed to process telemetry: {}'.format(result))
+        return result
+
+    def close(self, sid):
+        with self._lock:
+            self.conn.send(('close', sid, None))
+        self.sids.discard(sid)
+
+    # Define a function to get the snapshot of the shard's metrics registry
+    def snapshot(self):
+        with self._lock:
+            self.conn.send(('metrics', None, None))
+            status, snapshot = self.conn.recv()
+        return snapshot
+
+    def stop(self):
+        with self._lock:
+            self.conn.send(('stop', None, None))
+        self.process.join()
+
+# Sessions spread over worker processes, with the same step()/close()
+# interface as SessionManager.  A newly opened sid goes to the shard serving
+# the fewest sessions and stays there until it is closed, so its Rover state lives in one process;
+# different sessions run on different cores.  step() blocks until the shard
+# answers, so the server calls it from a thread (eventlet.tpool)
+class ShardedSessions():
+    def __init__(self, options, workers):
+        context = multiprocessing.get_context('spawn')
+        self.shards = [Shard(context, options, index) for index in range(workers)]
+        self.assigned = {} # sid -> Shard
+        self._lock = threading.Lock()
+
+    def open(self, sid):
+        with self._lock:
+            if sid in self.assigned:
+                return
+            shard = min(self.shards, key=lambda s: len(s.sids))
+            shard.sids.add(sid)
+            self.assigned[sid] = shard
+        shard.open(sid)
+
+    # Returns None (the frame is dropped) if the sid has no open session
+    def step(self, sid, data):
+        shard = self.assigned.get(sid)
+        if shard is None:
+            return None
+        return shard.step(sid, data)
+
+    def close(self, sid):
+        with self._lock:
+            shard = self.assigned.pop(sid, None)
+        if shard is not None:
+            shard.close(sid)
+
+    # Define a function to get the metrics the shards recorded (per-stage
+    # timings, recorder counters, ...), one registry snapshot per shard
+    def snapshots(self):
+        return [shard.snapshot() for shard in self.shards]
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def __len__(self):
+        return len(self.assigned)
@@ -0,0 +1,159 @@
+# Stand-in for the simulator: socket.io clients that replay a recorded run as
+# telemetry into drive_rover.py and measure how fast the commands come back
+# Example: $ python simulate.py ../test_dataset --clients 4 --rate 0 --loops 3
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+import socketio
+
+from runs import open_run
+from telemetry import run_message
+
+# Define a function to summarize round-trip times (seconds) in milliseconds
+def rtt_stats(rtts):
+    if len(rtts) == 0:
+        return {'count': 0}
+    rtts = 1e3 * np.asarray(rtts)
+    return {'count': len(rtts), 'mean_ms': round(float(np.mean(rtts)), 3),
+            'p50_ms': round(float(np.percentile(rtts, 50)), 3),
+            'p99_ms': round(float(np.percentile(rtts, 99)), 3),
+            'max_ms': round(float(np.max(rtts)), 3)}
+
+# One simulated simulator connection.
+# With rate 0 it runs closed loop: the next frame is sent as soon as the
+# commands for the previous one arrived (or after timeout), which measures
+# the server's best throughput.  With rate > 0 frames are sent at that many
+# per second whatever the server does, like the real simulator.  Replies
+# carry no frame id, so a 'data' reply is matched to the oldest frame still
+# waiting for one; a 'pickup' reply is timed from the same frame
+class SimClient():
+    def __init__(self, url, messages, rate=0, loops=1, timeout=1.0):
+        self.url = url
+        self.messages = messages # Telemetry messages to send, in order
+        self.rate = rate # Frames per second, 0 for closed loop
+        self.loops = loops # Passes over the messages
+        self.timeout = timeout # Closed loop: give up waiting for a reply after this long
+        self.sent = 0
+        self.data_rtts = []
+        self.pickup_rtts = []
+        self.timeouts = 0
+        self.elapsed = None
+        self._pending = deque() # Send times of frames without a reply yet
+        self._last_matched = None # Send time of the frame the last reply was matched to
+        self._lock = threading.Lock()
+        self._replied = threading.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('data', self._on_data)
+        self.sio.on('pickup', self._on_pickup)
+
+    def _on_data(self, data):
+        now = time.perf_counter()
+        with self._lock:
+            if self._pending:
+                self._last_matched = self._pending.popleft()
+                self.data_rtts.append(now - self._last_matched)
+        self._replied.set()
+
+    def _on_pickup(self, data):
+        now = time.perf_counter()
+        with self._lock:
+            if self._last_matched is not None:
+                self.pickup_rtts.append(now - self._last_matched)
+
+    def _send(self, message):
+        self._replied.clear()
+        with self._lock:
+            self._pending.append(time.perf_counter())
+        self.sio.emit('telemetry', message)
+        self.sent += 1
+
+    # Define a function to connect, replay the messages and disconnect
+    def run(self):
+        self.sio.connect(self.url, transports=['websocket'])
+        # The server greets a new client with a null 'data' command
+        self._replied.wait(self.timeout)
+        self._replied.clear()
+        start = time.perf_counter()
+        for n in range(self.loops * len(self.messages)):
+            message = self.messages[n % len(self.messages)]
+            if self.rate > 0:
+                delay = start + n / self.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                self._send(message)
+            else:
+                self._send(message)
+                if not self._replied.wait(self.timeout):
+                    self.timeouts += 1
+                    with self._lock:
+                        self._pending.clear()
+        # Give the last frames time to be answered
+        deadline = time.perf_counter() + self.timeout
+        while self._pending and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        self.elapsed = time.perf_counter() - start
+        self.sio.disconnect()
+
+    def results(self):
+        return {
+            'sent': self.sent,
+            'replies': len(self.data_rtts),
+            'unanswered': self.sent - len(self.data_rtts),
+            'timeouts': self.timeouts,
+            'seconds': round(self.elapsed, 3),
+            'replies_per_second': round(len(self.data_rtts) / self.elapsed, 1) if self.elapsed else None,
+            'data_rtt': rtt_stats(self.data_rtts),
+            'pickup_rtt': rtt_stats(self.pickup_rtts),
+        }
+
+# Define a function to replay a run with several clients at once
+# Returns per-client results and the totals over all clients
+def simulate(dataset, url='http://localhost:4567', clients=1, rate=0, loops=1, limit=None, timeout=1.0):
+    run = open_run(dataset)
+    nframes = len(run) if limit is None else min(limit, len(run))
+    messages = [run_message(run, i) for i in range(nframes)]
+    sims = [SimClient(url, messages, rate, loops, timeout) for _ in range(clients)]
+    threads = [threading.Thread(target=sim.run, name='sim-client-{}'.format(i)) for i, sim in enumerate(sims)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    replies = sum(len(sim.data_rtts) for sim in sims)
+    return {
+        'clients': [sim.results() for sim in sims],
+        'total': {
+            'clients': clients, 'rate': rate, 'frames': nframes, 'loops': loops,
+            'sent': sum(sim.sent for sim in sims), 'replies': replies,
+            'seconds': round(elapsed, 3),
+            'replies_per_second': round(replies / elapsed, 1) if elapsed > 0 else None,
+            'data_rtt': rtt_stats(np.concatenate([sim.data_rtts for sim in sims])),
+            'pickup_rtt': rtt_stats(np.concatenate([sim.pickup_rtts for sim in sims])),
+        },
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded telemetry into drive_rover.py')
+    parser.add_argument('dataset', type=str, nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_dataset'),
+                        help='Folder with robot_log.csv and IMG/, or a run container (default: test_dataset)')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='drive_rover.py server')
+    parser.add_argument('--clients', type=int, default=1, help='Simulated simulators connected at once')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Frames per second per client, 0 to send each frame as soon as the last was answered')
+    parser.add_argument('--loops', type=int, default=1, help='Passes over the run per client')
+    parser.add_argument('--limit', type=int, default=None, help='Only send the first N frames of the run')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Seconds to wait for a reply')
+    parser.add_argument('--out', type=str, default='', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = simulate(args.dataset, args.url, args.clients, args.rate, args.loops, args.limit, args.timeout)
+    print(json.dumps(results['total'], indent=2))
+    if args.out != '':
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
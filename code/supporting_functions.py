@@ -1,128 +1,103 @@
 import numpy as np
 import cv2
 from PIL import Image
-from io import BytesIO, StringIO
+from io import BytesIO
 import base64
+import logging
 import time
 
+from telemetry import TelemetryDecoder, parse_list, log
+from perception import perception_step
+from decision import decision_step
+from metrics import registry
+
+# Per-stage timing of telemetry_step(), served by drive_rover.py on /metrics
+stage_seconds = {
+      'decode': registry.histogram('rover_decode_seconds', 'Telemetry parsing and camera JPEG decoding per frame'),
+      'perception': registry.histogram('rover_perception_seconds', 'perception_step() per frame'),
+      'decision': registry.histogram('rover_decision_seconds', 'decision_step() per frame'),
+      'render': registry.histogram('rover_render_seconds', 'Inset refresh (map composition, encoding hand-off) per frame'),
+}
+invalid_frames = registry.counter('rover_invalid_frames_total', 'Telemetry frames with invalid (non-finite) speed')
+
+# Decoder used by update_rover() when none is given, keeps its frame buffer
+# from one telemetry message to the next
+telemetry_decoder = TelemetryDecoder()
+
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
+      return float(string_to_convert.replace(',','.'))
 
-def update_rover(Rover, data):
+def update_rover(Rover, data, decoder=None):
+      if decoder is None:
+            decoder = telemetry_decoder
       # Initialize start time and sample positions
       if Rover.start_time == None:
             Rover.start_time = time.time()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
+            samples_xpos = np.int_(parse_list(data["samples_x"]))
+            samples_ypos = np.int_(parse_list(data["samples_y"]))
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.samples_to_find = int(data["sample_count"])
       # Or just update elapsed time
       else:
             tot_time = time.time() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
       # Print out the fields in the telemetry data dictionary
-      print(data.keys())
-      # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
-      # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-      # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
-      # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
-      # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
-      # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      log.debug('telemetry fields: %s', list(data.keys()))
+      # The current speed, position, yaw/pitch/roll angles, throttle setting
+      # and steering angle of the rover, all parsed in one go
+      Rover.vel, Rover.pos, Rover.yaw, Rover.pitch, Rover.roll, \
+            Rover.throttle, Rover.steer = decoder.decode_fields(data)
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = int(data["near_sample"])
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = int(data["picking_up"])
       # Update number of rocks found
-      Rover.samples_found = Rover.samples_to_find - np.int(data["sample_count"])
-
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples found:', Rover.samples_found, 'can see rock:', Rover.can_see_rock, 
-      'Mode:', Rover.mode, 'stuck: ', Rover.stuck)
+      Rover.samples_found = Rover.samples_to_find - int(data["sample_count"])
+
+      if log.isEnabledFor(logging.DEBUG):
+            log.debug('speed = %s position = %s throttle = %s steer_angle = %s near_sample: %s '
+                  'picking_up: %s sending pickup: %s total time: %s samples remaining: %s '
+                  'samples found: %s can see rock: %s Mode: %s stuck: %s',
+                  Rover.vel, Rover.pos, Rover.throttle, Rover.steer, Rover.near_sample,
+                  data["picking_up"], Rover.send_pickup, Rover.total_time, data["sample_count"],
+                  Rover.samples_found, Rover.can_see_rock, Rover.mode, Rover.stuck)
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      # (decoded into the decoder's reusable frame buffer)
+      Rover.img = decoder.decode_image(data["image"])
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      # Return updated Rover and the camera image for optional saving
+      return Rover, Rover.img
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
-
-      # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-      else:
-            obstacle = Rover.worldmap[:,:,0]
-
-      likely_nav = navigable >= obstacle
-      obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
-      # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      if rock_world_pos[0].any():
-            rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-      # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-      # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-      # Calculate the number of good map pixel detections divided by total pixels 
+# Define a function to compose the map display image (flipped, with text)
+def compose_map_image(Rover):
+
+      # Scaled obstacle and navigable terrain map overlaid with the ground truth
+      # map, only redrawn where the worldmap changed (see mapstats.MapOverlay)
+      map_add = Rover.map_overlay.render(Rover.worldmap).copy()
+
+      # Step through the known sample positions to confirm whether rock
+      # detections are real: if rocks were detected within 3 meters of a known
+      # sample position consider it a success and plot the location of the
+      # known sample on the map (see mapstats.RockIndex; the map has
+      # Rover.worldmap.resolution cells per meter)
+      resolution = Rover.worldmap.resolution
+      rock_size = max(int(2 * resolution), 1)
+      for idx in np.flatnonzero(Rover.rock_index.confirmed(Rover.samples_pos)):
+            test_rock_x = int(Rover.samples_pos[0][idx] * resolution)
+            test_rock_y = int(Rover.samples_pos[1][idx] * resolution)
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
+      # Statistics on the map results are kept up to date incrementally
+      # as perception updates the worldmap (see mapstats.MapStats)
+      # Percentage of the ground truth map that has been successfully found
+      perc_mapped = Rover.map_stats.perc_mapped()
+      # Number of good map pixel detections divided by total pixels 
       # found to be navigable terrain
-      if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-      else:
-            fidelity = 0
+      fidelity = Rover.map_stats.fidelity()
       # Flip the map for plotting so that the y-axis points upward in the display
       map_add = np.flipud(map_add).astype(np.float32)
       # Add some text about map and rock sample detection results
@@ -135,18 +110,46 @@ def create_output_images(Rover):
       cv2.putText(map_add,"Rocks: "+str(Rover.samples_found), (0, 55), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
 
-      # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-      
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      return map_add.astype(np.uint8)
+
+# Define a function to JPEG-encode an RGB uint8 image as a base64 string
+# backend is 'pil' (PIL + BytesIO) or 'cv2' (cv2.imencode, usually faster)
+def encode_image(img, quality=75, backend='pil'):
+      if backend == 'cv2':
+            ok, buff = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                                    [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+            return base64.b64encode(buff).decode("utf-8")
+      pil_img = Image.fromarray(img)
       buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+      pil_img.save(buff, format="JPEG", quality=int(quality))
+      return base64.b64encode(buff.getvalue()).decode("utf-8")
 
-      return encoded_string1, encoded_string2
+# Define a function to create display output given worldmap results
+def create_output_images(Rover, quality=75, backend='pil'):
 
+      # Convert map and vision image to base64 strings for sending to server
+      encoded_string1 = encode_image(compose_map_image(Rover), quality, backend)
+      encoded_string2 = encode_image(Rover.vision_image.astype(np.uint8), quality, backend)
 
+      return encoded_string1, encoded_string2
 
+# Define a function to handle one telemetry message: update the Rover, run
+# perception and decision and refresh the insets (an InsetRenderer)
+# Returns the camera image, the (throttle, brake, steer) commands and the
+# (map, vision) inset strings to send; commands are None for invalid telemetry
+def telemetry_step(Rover, data, insets, decoder=None):
+      with stage_seconds['decode'].time():
+            Rover, image = update_rover(Rover, data, decoder)
+      if not np.isfinite(Rover.vel):
+            invalid_frames.inc()
+            return image, None, ('', '')
+      # Execute the perception and decision steps to update the Rover's state
+      with stage_seconds['perception'].time():
+            perception_step(Rover)
+      with stage_seconds['decision'].time():
+            decision_step(Rover)
+      # Refresh the output images to send to server if due; the
+      # encoding happens in the background, so just take the latest
+      with stage_seconds['render'].time():
+            insets.submit(Rover)
+      return image, (Rover.throttle, Rover.brake, Rover.steer), insets.latest()
@@ -0,0 +1,82 @@
+import base64
+import logging
+import numpy as np
+import cv2
+
+log = logging.getLogger(__name__)
+
+# Numeric telemetry fields parsed in one go, in order; position is "x;y"
+numeric_fields = ('speed', 'position', 'yaw', 'pitch', 'roll', 'throttle', 'steering_angle')
+
+# Newer OpenCV can decode straight to RGB, older versions decode BGR
+_imread_rgb = getattr(cv2, 'IMREAD_COLOR_RGB', None)
+
+# Decoder for the simulator's telemetry messages.
+# The camera JPEG is decoded with cv2.imdecode into a frame buffer that is
+# reused from one message to the next, and the numeric fields are joined and
+# parsed in a single pass independent of the decimal convention
+class TelemetryDecoder():
+    def __init__(self):
+        self.frame = None # Reusable RGB frame buffer (rows, cols, 3) uint8
+        self.jpeg = None # Raw JPEG bytes of the last decoded frame
+
+    # Define a function to decode the base64 camera image into the frame buffer
+    # Returns the frame buffer, which is overwritten by the next call
+    def decode_image(self, img_string):
+        return self.decode_jpeg(base64.b64decode(img_string))
+
+    # Define a function to decode raw JPEG bytes into the frame buffer
+    def decode_jpeg(self, jpeg):
+        self.jpeg = jpeg
+        encoded = np.frombuffer(jpeg, dtype=np.uint8)
+        if _imread_rgb is not None:
+            decoded = cv2.imdecode(encoded, _imread_rgb)
+        else:
+            decoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        if decoded is None:
+            raise ValueError('invalid camera image in telemetry')
+        if self.frame is None or self.frame.shape != decoded.shape:
+            self.frame = np.empty(decoded.shape, dtype=np.uint8)
+        if _imread_rgb is not None:
+            np.copyto(self.frame, decoded)
+        else:
+            cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB, dst=self.frame)
+        return self.frame
+
+    # Define a function to parse the numeric fields
+    # Returns speed, (x, y), yaw, pitch, roll, throttle, steering_angle
+    def decode_fields(self, data):
+        joined = ';'.join([data[field] for field in numeric_fields])
+        speed, x, y, yaw, pitch, roll, throttle, steer = \
+            [float(value) for value in joined.replace(',', '.').split(';')]
+        return speed, (x, y), yaw, pitch, roll, throttle, steer
+
+# Define a function to parse a ';' separated list of numbers (e.g. samples_x)
+def parse_list(string):
+    return [float(value) for value in string.replace(',', '.').split(';')]
+
+# Define a function to build a simulator-style telemetry message (what
+# TelemetryDecoder parses) from raw JPEG bytes and the numeric fields
+# samples_pos are the (x positions, y positions) of the rock samples
+def encode_message(jpeg, speed, position, yaw, pitch, roll, throttle, steer,
+                   samples_pos=((100, 50, 150, 120, 60, 30), (90, 80, 100, 20, 140, 60)),
+                   sample_count=None, near_sample=0, picking_up=0):
+    return {
+        'speed': str(speed), 'position': '{};{}'.format(position[0], position[1]),
+        'yaw': str(yaw), 'pitch': str(pitch), 'roll': str(roll),
+        'throttle': str(throttle), 'steering_angle': str(steer),
+        'near_sample': str(int(near_sample)), 'picking_up': str(int(picking_up)),
+        'sample_count': str(len(samples_pos[0]) if sample_count is None else sample_count),
+        'samples_x': ';'.join(str(x) for x in samples_pos[0]),
+        'samples_y': ';'.join(str(y) for y in samples_pos[1]),
+        'image': base64.b64encode(jpeg).decode('utf-8'),
+    }
+
+# Define a function to build the telemetry message of frame i of a recorded
+# run (see runs.py), as the simulator would have sent it
+def run_message(run, i, **kwargs):
+    columns = run.columns
+    return encode_message(bytes(run.jpeg(i)), columns['Speed'][i],
+                          (columns['X_Position'][i], columns['Y_Position'][i]),
+                          columns['Yaw'][i], columns['Pitch'][i], columns['Roll'][i],
+                          columns['Throttle'][i], columns['SteerAngle'][i], **kwargs)
@@ -0,0 +1,25 @@
+# Checks of the fused label classifier
+# Example: $ python -m pytest -q test_classify.py
+import numpy as np
+
+import classify
+from benchmark import inrange_masks
+from perception import classify_pixels
+
+# The fused label classifier gives the same masks as one cv2.inRange() per class
+def test_classifier_matches_inrange(frames):
+    rng = np.random.RandomState(0)
+    images = frames[:10] + [rng.randint(0, 256, (160, 320, 3)).astype(np.uint8)]
+    for img in images:
+        for expected, mask in zip(inrange_masks(img), classify_pixels(img)):
+            assert np.array_equal(expected, mask)
+
+# Cached packing levels are only seeded when their gray values do not collide
+def test_seeded_packing_levels_are_checked(monkeypatch):
+    monkeypatch.setattr(classify, '_levels_cache', {})
+    classify.seed_packing_levels(3, np.array([0, 1, 2]))
+    assert 3 not in classify._levels_cache
+    levels = classify._packing_levels(3)
+    classify._levels_cache.clear()
+    classify.seed_packing_levels(3, levels)
+    assert classify._levels_cache[3] is levels
@@ -0,0 +1,42 @@
+# Checks of the incremental exploration frontier
+# Example: $ python -m pytest -q test_frontier.py
+import numpy as np
+
+from frontier import FrontierIndex
+from worldmap import WorldMap, FREE, UNKNOWN, NAVIGABLE_CHANNEL, cell_occupancy
+
+# Define a function to find the frontier of a worldmap with a full scan:
+# free cells with an unknown 4-neighbour (cells outside the map are not unknown)
+def full_frontier(worldmap):
+    size = worldmap.size
+    grid = cell_occupancy(worldmap.dense().reshape(-1, 3)).reshape(size, size)
+    padded = np.pad(grid, 1, constant_values=FREE)
+    near_unknown = (padded[:-2, 1:-1] == UNKNOWN) | (padded[2:, 1:-1] == UNKNOWN) | \
+                   (padded[1:-1, :-2] == UNKNOWN) | (padded[1:-1, 2:] == UNKNOWN)
+    return (grid == FREE) & near_unknown
+
+# The frontier kept from the updates of a recorded run is the one a full
+# scan of the final map finds
+def test_frontier_matches_full_scan(run_frames):
+    Rover, _ = run_frames(planning=True)
+    expected = full_frontier(Rover.worldmap)
+    assert np.any(expected)
+    assert np.array_equal(Rover.frontier.frontier, expected)
+    assert Rover.frontier.count == np.count_nonzero(expected)
+
+# Clusters are offered from their cell nearest the centroid; tiny ones are not
+def test_frontier_clusters():
+    worldmap = WorldMap(40)
+    frontier = FrontierIndex(40)
+    worldmap.trackers.append(frontier)
+    # A free 5x5 block (its border is frontier) and a single free cell
+    ys, xs = np.mgrid[10:15, 10:15]
+    cells = np.append(ys.ravel() * 40 + xs.ravel(), 30 * 40 + 30)
+    worldmap.add_flat(cells * 3 + NAVIGABLE_CHANNEL)
+    assert frontier.count == 16 + 1
+    targets, sizes = frontier.clusters()
+    assert sizes.tolist() == [16]
+    assert frontier.nearest((0, 0)) == tuple(targets[0])
+    assert frontier.largest((0, 0)) == tuple(targets[0])
+    assert frontier.nearest((12, 12), min_distance=10) is None
+    assert frontier.nearest((0, 0), exclude={tuple(targets[0])}) is None
@@ -0,0 +1,37 @@
+# Checks of the incremental map statistics and map overlay
+# Example: $ python -m pytest -q test_mapstats.py
+import numpy as np
+
+from benchmark import load_pose
+from perception import perception_step
+from rover_state import RoverState
+
+# The statistics kept from the updates are the ones a full scan of the map gives
+def test_stats_match_full_scan(run_frames):
+    Rover, _ = run_frames()
+    stats = Rover.map_stats
+    counts = Rover.worldmap.dense()
+    navigable = counts[:,:,2] > 0
+    truth = Rover.ground_truth[:,:,1] > 0
+    assert stats.nav_cells == np.count_nonzero(navigable)
+    assert stats.good_nav_cells == np.count_nonzero(navigable & truth)
+    assert stats.obs_cells == np.count_nonzero(counts[:,:,0] > 0)
+    assert np.isclose(stats.nav_sum, counts[:,:,2].sum(dtype=np.float64))
+    assert stats.perc_mapped() == round(100 * np.count_nonzero(navigable & truth) / np.count_nonzero(truth), 1)
+
+# Rendered every frame, the overlay always equals a full redraw of the map
+# with the scales it was last normalized with
+def test_overlay_matches_full_redraw(frames, poses):
+    Rover = RoverState()
+    overlay = Rover.map_overlay
+    for i in range(len(frames)):
+        perception_step(load_pose(Rover, frames, poses, i))
+        image = overlay.render(Rover.worldmap)
+        counts = Rover.worldmap.dense().astype(np.float64)
+        navigable = counts[:,:,2] * overlay.scales[0]
+        obstacle = counts[:,:,0] * overlay.scales[1]
+        obstacle[navigable >= obstacle] = 0
+        expected = 0.5 * Rover.ground_truth.astype(np.float64)
+        expected[:,:,0] += np.clip(obstacle, 0, 255)
+        expected[:,:,2] += np.clip(navigable, 0, 255)
+        assert np.array_equal(image, expected)
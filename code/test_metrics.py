@@ -0,0 +1,49 @@
+# Checks of the metrics registry and its text exporter
+# Example: $ python -m pytest -q test_metrics.py
+import pytest
+
+from metrics import Registry
+
+# Every metric is exported in the text exposition format, histogram buckets
+# cumulative
+def test_export():
+    registry = Registry()
+    registry.counter('frames_total', 'Frames').inc(3)
+    registry.gauge('fps').set(25)
+    histogram = registry.histogram('step_seconds', 'Step', buckets=(0.01, 0.1))
+    for value in (0.005, 0.05, 0.05, 1.0):
+        histogram.observe(value)
+    lines = registry.export().splitlines()
+    assert lines[:3] == ['# HELP frames_total Frames', '# TYPE frames_total counter', 'frames_total 3']
+    assert 'fps 25' in lines
+    assert 'step_seconds_bucket{le="0.01"} 1' in lines
+    assert 'step_seconds_bucket{le="0.1"} 3' in lines
+    assert 'step_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'step_seconds_count 4' in lines
+    assert histogram.quantile(0.5) == 0.1 and histogram.quantile(1.0) == float('inf')
+
+# Getting a metric again returns it, under another kind it is an error
+def test_registry_reuses_metrics():
+    registry = Registry()
+    counter = registry.counter('dropped_total')
+    assert registry.counter('dropped_total') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('dropped_total')
+    counter.inc()
+    registry.reset()
+    assert counter.value == 0
+
+# Snapshots of other registries add up with this one's on export
+def test_export_merges_snapshots():
+    registry, worker = Registry(), Registry()
+    registry.counter('frames_total').inc(2)
+    worker.counter('frames_total').inc(3)
+    worker.histogram('step_seconds', buckets=(0.01, 0.1)).observe(0.05)
+    lines = registry.export([worker.snapshot(), worker.snapshot()]).splitlines()
+    assert 'frames_total 8' in lines
+    assert 'step_seconds_bucket{le="0.1"} 2' in lines and 'step_seconds_count 2' in lines
+    # The registry itself is unchanged
+    assert 'frames_total 2' in registry.export().splitlines()
+    with pytest.raises(ValueError):
+        registry.histogram('step_seconds', buckets=(1.0,))
+        registry.merge(worker.snapshot())
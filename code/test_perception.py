@@ -0,0 +1,90 @@
+# Checks of the perception paths against the warp path they replace
+# Example: $ python -m pytest -q test_perception.py
+import numpy as np
+import pytest
+
+import perception
+from perception import perspective_points, perspect_transform, classify_pixels, rover_coords, \
+    to_polar_coords, perception_batch, tilt_correct, AdaptiveResolution
+from worldmap import WorldMap
+
+# The default warp path runs end to end and finds navigable terrain
+def test_warp_perception_runs(frames, run_frames):
+    src, dst = perspective_points(frames[0].shape)
+    x_pix, y_pix = rover_coords(classify_pixels(perspect_transform(frames[0], src, dst))[2])
+    assert x_pix.dtype == np.float64 and len(x_pix) > 0
+    assert len(to_polar_coords(x_pix, y_pix)[0]) == len(x_pix)
+    Rover, outputs = run_frames()
+    assert Rover.map_stats.perc_mapped() > 0
+    assert all(len(dist) > 0 for dist, _, _ in outputs)
+
+# The projection table path (and the memory-lean buffers) give exactly the
+# navigable pixels, vision image and worldmap of the warp path
+@pytest.mark.parametrize('mode,lean', [('lookup', False), ('warp', True), ('lookup', True)])
+def test_perception_modes_match_warp(run_frames, mode, lean):
+    warp_rover, warp_outputs = run_frames()
+    Rover, outputs = run_frames(perception_mode=mode, lean=lean)
+    for expected, output in zip(warp_outputs, outputs):
+        for a, b in zip(expected, output):
+            assert np.array_equal(a, b)
+    assert np.array_equal(Rover.worldmap.dense(), warp_rover.worldmap.dense())
+
+# roi mode leaves out the warp border, its rock and navigable cells match
+def test_roi_matches_warp(run_frames):
+    warp_rover, warp_outputs = run_frames()
+    Rover, outputs = run_frames(perception_mode='roi')
+    for expected, output in zip(warp_outputs, outputs):
+        assert np.array_equal(expected[0], output[0]) and np.array_equal(expected[1], output[1])
+    assert np.array_equal(Rover.worldmap.dense()[:,:,1:], warp_rover.worldmap.dense()[:,:,1:])
+
+# The roi stride doubles while frames are over budget, halves again once
+# they are well under it, and stays within 1..max_stride
+def test_adaptive_resolution():
+    adaptive = AdaptiveResolution(budget=0.003, max_stride=4)
+    strides = [adaptive.update(seconds) for seconds in (0.005, 0.005, 0.005, 0.002, 0.001, 0.001, 0.001)]
+    assert strides == [2, 4, 4, 4, 2, 1, 1]
+
+# perception_batch() accumulates the same worldmap as perception_step() frame by frame
+@pytest.mark.parametrize('mode', ['warp', 'lookup'])
+def test_batch_matches_per_frame(frames, poses, run_frames, mode):
+    Rover, _ = run_frames(perception_mode=mode)
+    worldmap = perception_batch(np.stack(frames), poses, WorldMap(200), mode, batch_size=16)
+    assert np.array_equal(worldmap.dense(), Rover.worldmap.dense())
+
+# The batch skips the same tilted frames as perception_step(), with any level_tilt
+def test_batch_follows_level_tilt(frames, poses, run_frames, monkeypatch):
+    monkeypatch.setattr(perception, 'level_tilt', 0.5)
+    Rover, _ = run_frames()
+    worldmap = perception_batch(np.stack(frames), poses, WorldMap(200), batch_size=7)
+    assert np.array_equal(worldmap.dense(), Rover.worldmap.dense())
+
+# Define a function to get the level-ground coords a camera tilted by pitch
+# and roll (degrees) sees the ground points (x, y) at: the inverse of
+# tilt_correct(), by rotating the rays to the points into the camera frame
+def tilted_view(x, y, pitch, roll, height):
+    p, r = np.radians(pitch), np.radians(roll)
+    # tilt_correct() rotates camera rays by pitch about y, then by roll about x
+    rotate_pitch = np.array([[np.cos(p), 0, np.sin(p)], [0, 1, 0], [-np.sin(p), 0, np.cos(p)]])
+    rotate_roll = np.array([[1, 0, 0], [0, np.cos(r), -np.sin(r)], [0, np.sin(r), np.cos(r)]])
+    rays = (rotate_roll @ rotate_pitch).T @ np.array([x, y, np.full(len(x), -height)])
+    return height * rays[0] / -rays[2], height * rays[1] / -rays[2]
+
+# Pitch/roll correction puts the pixels of a tilted frame back on the ground
+# points they show; on a level frame it changes nothing
+@pytest.mark.parametrize('pitch,roll', [(0, 0), (2.5, 0), (0, 357), (358, 3)])
+def test_tilt_correct_inverts_the_tilt(pitch, roll):
+    rng = np.random.RandomState(0)
+    x, y = rng.uniform(5, 150, 200), rng.uniform(-100, 100, 200)
+    x_pix, y_pix = tilted_view(x, y, pitch, roll, height=20.0)
+    x_ground, y_ground, valid = tilt_correct(x_pix, y_pix, pitch, roll, height=20.0, max_range=1000)
+    assert np.all(valid)
+    assert np.allclose(x_ground, x) and np.allclose(y_ground, y)
+
+# Rays the tilt turns above the horizon, or farther than max_range, are dropped
+def test_tilt_correct_drops_far_pixels():
+    x_pix, y_pix = np.array([10.0, 100.0, 1000.0]), np.zeros(3)
+    # Nose up by 10 degrees: the near pixel lands a bit farther away, the
+    # middle one beyond max_range and the far one's ray above the horizon
+    x_ground, _, valid = tilt_correct(x_pix, y_pix, 350, 0, height=20.0, max_range=150)
+    assert valid.tolist() == [True, False, False]
+    assert 10 < x_ground[0] < 15
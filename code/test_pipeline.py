@@ -0,0 +1,62 @@
+# Checks of the newest-frame telemetry pipeline
+# Example: $ python -m pytest -q test_pipeline.py
+from pipeline import FramePipeline
+
+# Define a function to make a pipeline whose worker loop only runs when the
+# test calls it, returns the pipeline, its started loops and its deliveries
+def manual_pipeline():
+    loops, delivered = [], []
+    pipeline = FramePipeline(lambda data: data * 10, lambda result, received: delivered.append(result),
+                             spawn=loops.append)
+    return pipeline, loops, delivered
+
+# Frames replaced before the worker got to them are dropped as stale and
+# only the newest one is processed
+def test_newest_frame_wins():
+    pipeline, loops, delivered = manual_pipeline()
+    for data in (1, 2, 3):
+        pipeline.submit(data)
+    assert len(loops) == 1
+    loops[0]()
+    assert delivered == [30]
+    assert (pipeline.submitted, pipeline.processed, pipeline.dropped) == (3, 1, 2)
+    # The worker stopped, the next frame starts it again
+    pipeline.submit(4)
+    assert len(loops) == 2
+    loops[1]()
+    assert delivered == [30, 40]
+
+# close() drops the pending frame and ignores later ones
+def test_close_drops_pending_frames():
+    pipeline, loops, delivered = manual_pipeline()
+    pipeline.submit(1)
+    pipeline.close()
+    pipeline.submit(2)
+    loops[0]()
+    assert delivered == []
+    assert (pipeline.submitted, pipeline.processed, pipeline.dropped) == (1, 0, 1)
+
+# discard() hears about every dropped frame, stale or pending at close()
+def test_discard_gets_dropped_frames():
+    discarded = []
+    pipeline = FramePipeline(lambda data: data, lambda result, received: None,
+                             spawn=lambda fn: None, discard=discarded.append)
+    for data in (1, 2, 3):
+        pipeline.submit(data)
+    pipeline.close()
+    assert discarded == [1, 2, 3] and pipeline.dropped == 3
+
+# A failing frame is logged and the worker goes on with the next one
+def test_failed_frame_does_not_stop_the_worker():
+    delivered = []
+    def process(data):
+        if data == 1:
+            raise RuntimeError('bad frame')
+        return data
+    pipeline = FramePipeline(process, lambda result, received: delivered.append(result),
+                             spawn=lambda fn: None)
+    pipeline.submit(1)
+    pipeline._run()
+    pipeline.submit(2)
+    pipeline._run()
+    assert delivered == [2] and pipeline.processed == 2
@@ -0,0 +1,105 @@
+# Checks of the incremental path planner
+# Example: $ python -m pytest -q test_planner.py
+import heapq
+import math
+import numpy as np
+import pytest
+
+from planner import Planner
+from worldmap import WorldMap, FREE, BLOCKED, NAVIGABLE_CHANNEL, OBSTACLE_CHANNEL, cell_occupancy
+
+size = 30
+cell_costs = (1.0, 3.0, float('inf'))
+
+# Define a function to get the cost of the cheapest path from start to goal
+# with a plain Dijkstra over the occupancy grid (entering a cell costs the
+# step length times the cell's cost)
+def dijkstra(occupancy, start, goal):
+    dist = {start: 0.0}
+    heap = [(0.0, start)]
+    while heap:
+        d, (x, y) = heapq.heappop(heap)
+        if (x, y) == goal:
+            return d
+        if d > dist[(x, y)]:
+            continue
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                nx, ny = x + dx, y + dy
+                if (dx or dy) and 0 <= nx < size and 0 <= ny < size:
+                    nd = d + math.hypot(dx, dy) * cell_costs[occupancy[ny, nx]]
+                    if nd < dist.get((nx, ny), float('inf')):
+                        dist[(nx, ny)] = nd
+                        heapq.heappush(heap, (nd, (nx, ny)))
+    return float('inf')
+
+# Define a function to mark cells free or blocked on the worldmap, with
+# enough hits to outweigh what the cells had
+def mark(worldmap, cells, occ):
+    ys, xs = np.asarray(cells[0]), np.asarray(cells[1])
+    counts = worldmap.cell_counts(ys * size + xs).astype(np.float64)
+    navigable, obstacle = counts[:, NAVIGABLE_CHANNEL], 0.25 * counts[:, OBSTACLE_CHANNEL]
+    if occ == FREE:
+        channel, hits = NAVIGABLE_CHANNEL, np.maximum(obstacle - navigable, 0) + 1
+    else:
+        channel, hits = OBSTACLE_CHANNEL, 4 * (np.maximum(navigable - obstacle, 0) + 1)
+    worldmap.add_flat((ys * size + xs) * 3 + channel, hits)
+    assert np.all(occupancy(worldmap)[ys, xs] == occ)
+
+# Define a function to get the occupancy grid of the worldmap
+def occupancy(worldmap):
+    return cell_occupancy(worldmap.counts.reshape(-1, 3), 0.25).reshape(size, size)
+
+# Define a function to plan until the plan is final, within the budget per call
+def plan(planner):
+    for _ in range(10000):
+        if planner.plan():
+            return
+    raise AssertionError('plan did not finish')
+
+# The planner finds the same path costs as Dijkstra, also after the map
+# changes and the rover moves, with a small budget per plan() call
+@pytest.mark.parametrize('seed', range(5))
+def test_planner_matches_dijkstra(seed):
+    rng = np.random.RandomState(seed)
+    worldmap = WorldMap(size)
+    planner = Planner(size, budget=50)
+    worldmap.trackers.append(planner)
+    mark(worldmap, np.nonzero(rng.rand(size, size) < 0.5), FREE)
+    mark(worldmap, np.nonzero(rng.rand(size, size) < 0.2), BLOCKED)
+    goal, start = (25, 27), (2, 3)
+    mark(worldmap, ([goal[1], start[1]], [goal[0], start[0]]), FREE)
+    planner.set_goal(goal)
+    for step in range(6):
+        planner.set_start(start)
+        plan(planner)
+        grid = occupancy(worldmap)
+        expected = dijkstra(grid, start, goal)
+        assert math.isclose(planner.g[planner.index(start)], expected)
+        # Following the path costs what the plan promised
+        path = planner.path(steps=1000)
+        assert path[-1] == goal
+        cost, previous = 0.0, start
+        for cell in path:
+            cost += math.hypot(cell[0] - previous[0], cell[1] - previous[1]) * \
+                cell_costs[grid[cell[1], cell[0]]]
+            previous = cell
+        assert math.isclose(cost, expected)
+        # Block part of the path, clear some other cells and move along
+        ys, xs = np.array([c[1] for c in path[3:6]]), np.array([c[0] for c in path[3:6]])
+        keep = (xs != goal[0]) | (ys != goal[1])
+        mark(worldmap, (ys[keep], xs[keep]), BLOCKED)
+        mark(worldmap, np.nonzero(rng.rand(size, size) < 0.05), FREE)
+        start = path[0]
+
+# A goal walled off by blocked cells is reported unreachable
+def test_planner_unreachable_goal():
+    worldmap = WorldMap(size)
+    planner = Planner(size)
+    worldmap.trackers.append(planner)
+    wall = np.array([(x, y) for x in range(18, 23) for y in range(18, 23) if x in (18, 22) or y in (18, 22)])
+    mark(worldmap, (wall[:, 1], wall[:, 0]), BLOCKED)
+    planner.set_goal((20, 20))
+    planner.set_start((2, 2))
+    plan(planner)
+    assert not planner.reachable() and planner.path() == []
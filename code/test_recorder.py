@@ -0,0 +1,54 @@
+# Checks of the background run recorder
+# Example: $ python -m pytest -q test_recorder.py
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+from benchmark import dataset_dir
+from recorder import RunRecorder, recorder_dropped
+from runs import CsvRun
+
+# Define a function to get a Rover-like pose for frame i of a run
+def run_pose(run, i):
+    columns = run.columns
+    return SimpleNamespace(steer=columns['SteerAngle'][i], throttle=columns['Throttle'][i],
+                           brake=columns['Brake'][i], vel=columns['Speed'][i],
+                           pos=(columns['X_Position'][i], columns['Y_Position'][i]),
+                           pitch=columns['Pitch'][i], yaw=columns['Yaw'][i], roll=columns['Roll'][i])
+
+# A recording reads back as the same frames (byte for byte) and log columns
+def test_recording_round_trip(tmp_path):
+    source = CsvRun(dataset_dir)
+    recorder = RunRecorder(str(tmp_path), batch_size=4)
+    for i in range(10):
+        assert recorder.record(source.jpeg(i), run_pose(source, i))
+    recorder.close()
+    run = CsvRun(str(tmp_path))
+    assert len(run) == 10
+    for i in range(10):
+        assert run.jpeg(i) == source.jpeg(i)
+    for name, values in run.columns.items():
+        assert np.array_equal(values, source.columns[name][:10])
+    # Frame names stay unique and in order
+    assert np.all(np.diff(run.times) > 0)
+
+# Frames are dropped, not queued without bound, while the writer is stuck
+def test_full_queue_drops_frames(tmp_path):
+    source = CsvRun(dataset_dir)
+    recorder = RunRecorder(str(tmp_path), max_queue=2, batch_size=1)
+    writing, release = threading.Event(), threading.Event()
+    write = recorder._write
+    def slow_write(batch):
+        writing.set()
+        release.wait()
+        write(batch)
+    recorder._write = slow_write
+    dropped = recorder_dropped.value
+    recorder.record(source.jpeg(0), run_pose(source, 0))
+    writing.wait()
+    results = [recorder.record(source.jpeg(i), run_pose(source, i)) for i in range(1, 5)]
+    assert results == [True, True, False, False]
+    assert recorder_dropped.value == dropped + 2
+    release.set()
+    recorder.close()
+    assert len(CsvRun(str(tmp_path))) == 3
@@ -0,0 +1,64 @@
+# Checks of the rock sample tracker
+# Example: $ python -m pytest -q test_rocks.py
+from types import SimpleNamespace
+import numpy as np
+
+from benchmark import load_frames, load_poses, load_pose
+from perception import perception_step
+from rocks import RockTracker
+from rover_state import RoverState
+
+# Define a function to get a Rover-like view at pos, yaw (degrees) with
+# 3x3 pixel rocks at the given world positions (meters) in its vision image
+def rover_view(tracker, pos, yaw, rocks=()):
+    vision = np.zeros((160, 320, 3), dtype=np.uint8)
+    for x, y in rocks:
+        x_rover, y_rover = tracker.to_rover(x, y, pos, yaw)
+        col, row = int(round(160 - y_rover)), int(round(160 - x_rover))
+        if 0 < x_rover and 1 <= row < 159 and 1 <= col < 319:
+            vision[row - 1:row + 2, col - 1:col + 2, 1] = 255
+    return SimpleNamespace(vision_image=vision, pos=pos, yaw=yaw, samples_found=0)
+
+# A rock seen twice becomes the target, at its distance and bearing
+def test_rock_becomes_target():
+    tracker = RockTracker()
+    rock = (15.0, 12.0)
+    for _ in range(2):
+        tracker.update(rover_view(tracker, (10.0, 10.0), 0.0, [rock]))
+    assert len(tracker.tracks) == 1 and tracker.target is tracker.tracks[0]
+    dist, angle = tracker.target_polar((10.0, 10.0), 0.0)
+    assert abs(dist - np.hypot(50, 20)) < 2 and abs(angle - np.degrees(np.arctan2(20, 50))) < 2
+
+# The target is only approached while it is in view and was seen lately;
+# the track itself is remembered and continues when the rock is back
+def test_target_needs_a_recent_sighting_in_view():
+    tracker = RockTracker(max_coast=3)
+    pos, rock = (10.0, 10.0), (16.0, 10.0)
+    for _ in range(3):
+        tracker.update(rover_view(tracker, pos, 0.0, [rock]))
+    track = tracker.target
+    # Turned away: the rock is behind the rover, no target at once
+    tracker.update(rover_view(tracker, pos, 180.0))
+    assert tracker.target is None and tracker.tracks == [track]
+    # In view but missed: the target coasts for max_coast frames
+    for frame in range(5):
+        tracker.update(rover_view(tracker, pos, 0.0))
+        assert (tracker.target is track) == (frame < 2)
+    # Seen again: the same track is the target again
+    tracker.update(rover_view(tracker, pos, 0.0, [rock]))
+    assert tracker.target is track and track.hits == 4
+
+# On the recorded run (its frames with a rock in view) the target is
+# always a rock in front of the rover that was seen lately
+def test_recorded_targets_are_in_view():
+    frames, poses = load_frames(140), load_poses(140)
+    Rover = RoverState()
+    tracker = Rover.rock_tracker
+    targets = 0
+    for i in range(90, 140):
+        perception_step(load_pose(Rover, frames, poses, i))
+        if tracker.target is not None:
+            targets += 1
+            assert tracker.frame - tracker.target.last_seen <= tracker.max_coast
+            assert tracker.in_view(*tracker.to_rover(tracker.target.x, tracker.target.y, Rover.pos, Rover.yaw))
+    assert targets > 0
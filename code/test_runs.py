@@ -0,0 +1,35 @@
+# Checks of the single-file run container
+# Example: $ python -m pytest -q test_runs.py
+import numpy as np
+import pytest
+
+from benchmark import dataset_dir
+from runs import CsvRun, RunFile, convert, open_run, write_run
+
+# A converted run reads back with the same columns, times and frames
+def test_container_round_trip(tmp_path):
+    source = CsvRun(dataset_dir)
+    path = convert(dataset_dir, str(tmp_path / 'test.run'))
+    run = open_run(path)
+    assert isinstance(run, RunFile) and len(run) == len(source)
+    for name, values in source.columns.items():
+        assert np.array_equal(run.columns[name], values)
+    assert np.array_equal(run.times, source.times)
+    for i in (0, 1, len(run) // 2, len(run) - 1):
+        assert bytes(run.jpeg(i)) == source.jpeg(i)
+    # A range of frames is their JPEGs back to back
+    blob, offsets = run.jpegs(2, 5)
+    for k in range(3):
+        assert bytes(blob[offsets[k]:offsets[k + 1]]) == source.jpeg(2 + k)
+
+# Columns of the wrong length and files that are not containers are rejected
+def test_container_rejects_bad_input(tmp_path):
+    source = CsvRun(dataset_dir)
+    columns = {name: values[:3] for name, values in source.columns.items()}
+    columns['Speed'] = columns['Speed'][:2]
+    with pytest.raises(ValueError):
+        write_run(str(tmp_path / 'bad.run'), columns, source.times[:3], [source.jpeg(i) for i in range(3)])
+    other = tmp_path / 'other.run'
+    other.write_bytes(b'NOTARUN!' + bytes(64))
+    with pytest.raises(ValueError):
+        RunFile(str(other))
@@ -0,0 +1,75 @@
+# Checks of the per-client sessions, in process and sharded over workers
+# Example: $ python -m pytest -q test_sessions.py
+import pytest
+
+from benchmark import load_telemetry
+from metrics import Registry
+from recorder import recorder_dropped
+from runs import CsvRun
+from sessions import SessionManager, ShardedSessions
+
+@pytest.fixture(scope='module')
+def messages():
+    return load_telemetry(10)
+
+# Define a function to drive two clients through a session store, returns
+# the results of each client's frames
+def drive_clients(sessions, messages):
+    results = {'a': [], 'b': []}
+    for sid in results:
+        sessions.open(sid)
+    for data in messages:
+        for sid in results:
+            results[sid].append(sessions.step(sid, data))
+    return results
+
+# Every client gets commands and insets for its frames from a Rover of its own
+def test_sessions_per_client(messages):
+    sessions = SessionManager({})
+    results = drive_clients(sessions, messages)
+    assert len(sessions) == 2
+    assert sessions.get('a').Rover is not sessions.get('b').Rover
+    for sid in results:
+        for commands, strings, pickup in results[sid]:
+            assert len(commands) == 3 and len(strings) == 2
+    # Both clients sent the same frames, so they get the same commands
+    assert [r[0] for r in results['a']] == [r[0] for r in results['b']]
+    # Telemetry of a closed or unknown client is dropped
+    sessions.close('a')
+    assert sessions.step('a', messages[0]) is None and sessions.step('c', messages[0]) is None
+    assert len(sessions) == 1
+
+# A recording session records valid frames and counts invalid ones as dropped
+def test_invalid_frames_count_as_dropped(messages, tmp_path):
+    sessions = SessionManager({'image_folder': str(tmp_path)})
+    sessions.open('a')
+    dropped = recorder_dropped.value
+    commands, _, _ = sessions.step('a', messages[0])
+    assert commands is not None
+    commands, _, _ = sessions.step('a', dict(messages[1], speed='nan'))
+    assert commands is None
+    sessions.close('a')
+    assert recorder_dropped.value == dropped + 1
+    assert len(CsvRun(str(tmp_path))) == 1
+
+# Sharded sessions spread the clients over the workers and give the same
+# commands as in-process sessions
+def test_sharded_sessions_match(messages):
+    expected = drive_clients(SessionManager({}), messages)
+    sessions = ShardedSessions({}, 2)
+    try:
+        results = drive_clients(sessions, messages)
+        assert len(sessions) == 2
+        assert sessions.assigned['a'] is not sessions.assigned['b']
+        for sid in results:
+            assert [r[0] for r in results[sid]] == [r[0] for r in expected[sid]]
+        sessions.close('a')
+        assert sessions.step('a', messages[0]) is None
+        # The shards' metrics reach the server's registry
+        merged = Registry()
+        for snapshot in sessions.snapshots():
+            merged.merge(snapshot)
+        assert merged.histogram('rover_decode_seconds').count == 2 * len(messages)
+        assert merged.histogram('rover_perception_seconds').count == 2 * len(messages)
+    finally:
+        sessions.stop()
@@ -0,0 +1,16 @@
+# Checks of the telemetry decoder
+# Example: $ python -m pytest -q test_telemetry.py
+import numpy as np
+
+from benchmark import load_telemetry, legacy_decode
+from telemetry import TelemetryDecoder
+
+# The telemetry decoder gives the same frames and fields as PIL and float()
+def test_decoder_matches_pil():
+    decoder = TelemetryDecoder()
+    for data in load_telemetry(10):
+        fields, image = legacy_decode(data)
+        speed, position, yaw, pitch, roll, throttle, steer = decoder.decode_fields(data)
+        assert [speed, yaw, pitch, roll, throttle, steer] == fields[:6]
+        assert list(position) == fields[6]
+        assert np.array_equal(decoder.decode_image(data['image']), image)
@@ -0,0 +1,111 @@
+# Checks of the worldmap hit accumulation
+# Example: $ python -m pytest -q test_worldmap.py
+import numpy as np
+import pytest
+
+from benchmark import load_pose
+from perception import perception_step, pix_to_world
+from rover_state import RoverState
+from worldmap import WorldMap, TiledWorldMap, HitScratch, group_hits
+
+# add_flat() counts every hit of a cell, like np.add.at(), and reports the
+# changed cells with their old and new counts
+def test_add_flat_counts_every_hit():
+    rng = np.random.RandomState(0)
+    worldmap = WorldMap(200)
+    expected = np.zeros(200 * 200 * 3)
+    for n in (5000, 20, 0):
+        flat = rng.randint(0, 200 * 200 * 3, n)
+        weights = rng.uniform(0.1, 2, n)
+        before = expected.copy()
+        np.add.at(expected, flat, weights)
+        update = worldmap.add_flat(flat, weights)
+        assert np.array_equal(update.cells, np.unique(flat))
+        assert np.allclose(update.old, before[update.cells])
+        assert np.allclose(update.new, expected[update.cells])
+    assert np.allclose(worldmap.dense().reshape(-1), expected)
+
+# With a HitScratch add_flat() gives the same updates and counts, zero
+# weight hits are left out and the accumulator is clear after every frame
+def test_add_flat_scratch_matches():
+    rng = np.random.RandomState(0)
+    plain, lean, scratch = WorldMap(200, dtype=np.uint8), WorldMap(200, dtype=np.uint8), HitScratch()
+    for n in (5000, 20, 0, 3000):
+        flat = rng.randint(0, 200 * 200 * 3, n)
+        weights = rng.randint(0, 3, n).astype(np.float64)
+        expected = plain.add_flat(flat[weights > 0], weights[weights > 0])
+        update = lean.add_flat(flat, weights, scratch)
+        for a, b in zip(expected, update):
+            assert np.array_equal(a, b)
+        assert not scratch.acc.any()
+    assert np.array_equal(lean.dense(), plain.dense())
+
+# Both group_hits() paths (dense bincount and unique) give the same sums
+def test_group_hits_paths_agree():
+    flat = np.array([7, 3, 7, 100000, 3, 3])
+    cells, hits = group_hits(flat, None)
+    assert cells.tolist() == [3, 7, 100000] and hits.tolist() == [3, 2, 1]
+    cells, hits = group_hits(flat[[0, 1, 2, 4]], np.full(4, 0.5))
+    assert cells.tolist() == [3, 7] and hits.tolist() == [1.0, 1.0]
+
+# Counts saturate instead of wrapping
+def test_counts_saturate():
+    worldmap = WorldMap(10, dtype=np.uint8)
+    for _ in range(2):
+        worldmap.add_flat(np.zeros(200, dtype=np.intp))
+    assert worldmap.dense()[0, 0, 0] == 255
+
+# The tiled worldmap keeps the same counts, updates and statistics as the dense one
+def test_tiled_matches_dense(run_frames):
+    dense_rover, _ = run_frames()
+    tiled_rover, _ = run_frames(tiled=True)
+    assert np.array_equal(tiled_rover.worldmap.dense(), dense_rover.worldmap.dense())
+    assert tiled_rover.map_stats.perc_mapped() == dense_rover.map_stats.perc_mapped()
+    assert tiled_rover.map_stats.fidelity() == dense_rover.map_stats.fidelity()
+    rng = np.random.RandomState(0)
+    dense, tiled = WorldMap(200), TiledWorldMap(200)
+    for _ in range(5):
+        flat = rng.randint(0, 200 * 200 * 3, 5000)
+        weights = rng.uniform(0.1, 2, len(flat))
+        expected, update = dense.add_flat(flat, weights), tiled.add_flat(flat, weights)
+        for a, b in zip(expected, update):
+            assert np.array_equal(a, b)
+    assert np.array_equal(tiled.dense(), dense.dense())
+
+# Hits outside the window, negative cells too, are kept in their tiles
+def test_tiled_keeps_cells_outside_the_window():
+    tiled = TiledWorldMap(100, tile_size=16)
+    update = tiled.add([(np.array([-5, 150, 3]), np.array([-40, 7, 3]))] + [(np.zeros(0), np.zeros(0))] * 2)
+    assert update.cells.tolist() == [(3 * 100 + 3) * 3]
+    assert tiled.dense(-5, -40, 1, 1)[0, 0, 0] == 1
+    assert tiled.dense(150, 7, 1, 1)[0, 0, 0] == 1
+    assert len(tiled.tiles) == 3
+
+# On an unbounded map world coords round down, so a rover left of and below
+# the origin maps the same cells as one at positive coords, shifted
+def test_unbounded_map_rounds_down(frames, poses):
+    x_world, y_world = pix_to_world(np.array([5.0, -5.0, -15.0]), np.zeros(3), 0.0, 0.0, 0.0, None, 10)
+    assert x_world.tolist() == [0, -1, -2] and y_world.tolist() == [0, 0, 0]
+    dense = RoverState()
+    tiled = RoverState(tiled=True)
+    shifted = dict(poses, pos=poses['pos'] - 150)
+    for i in range(len(frames)):
+        perception_step(load_pose(dense, frames, poses, i))
+        perception_step(load_pose(tiled, frames, shifted, i))
+    assert np.array_equal(tiled.worldmap.dense(-150, -150, 200, 200), dense.worldmap.dense())
+
+# At other resolutions the map statistics, overlay and rock index work in
+# the worldmap's cells: finer cells map about as much of the ground truth
+@pytest.mark.parametrize('resolution', [2.0, 0.5])
+def test_resolution_scales_the_trackers(run_frames, resolution):
+    meter_rover, _ = run_frames()
+    Rover, _ = run_frames(resolution=resolution, lean=True)
+    size = int(200 * resolution)
+    assert Rover.worldmap.dense().shape == (size, size, 3)
+    assert abs(Rover.map_stats.perc_mapped() - meter_rover.map_stats.perc_mapped()) < 2
+    assert Rover.map_stats.tot_map_pix == pytest.approx(meter_rover.map_stats.tot_map_pix * resolution**2, rel=0.05)
+    assert Rover.map_overlay.render(Rover.worldmap).shape == (size, size, 3)
+    # A rock cell confirms a sample within 3 meters, in meters
+    none = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    Rover.worldmap.add([none, (np.array([int(50 * resolution)]), np.array([int(60 * resolution)])), none])
+    assert Rover.rock_index.confirmed(([51, 50], [61, 70])).tolist() == [True, False]
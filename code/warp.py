@@ -0,0 +1,76 @@
+import numpy as np
+import cv2
+
+# Cache of WarpMap objects keyed by (image shape, src points, dst points)
+_warp_cache = {}
+
+# Precomputed perspective warp for one camera geometry.  The homography and
+# the per-pixel remap coordinates are computed once, so warping a frame is a
+# single cv2.remap() call instead of getPerspectiveTransform + warpPerspective
+# maps, if given, are previously computed (map_x, map_y) for the same
+# geometry (see artifacts.py)
+class WarpMap():
+    def __init__(self, shape, src, dst, maps=None):
+        self.shape = tuple(shape[:2]) # (rows, cols) of input and output image
+        self.src = np.float32(src) # Source points in the camera image
+        self.dst = np.float32(dst) # Destination points in the warped image
+        # Forward homography (camera -> warped), same as perspect_transform used
+        self.M = cv2.getPerspectiveTransform(self.src, self.dst)
+        # Inverse homography (warped -> camera), this is what remap needs
+        self.M_inv = np.linalg.inv(self.M)
+        # Float maps: for every output pixel the camera pixel it samples from
+        self.map_x, self.map_y = self._build_maps() if maps is None else maps
+        # Fixed-point variants (16-bit integer coords + interpolation table index),
+        # the representation older OpenCV versions use inside warpPerspective
+        self.map_fixed, self.map_frac = cv2.convertMaps(self.map_x, self.map_y, cv2.CV_16SC2)
+
+    def _build_maps(self):
+        rows, cols = self.shape
+        ygrid, xgrid = np.indices((rows, cols), dtype=np.float64)
+        Mi = self.M_inv
+        w = Mi[2, 0] * xgrid + Mi[2, 1] * ygrid + Mi[2, 2]
+        # Mimic warpPerspective: a zero denominator maps to the origin
+        w = np.where(w != 0, 1.0 / np.where(w != 0, w, 1.0), 0.0)
+        map_x = (Mi[0, 0] * xgrid + Mi[0, 1] * ygrid + Mi[0, 2]) * w
+        map_y = (Mi[1, 0] * xgrid + Mi[1, 1] * ygrid + Mi[1, 2]) * w
+        # Anything outside the camera image only ever samples the (black) border,
+        # so clip far-away coordinates to keep them inside the 16-bit range
+        map_x = np.clip(map_x, -2, cols + 1).astype(np.float32)
+        map_y = np.clip(map_y, -2, rows + 1).astype(np.float32)
+        return map_x, map_y
+
+    # Define a function to warp a camera image with the cached maps
+    def warp(self, img, fixed_point=False, interpolation=cv2.INTER_LINEAR, dst=None):
+        if fixed_point:
+            map1, map2 = self.map_fixed, self.map_frac
+            if interpolation == cv2.INTER_NEAREST:
+                # The fractional table is only used for interpolation
+                map2 = None
+        else:
+            map1, map2 = self.map_x, self.map_y
+        return cv2.remap(img, map1, map2, interpolation, dst=dst,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    # Mask of output pixels that sample from inside the camera image
+    def footprint(self):
+        rows, cols = self.shape
+        return (self.map_x >= 0) & (self.map_x <= cols - 1) \
+             & (self.map_y >= 0) & (self.map_y <= rows - 1)
+
+# Define a function to build a cache key from an image shape and point sets
+def _warp_key(shape, src, dst):
+    return (tuple(shape[:2]), np.float32(src).tobytes(), np.float32(dst).tobytes())
+
+# Define a function to return the cached WarpMap for a geometry, building it once
+# (from maps, if given)
+def get_warp_map(shape, src, dst, maps=None):
+    key = _warp_key(shape, src, dst)
+    warp_map = _warp_cache.get(key)
+    if warp_map is None:
+        warp_map = WarpMap(shape, src, dst, maps)
+        _warp_cache[key] = warp_map
+    return warp_map
+
+# Define a function to drop cached maps, e.g. after a camera re-calibration
+def clear_warp_cache():
+    _warp_cache.clear()
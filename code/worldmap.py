@@ -0,0 +1,390 @@
+from collections import namedtuple
+import numpy as np
+
+# Worldmap channels, same layout as Rover.vision_image
+OBSTACLE_CHANNEL = 0
+ROCK_CHANNEL = 1
+NAVIGABLE_CHANNEL = 2
+
+# Occupancy classes of worldmap cells (see cell_occupancy)
+FREE = 0 # Navigable hits outweigh obstacle hits
+UNKNOWN = 1 # Never seen
+BLOCKED = 2 # Obstacle hits outweigh navigable hits
+
+# Define a function to classify cells from their hit counts (rows of
+# WorldMap.counts.reshape(-1, 3)).  A frame has many more obstacle than
+# navigable pixels, so obstacle hits are weighed down by obstacle_weight
+# before the two are compared
+def cell_occupancy(counts, obstacle_weight=0.25):
+    obstacle = obstacle_weight * counts[:, OBSTACLE_CHANNEL]
+    navigable = counts[:, NAVIGABLE_CHANNEL]
+    return np.where(navigable > obstacle, FREE, np.where(obstacle > 0, BLOCKED, UNKNOWN)).astype(np.uint8)
+
+# Define a function to resample a grid with one entry per meter (e.g. the
+# ground truth map) to the window cells of a worldmap with `resolution`
+# cells per meter: every cell takes the entry of the meter its center lies
+# in, cells beyond the grid are zero.  Returns the grid itself at 1 cell per meter
+def meter_grid(grid, worldmap):
+    window, resolution = worldmap.window, worldmap.resolution
+    if resolution == 1 and grid.shape[:2] == (window, window):
+        return grid
+    meters = np.floor((np.arange(window) + 0.5) / resolution).astype(np.intp)
+    rows, cols = meters < grid.shape[0], meters < grid.shape[1]
+    out = np.zeros((window, window) + grid.shape[2:], dtype=grid.dtype)
+    out[np.ix_(rows, cols)] = grid[np.ix_(meters[rows], meters[cols])]
+    return out
+
+# Cells changed by one WorldMap.add(): flat indices into WorldMap.counts
+# (sorted, unique) with their values before and after the update
+MapUpdate = namedtuple('MapUpdate', ['cells', 'old', 'new'])
+
+# Define a function to sum hits per flat index
+# Returns the sorted unique indices and their summed weights
+def group_hits(flat, weights):
+    if len(flat) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0)
+    low = flat.min()
+    if len(flat) * 8 > flat.max() - low:
+        # Many hits: a dense bincount over the range they span beats sorting them
+        hits = np.bincount(flat - low, weights=weights)
+        cells = np.flatnonzero(hits)
+        return cells + low, hits[cells]
+    # Few hits: group them by index, cost depends only on the number of hits
+    cells, inverse = np.unique(flat, return_inverse=True)
+    return cells, np.bincount(inverse.ravel(), weights=weights, minlength=len(cells))
+
+# Preallocated buffers for WorldMap.add_flat(), so that accumulating a frame
+# allocates nothing.  Hits are summed with np.add.at into an accumulator the
+# size of the counts (left all zero between frames), the touched cells are
+# compressed out of a reused index span and the update arrays are views into
+# the buffers: they are only valid until the next add_flat() with this scratch
+class HitScratch():
+    def __init__(self):
+        self.key = None # Size and dtype of the counts the buffers were sized for
+
+    # Define a function to (re)size the buffers for a counts array if needed
+    def prepare(self, counts):
+        key = (counts.size, counts.dtype)
+        if key == self.key:
+            return
+        self.key = key
+        n = counts.size
+        self.acc = np.zeros(n, dtype=np.float64) # Summed weights per count entry
+        self.index = np.arange(n, dtype=np.intp)
+        self.touched = np.empty(n, dtype=bool)
+        self.cells = np.empty(n, dtype=np.intp)
+        self.hits = np.empty(n, dtype=np.float64)
+        self.total = np.empty(n, dtype=np.float64)
+        self.old = np.empty(n, dtype=counts.dtype)
+        self.new = np.empty(n, dtype=counts.dtype)
+
+    # Define a function to sum hits per flat index into the buffers
+    # Returns views of the sorted unique indices and their summed weights
+    def group(self, flat, weights):
+        if len(flat) == 0:
+            return self.cells[:0], self.hits[:0]
+        np.add.at(self.acc, flat, 1.0 if weights is None else weights)
+        low, high = flat.min(), flat.max() + 1
+        touched = self.touched[:high - low]
+        np.not_equal(self.acc[low:high], 0, out=touched)
+        k = np.count_nonzero(touched)
+        cells, hits = self.cells[:k], self.hits[:k]
+        np.compress(touched, self.index[low:high], out=cells)
+        np.take(self.acc, cells, out=hits, mode='clip')
+        self.acc.put(cells, 0)
+        return cells, hits
+
+# Define a function to check the count settings shared by the map stores
+# Returns the saturation to use for counts of this dtype
+def count_saturation(dtype, saturation=None, distance_falloff=None):
+    if distance_falloff is not None and np.issubdtype(dtype, np.integer):
+        raise ValueError('distance weighting needs a floating point WorldMap')
+    if saturation is None:
+        if np.issubdtype(dtype, np.integer):
+            saturation = np.iinfo(dtype).max
+        else:
+            # Largest count float32 still represents exactly
+            saturation = 2**24
+    return saturation
+
+# Define a function to get the hit weights of a frame of n hits for a map
+# store: distance weights (with distance_falloff and dists) times the frame
+# weight, None when every hit counts one
+def frame_weights(worldmap, n, dists=None, weight=None):
+    weights = None
+    if worldmap.distance_falloff is not None and dists is not None:
+        weights = worldmap.weights(np.concatenate(dists))
+    if weight is not None:
+        weights = np.full(n, float(weight)) if weights is None else weights * weight
+    return weights
+
+# Hit-count map of the world, one channel per class.
+# All classes of a frame are accumulated in one batched operation on flat
+# cell indices, so a cell hit by several pixels gets every hit (fancy-index
+# += counts duplicates only once).  Counts saturate at `saturation` instead
+# of wrapping or losing precision, and can optionally be weighted by the
+# rover-frame distance of each pixel (far pixels are less reliable)
+class WorldMap():
+    def __init__(self, size=200, dtype=np.float32, saturation=None, distance_falloff=None, resolution=1.0):
+        self.size = size # World is size x size cells
+        self.window = size # Side of the region trackers see, the whole map
+        self.resolution = resolution # Cells per meter
+        self.counts = np.zeros((size, size, 3), dtype=dtype)
+        self.saturation = count_saturation(self.counts.dtype, saturation, distance_falloff)
+        # Rover-frame distance (pixels) at which a hit counts half, None for unit weights
+        self.distance_falloff = distance_falloff
+        # Objects with an update(worldmap, map_update) method, called after every add()
+        self.trackers = []
+        # Incremented on every change, lets consumers skip work on an unchanged map
+        self.version = 0
+
+    # Define a function to convert rover-frame distances to hit weights
+    def weights(self, dists):
+        return self.distance_falloff / (self.distance_falloff + np.asarray(dists, dtype=np.float64))
+
+    # Define a function to accumulate one frame of world pixels
+    # world_pix is a sequence indexed by channel of (x_world, y_world) arrays,
+    # dists an optional matching sequence of rover-frame distances and weight
+    # an optional weight of every hit of the frame
+    def add(self, world_pix, dists=None, weight=None):
+        flat = []
+        for channel, (x_world, y_world) in enumerate(world_pix):
+            flat.append((np.asarray(y_world, dtype=np.intp) * self.size + x_world) * 3 + channel)
+        flat = np.concatenate(flat)
+        return self.add_flat(flat, frame_weights(self, len(flat), dists, weight))
+
+    # Define a function to accumulate hits given flat indices into counts
+    # With a HitScratch (sized to counts) nothing is allocated, and the
+    # returned update is made of views into the scratch
+    def add_flat(self, flat, weights=None, scratch=None):
+        counts = self.counts.reshape(-1)
+        if scratch is None:
+            cells, hits = group_hits(flat, weights)
+            old = counts[cells]
+            new = np.minimum(old + hits, self.saturation).astype(counts.dtype)
+        else:
+            scratch.prepare(counts)
+            cells, hits = scratch.group(flat, weights)
+            k = len(cells)
+            old, total = scratch.old[:k], scratch.total[:k]
+            np.take(counts, cells, out=old, mode='clip')
+            np.add(old, hits, out=total)
+            np.minimum(total, self.saturation, out=total)
+            new = scratch.new[:k]
+            np.copyto(new, total, casting='unsafe')
+        counts.put(cells, new)
+        self.version += 1
+        update = MapUpdate(cells, old, new)
+        for tracker in self.trackers:
+            tracker.update(self, update)
+        return update
+
+    # Define a function to get the (n, 3) counts of flat cell indices (y * size + x)
+    def cell_counts(self, cells):
+        return self.counts.reshape(-1, 3)[cells]
+
+    # Define a function to get the map as a (size, size, 3) array (no copy)
+    def dense(self):
+        return self.counts
+
+    @property
+    def dtype(self):
+        return self.counts.dtype
+
+    # Bytes of count storage
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    # Define a function to clear the map (e.g. when a new run starts)
+    def reset(self):
+        self.counts.fill(0)
+        self.version += 1
+        for tracker in self.trackers:
+            if hasattr(tracker, 'reset'):
+                tracker.reset()
+
+# Sparse hit-count map for large or unbounded worlds.
+# The map is split into tile_size x tile_size tiles that are only allocated
+# the first time a hit lands in them, so memory grows with the explored area
+# instead of the world bounds, and cells are never clipped (size is None, so
+# perception does not clip world coordinates; negative cells are fine too).
+# A frame's hits are scattered across tile boundaries in one batch: tiles
+# are numbered compactly, the hits are grouped by (tile, cell) with the same
+# bincount as WorldMap and each touched tile is then updated with one slice.
+# Trackers and the display see the window [0, window) x [0, window) cells,
+# with the same flat indices as a WorldMap(window) (hits outside the window
+# are kept but not reported to them); dense() exports it or any other region
+class TiledWorldMap():
+    def __init__(self, window=200, dtype=np.float32, saturation=None, distance_falloff=None,
+                 resolution=1.0, tile_size=64):
+        if tile_size & (tile_size - 1):
+            raise ValueError('tile_size must be a power of two')
+        self.size = None # Unbounded
+        self.window = window # Side of the region trackers and dense() see, in cells
+        self.resolution = resolution # Cells per meter
+        self.tile_size = tile_size
+        self.shift = tile_size.bit_length() - 1
+        self.tile_cells = tile_size * tile_size * 3 # Count entries per tile
+        self.dtype = np.dtype(dtype)
+        self.saturation = count_saturation(self.dtype, saturation, distance_falloff)
+        self.distance_falloff = distance_falloff
+        self.tiles = {} # (tile x, tile y) -> (tile_size, tile_size, 3) counts
+        self.trackers = []
+        self.version = 0
+
+    def weights(self, dists):
+        return self.distance_falloff / (self.distance_falloff + np.asarray(dists, dtype=np.float64))
+
+    # Define a function to accumulate one frame of world pixels (like WorldMap.add)
+    def add(self, world_pix, dists=None, weight=None):
+        xs, ys, channels = [], [], []
+        for channel, (x_world, y_world) in enumerate(world_pix):
+            xs.append(np.asarray(x_world, dtype=np.int64))
+            ys.append(np.asarray(y_world, dtype=np.int64))
+            channels.append(np.full(len(xs[-1]), channel, dtype=np.int64))
+        xs = np.concatenate(xs)
+        weights = frame_weights(self, len(xs), dists, weight)
+        return self.add_cells(xs, np.concatenate(ys), np.concatenate(channels), weights)
+
+    # Define a function to accumulate hits given flat window indices ((y * window + x) * 3 + channel)
+    def add_flat(self, flat, weights=None):
+        cells, channels = np.divmod(np.asarray(flat, dtype=np.int64), 3)
+        ys, xs = np.divmod(cells, self.window)
+        return self.add_cells(xs, ys, channels, weights)
+
+    # Define a function to accumulate hits given cell coords and channels
+    def add_cells(self, xs, ys, channels, weights=None):
+        self.version += 1
+        if len(xs) == 0:
+            update = MapUpdate(np.zeros(0, dtype=np.intp), np.zeros(0, self.dtype), np.zeros(0, self.dtype))
+            for tracker in self.trackers:
+                tracker.update(self, update)
+            return update
+        size, shift = self.tile_size, self.shift
+        tx0, ty0 = int(xs.min()) >> shift, int(ys.min()) >> shift
+        tx1, ty1 = int(xs.max()) >> shift, int(ys.max()) >> shift
+        if (tx1 - tx0 + 1) * (ty1 - ty0 + 1) * self.tile_cells <= max(8 * len(xs), 4 * self.tile_cells):
+            # A frame's hits: the tiles around them are few and mostly hit
+            return self._add_box(xs, ys, channels, weights, (tx0, ty0, tx1, ty1))
+        # Number the touched tiles 0..n-1 without sorting the hits
+        tx, ty = xs >> shift, ys >> shift
+        span = tx1 - tx0 + 1
+        key = (ty - ty0) * span + (tx - tx0)
+        touched = np.flatnonzero(np.bincount(key))
+        number = np.zeros(touched[-1] + 1, dtype=np.int64)
+        number[touched] = np.arange(len(touched))
+        local = ((ys & (size - 1)) * size + (xs & (size - 1))) * 3 + channels
+        flat, hits = group_hits(number[key] * self.tile_cells + local, weights)
+        # Hits are sorted by tile, so each tile gets one contiguous slice
+        bounds = np.searchsorted(flat, np.arange(len(touched) + 1) * self.tile_cells)
+        olds, news = [], []
+        for n, k in enumerate(touched.tolist()):
+            coords = (int(k % span + tx0), int(k // span + ty0))
+            tile = self.tiles.get(coords)
+            if tile is None:
+                tile = self.tiles[coords] = np.zeros((size, size, 3), dtype=self.dtype)
+            counts = tile.reshape(-1)
+            index = flat[bounds[n]:bounds[n + 1]] - n * self.tile_cells
+            old = counts[index]
+            new = np.minimum(old + hits[bounds[n]:bounds[n + 1]], self.saturation).astype(self.dtype)
+            counts[index] = new
+            olds.append(old)
+            news.append(new)
+        old, new = np.concatenate(olds), np.concatenate(news)
+        # Report the changes inside the window as flat window indices
+        tile_number, index = np.divmod(flat, self.tile_cells)
+        cell, channel = np.divmod(index, 3)
+        k = touched[tile_number]
+        x = (k % span + tx0) * size + cell % size
+        y = (k // span + ty0) * size + cell // size
+        inside = (x >= 0) & (x < self.window) & (y >= 0) & (y < self.window)
+        cells = ((y * self.window + x) * 3 + channel)[inside]
+        order = np.argsort(cells)
+        update = MapUpdate(cells[order].astype(np.intp), old[inside][order], new[inside][order])
+        for tracker in self.trackers:
+            tracker.update(self, update)
+        return update
+
+    # Define a function to add hits that lie in a small block of tiles: the
+    # hits are summed into one dense array over the block, which is added to
+    # the tiles slice by slice and is already in window order for the update
+    def _add_box(self, xs, ys, channels, weights, tile_box):
+        size = self.tile_size
+        tx0, ty0, tx1, ty1 = tile_box
+        x0, y0 = tx0 * size, ty0 * size
+        width, height = (tx1 - tx0 + 1) * size, (ty1 - ty0 + 1) * size
+        flat = ((ys - y0) * width + (xs - x0)) * 3 + channels
+        hits = np.bincount(flat, weights=weights, minlength=width * height * 3).reshape(height, width, 3)
+        old = np.zeros((height, width, 3), dtype=self.dtype)
+        blocks = []
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                block = (slice((ty - ty0) * size, (ty - ty0 + 1) * size),
+                         slice((tx - tx0) * size, (tx - tx0 + 1) * size))
+                tile = self.tiles.get((tx, ty))
+                if tile is not None:
+                    old[block] = tile
+                elif not hits[block].any():
+                    continue
+                blocks.append(((tx, ty), block))
+        new = np.minimum(old + hits, self.saturation).astype(self.dtype)
+        for coords, block in blocks:
+            self.tiles[coords] = new[block].copy()
+        # Report the changes inside the window as flat window indices
+        changed = np.flatnonzero(hits)
+        cell, channel = np.divmod(changed, 3)
+        y, x = np.divmod(cell, width)
+        x, y = x + x0, y + y0
+        inside = (x >= 0) & (x < self.window) & (y >= 0) & (y < self.window)
+        cells = ((y * self.window + x) * 3 + channel)[inside]
+        changed = changed[inside]
+        update = MapUpdate(cells.astype(np.intp), old.reshape(-1)[changed], new.reshape(-1)[changed])
+        for tracker in self.trackers:
+            tracker.update(self, update)
+        return update
+
+    # Define a function to get the (n, 3) counts of flat window cell indices (y * window + x)
+    def cell_counts(self, cells):
+        ys, xs = np.divmod(np.asarray(cells, dtype=np.int64), self.window)
+        out = np.zeros((len(xs), 3), dtype=self.dtype)
+        tx, ty = xs >> self.shift, ys >> self.shift
+        mask = self.tile_size - 1
+        for coords in set(zip(tx.tolist(), ty.tolist())):
+            tile = self.tiles.get(coords)
+            if tile is not None:
+                sel = (tx == coords[0]) & (ty == coords[1])
+                out[sel] = tile[ys[sel] & mask, xs[sel] & mask]
+        return out
+
+    # Define a function to export a region as a dense (height, width, 3) array
+    # (default the window), cells never hit are zero
+    def dense(self, x0=0, y0=0, width=None, height=None):
+        width = self.window if width is None else width
+        height = self.window if height is None else height
+        out = np.zeros((height, width, 3), dtype=self.dtype)
+        size = self.tile_size
+        for (tx, ty), tile in self.tiles.items():
+            # Overlap of the tile with the region, in world cells
+            left, top = max(tx * size, x0), max(ty * size, y0)
+            right, bottom = min((tx + 1) * size, x0 + width), min((ty + 1) * size, y0 + height)
+            if left < right and top < bottom:
+                out[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile[top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+        return out
+
+    # The window as a dense array, a copy (for code written against WorldMap.counts)
+    @property
+    def counts(self):
+        return self.dense()
+
+    @property
+    def nbytes(self):
+        return len(self.tiles) * self.tile_cells * self.dtype.itemsize
+
+    def reset(self):
+        self.tiles.clear()
+        self.version += 1
+        for tracker in self.trackers:
+            if hasattr(tracker, 'reset'):
+                tracker.reset()